@@ -382,6 +382,7 @@ function sectionScore(stateSection, configSection){
 
 // Offline data storage and synchronization functions
 const OFFLINE_QUEUE_KEY = 'scouting_offline_queue';
+const REJECTED_QUEUE_KEY = 'scouting_rejected_submissions';
 const SYNC_INTERVAL = 30000; // 30 seconds
 
 // Retrieves offline data queue from localStorage
@@ -427,6 +428,12 @@ async function processOfflineQueue() {
       }
       if (response && response.ok) {
         successful.push(item.id);
+      } else if (response && response.status === 400) {
+        // Retrying will not help; keep it in the rejected store until the scout fixes it
+        const result = await response.json();
+        addToRejected(item, result.details);
+        showNotification(`Offline entry needs fixing: ${describeValidationErrors(result.details)}`, 'error');
+        successful.push(item.id);
       }
     } catch (error) {
       console.error('Error processing offline item:', error);
@@ -440,6 +447,116 @@ async function processOfflineQueue() {
   }
 }
 
+// Retrieves entries the server rejected with a validation error
+function getRejectedSubmissions() {
+  const rejected = localStorage.getItem(REJECTED_QUEUE_KEY);
+  return rejected ? JSON.parse(rejected) : [];
+}
+
+// Saves the rejected entries and tells any open rejected-entries panel to redraw
+function saveRejectedSubmissions(rejected) {
+  localStorage.setItem(REJECTED_QUEUE_KEY, JSON.stringify(rejected));
+  window.dispatchEvent(new Event('rejected-submissions-changed'));
+}
+
+// Moves an offline queue item into the rejected store along with the server's field errors
+function addToRejected(item, errors) {
+  const rejected = getRejectedSubmissions().filter(r => r.id !== item.id);
+  rejected.push({ ...item, errors: errors || [], rejectedAt: new Date().toISOString() });
+  saveRejectedSubmissions(rejected);
+}
+
+// Downloads every rejected entry as JSON so nothing is lost if it cannot be fixed on this device
+export function exportRejectedSubmissions() {
+  const blob = new Blob([JSON.stringify(getRejectedSubmissions(), null, 2)], { type: 'application/json' });
+  const url = window.URL.createObjectURL(blob);
+  const a = document.createElement('a');
+  a.href = url;
+  a.download = `rejected-scouting-${new Date().toISOString().split('T')[0]}.json`;
+  a.click();
+  window.URL.revokeObjectURL(url);
+}
+
+// Sends a fixed rejected entry again; it leaves the store only once the server accepts it
+async function resubmitRejected(id) {
+  const rejected = getRejectedSubmissions();
+  const item = rejected.find(r => r.id === id);
+  if (!item) return;
+  try {
+    const r = await fetch(item.type === 'pit' ? '/api/pits' : '/api/matches', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(item.data)
+    });
+    if (r.ok) {
+      saveRejectedSubmissions(rejected.filter(x => x.id !== id));
+      showNotification('Rejected entry saved');
+    } else if (r.status === 400) {
+      item.errors = (await r.json()).details || [];
+      saveRejectedSubmissions(rejected);
+      showNotification(`Still invalid: ${describeValidationErrors(item.errors)}`, 'error');
+    } else {
+      throw new Error('Server error');
+    }
+  } catch (error) {
+    showNotification('Could not reach the server; try again when online', 'error');
+  }
+}
+
+// Renders the rejected entries of one type with an input for each field the server flagged
+export function renderRejectedSubmissions(root, type) {
+  const draw = () => {
+    root.innerHTML = '';
+    const rejected = getRejectedSubmissions().filter(r => r.type === type);
+    if (rejected.length === 0) return;
+    const card = el('div', {class: 'card'});
+    card.appendChild(el('h2', {}, `Rejected entries (${rejected.length})`));
+    card.appendChild(el('button', {class: 'btn', onclick: exportRejectedSubmissions}, 'Export all'));
+    rejected.forEach(item => {
+      const pre = item.data.pre_match_json || item.data.pit_json || {};
+      const title = `Team ${pre.team_number ?? '?'}` + (pre.match_number != null ? ` • Match ${pre.match_number}` : '');
+      const entry = el('div', {class: 'form-row'}, el('label', {}, `${title} (${item.timestamp})`));
+      item.errors.filter(e => e.field).forEach(e => {
+        const path = e.field.split('.');
+        const current = get(item.data, path);
+        const input = el('input', {
+          type: 'text',
+          value: current === undefined ? '' : (typeof current === 'object' ? JSON.stringify(current) : String(current)),
+          oninput: ev => {
+            let value = ev.target.value;
+            try { value = JSON.parse(value); } catch (err) { /* keep as text */ }
+            set(item.data, path, value);
+          }
+        });
+        entry.appendChild(el('div', {class: 'form-controls'}, el('span', {}, `${e.field}: ${e.error} `), input));
+      });
+      const save = () => {
+        const all = getRejectedSubmissions();
+        const index = all.findIndex(x => x.id === item.id);
+        if (index >= 0) all[index] = item;
+        localStorage.setItem(REJECTED_QUEUE_KEY, JSON.stringify(all));
+      };
+      entry.appendChild(el('div', {class: 'form-controls'},
+        el('button', {class: 'btn btn-green', onclick: () => { save(); resubmitRejected(item.id); }}, 'Resubmit'),
+        el('button', {class: 'btn btn-red', onclick: () => {
+          if (confirm('Discard this entry? Export it first if you may need it.')) {
+            saveRejectedSubmissions(getRejectedSubmissions().filter(x => x.id !== item.id));
+          }
+        }}, 'Discard')
+      ));
+      card.appendChild(entry);
+    });
+    root.appendChild(card);
+  };
+  window.addEventListener('rejected-submissions-changed', draw);
+  draw();
+}
+
+// Formats the {field, error} list from a 400 validation response as one line
+function describeValidationErrors(details){
+  return (details || []).map(d => d.field ? `${d.field}: ${d.error}` : d.error).join('; ');
+}
+
 // Displays a temporary notification message to the user
 function showNotification(message, type = 'success') {
   const notification = document.createElement('div');
@@ -623,6 +740,11 @@ export async function buildMatchForm(root, totalsEl){
         const r = await fetch('/api/matches',{method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(state)});
         if (r.ok) {
           return r.json();
+        } else if (r.status === 400) {
+          const result = await r.json();
+          const message = describeValidationErrors(result.details);
+          showNotification(`Please fix: ${message}`, 'error');
+          return { invalid: true, errors: result.details || [], message };
         } else {
           throw new Error('Server error');
         }
@@ -667,6 +789,11 @@ export async function buildPitForm(root){
 	const r = await fetch('/api/pits', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(state)});
         if (r.ok) {
           return r.json();
+        } else if (r.status === 400) {
+          const result = await r.json();
+          const message = describeValidationErrors(result.details);
+          showNotification(`Please fix: ${message}`, 'error');
+          return { invalid: true, errors: result.details || [], message };
         } else {
           throw new Error('Server error');
         }
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, request, jsonify, send_file, send_from_directory, has_request_context, Response, stream_with_context, g, make_response
 from flask_cors import CORS
 import json
 import os
@@ -16,9 +16,21 @@ import csv
 from io import StringIO
 from datetime import datetime
 import secrets
+import re
+import time
+import math
+import gzip
+import zlib
+import itertools
+import shutil
+import weakref
+import queue
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+import numpy as np
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Cursor', 'ETag', 'X-Checklist-Version', 'Retry-After', 'X-Snapshot-Version', 'X-Snapshot-Age'])
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB limit
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -42,18 +54,190 @@ def read_config():
     with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
         return json.load(f)
 
+# Server-side database settings from the "database" block of config.json (read once at startup)
+DB_SETTINGS = read_config().get('database', {})
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    factory = TracedConnection if query_trace['enabled'] else sqlite3.Connection
+    snapshot = request_snapshot()
+    if snapshot is not None:
+        conn = sqlite3.connect(snapshot['uri'], uri=True, factory=factory)
+        conn.execute('PRAGMA query_only = 1')
+    else:
+        conn = sqlite3.connect(DB_PATH, factory=factory)
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DROP TABLE IF EXISTS batteries")
-    cursor.execute("DROP TABLE IF EXISTS battery_logs")
 
 
+
+
+
+
+# ==================== QUERY TRACING ====================
+
+query_trace = {
+    'enabled': bool(DB_SETTINGS.get('trace_queries', False)),
+    'threshold_ms': float(DB_SETTINGS.get('slow_query_ms', 50)),
+    'top_n': int(DB_SETTINGS.get('slow_query_top_n', 10)),
+}
+slow_queries = deque(maxlen=int(DB_SETTINGS.get('slow_query_window', 200)))
+slow_queries_lock = threading.Lock()
+
+"""Cursor that times each statement, including the time spent fetching its rows."""
+class TracedCursor(sqlite3.Cursor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._trace = None
+
+    def _add_time(self, start):
+        if self._trace is not None:
+            self._trace[2] += time.perf_counter() - start
+
+    def _finish_trace(self):
+        if self._trace is not None:
+            sql, params, elapsed = self._trace
+            self._trace = None
+            record_query(self.connection, sql, params, elapsed)
+
+    def execute(self, sql, parameters=()):
+        self._finish_trace()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._trace = [sql, parameters, time.perf_counter() - start]
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish_trace()
+        seq_of_parameters = list(seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._trace = [sql, seq_of_parameters[0] if seq_of_parameters else (), time.perf_counter() - start]
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._add_time(start)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        start = time.perf_counter()
+        rows = super().fetchmany(*args, **kwargs)
+        self._add_time(start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._add_time(start)
+        self._finish_trace()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            self._add_time(start)
+
+    def close(self):
+        self._finish_trace()
+        super().close()
+
+"""Connection whose cursors are traced; pending statements are recorded when it closes."""
+class TracedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._traced_cursors = weakref.WeakSet()
+
+    def cursor(self, factory=TracedCursor):
+        cursor = super().cursor(factory)
+        if isinstance(cursor, TracedCursor):
+            self._traced_cursors.add(cursor)
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        for cursor in list(self._traced_cursors):
+            cursor._finish_trace()
+        super().close()
+
+"""Describes bound parameters by type only, so logged entries never contain scouting data."""
+def param_shape(params):
+    if isinstance(params, dict):
+        return {key: type(value).__name__ for key, value in params.items()}
+    return [type(value).__name__ for value in params]
+
+"""Runs EXPLAIN QUERY PLAN for a statement on an untraced cursor."""
+def explain_query_plan(conn, sql, params):
+    if sql.lstrip().split(None, 1)[0].upper() not in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+        return []
+    try:
+        cursor = sqlite3.Connection.cursor(conn, sqlite3.Cursor)
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = [row[3] for row in cursor.fetchall()]
+        cursor.close()
+        return plan
+    except sqlite3.Error as e:
+        return ['unavailable: {}'.format(e)]
+
+"""Records a traced statement if it ran longer than the slow-query threshold."""
+def record_query(conn, sql, params, elapsed):
+    elapsed_ms = elapsed * 1000
+    if elapsed_ms < query_trace['threshold_ms']:
+        return
+    route = '{} {}'.format(request.method, request.endpoint) if has_request_context() else 'background'
+    entry = {
+        'sql': ' '.join(sql.split()),
+        'elapsed_ms': round(elapsed_ms, 2),
+        'route': route,
+        'params': param_shape(params),
+        'plan': explain_query_plan(conn, sql, params),
+        'at': datetime.now().isoformat(timespec='seconds')
+    }
+    with slow_queries_lock:
+        slow_queries.append(entry)
+    print("Slow query ({elapsed_ms}ms) in {route}: {sql} params={params} plan={plan}".format(**entry))
+
+"""Groups the rolling window of slow statements and returns the N with the most total time."""
+def slow_query_summary():
+    with slow_queries_lock:
+        entries = list(slow_queries)
+    grouped = {}
+    for entry in entries:
+        stats = grouped.setdefault(entry['sql'], {
+            'sql': entry['sql'], 'count': 0, 'total_ms': 0, 'max_ms': 0, 'routes': [], 'params': entry['params']
+        })
+        stats['count'] += 1
+        stats['total_ms'] += entry['elapsed_ms']
+        stats['max_ms'] = max(stats['max_ms'], entry['elapsed_ms'])
+        stats['plan'] = entry['plan']
+        if entry['route'] not in stats['routes']:
+            stats['routes'].append(entry['route'])
+    top = sorted(grouped.values(), key=lambda s: s['total_ms'], reverse=True)[:query_trace['top_n']]
+    for stats in top:
+        stats['total_ms'] = round(stats['total_ms'], 2)
+        stats['avg_ms'] = round(stats['total_ms'] / stats['count'], 2)
+    return top
+
+
+
+
+
+
+
+# ==================== SCHEMA MIGRATIONS ====================
+
+"""Creates the original tables. Existing tables and their rows are left untouched."""
+def migration_001_initial_schema(conn):
     conn.execute('''
         CREATE TABLE IF NOT EXISTS matches(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -128,21 +312,1131 @@ def init_db():
             FOREIGN KEY (battery_id) REFERENCES batteries (id)
         )
     ''')
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM users WHERE role = "admin"')
-    admin_count = cursor.fetchone()[0]
+
+"""Creates the default admin (admin/admin123) when the database has no admin yet."""
+def migration_002_default_admin(conn):
+    admin_count = conn.execute("SELECT COUNT(*) FROM users WHERE role = 'admin'").fetchone()[0]
     if admin_count == 0:
-        # Default admin: username=admin, password=admin123
         password_hash = hashlib.sha256('admin123'.encode()).hexdigest()
-        cursor.execute(
+        conn.execute(
             'INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)',
             ('admin', password_hash, 'admin')
         )
         print("Created default admin user: admin/admin123")
-    
-    conn.commit()
-    conn.close()
-init_db()
+
+"""Switches to WAL so readers no longer block the writer thread (the mode persists in the file)."""
+def migration_003_wal_journal(conn):
+    conn.execute('PRAGMA journal_mode=WAL')
+
+# Bumps matches.row_version whenever a match's JSON changes; recreated by reindex_matches
+MATCHES_ROW_VERSION_TRIGGER = '''
+    CREATE TRIGGER IF NOT EXISTS matches_row_version
+    AFTER UPDATE OF pre_match_json, auto_json, teleop_json, endgame_json, misc_json ON matches
+    BEGIN
+        UPDATE matches SET row_version = OLD.row_version + 1 WHERE id = NEW.id;
+    END
+'''
+MATCHES_TEAM_INDEX = '''
+    CREATE INDEX IF NOT EXISTS idx_matches_team
+    ON matches (CAST(json_extract(pre_match_json, '$.team_number') AS TEXT))
+'''
+MATCHES_EVENT_INDEX = '''
+    CREATE INDEX IF NOT EXISTS idx_matches_event
+    ON matches (COALESCE(json_extract(pre_match_json, '$.event_code'), 'Unknown'), id)
+'''
+
+"""Adds a per-row version so cached decoded matches can be validated without reading their JSON."""
+def migration_004_match_row_version(conn):
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(matches)').fetchall()]
+    if 'row_version' not in columns:
+        conn.execute('ALTER TABLE matches ADD COLUMN row_version INTEGER NOT NULL DEFAULT 1')
+    conn.execute(MATCHES_ROW_VERSION_TRIGGER)
+    conn.execute(MATCHES_TEAM_INDEX)
+
+"""Indexes battery_logs for per-battery and time-ordered reads (rowid breaks created_at ties)."""
+def migration_005_battery_log_indexes(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_battery_logs_battery_created ON battery_logs (battery_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_battery_logs_created ON battery_logs (created_at)')
+
+BATTERY_ROLLUP_COLUMNS = (
+    'battery_id, bucket_kind, bucket, scans, uses, charge_sum, v0_min, v0_max, v0_sum, '
+    'v2_min, v2_max, v2_sum, sag_max, sag_sum, rint_min, rint_max, rint_sum, first_scan, last_scan'
+)
+# Aggregates of battery_logs rows in the order of BATTERY_ROLLUP_COLUMNS after the bucket; sag is v0 - v2
+BATTERY_ROLLUP_AGGREGATES = (
+    "COUNT(*), SUM(status = 'In Use'), SUM(charge), MIN(v0), MAX(v0), SUM(v0), MIN(v2), MAX(v2), SUM(v2), "
+    "MAX(v0 - v2), SUM(v0 - v2), MIN(rint), MAX(rint), SUM(rint), MIN(created_at), MAX(created_at)"
+)
+BATTERY_ROLLUP_NEW_ROW = (
+    "1, NEW.status = 'In Use', NEW.charge, NEW.v0, NEW.v0, NEW.v0, NEW.v2, NEW.v2, NEW.v2, "
+    "NEW.v0 - NEW.v2, NEW.v0 - NEW.v2, NEW.rint, NEW.rint, NEW.rint, NEW.created_at, NEW.created_at"
+)
+BATTERY_ROLLUP_MERGE = '''
+    ON CONFLICT (battery_id, bucket_kind, bucket) DO UPDATE SET
+        scans = scans + excluded.scans, uses = uses + excluded.uses, charge_sum = charge_sum + excluded.charge_sum,
+        v0_min = min(v0_min, excluded.v0_min), v0_max = max(v0_max, excluded.v0_max), v0_sum = v0_sum + excluded.v0_sum,
+        v2_min = min(v2_min, excluded.v2_min), v2_max = max(v2_max, excluded.v2_max), v2_sum = v2_sum + excluded.v2_sum,
+        sag_max = max(sag_max, excluded.sag_max), sag_sum = sag_sum + excluded.sag_sum,
+        rint_min = min(rint_min, excluded.rint_min), rint_max = max(rint_max, excluded.rint_max),
+        rint_sum = rint_sum + excluded.rint_sum,
+        first_scan = min(first_scan, excluded.first_scan), last_scan = max(last_scan, excluded.last_scan)
+'''
+# A new log is merged into its day and event buckets in O(1). min/max cannot be un-merged, so a
+# deleted log's two buckets are recomputed from their remaining logs (an index range per bucket).
+BATTERY_ROLLUP_TRIGGERS = ('''
+    CREATE TRIGGER IF NOT EXISTS battery_logs_rollup_insert AFTER INSERT ON battery_logs
+    BEGIN
+        INSERT INTO battery_rollups ({columns})
+        SELECT NEW.battery_id, 'day', date(NEW.created_at), {new_row} WHERE 1
+        {merge};
+        INSERT INTO battery_rollups ({columns})
+        SELECT NEW.battery_id, 'event', NEW.event_code, {new_row} WHERE NEW.event_code IS NOT NULL
+        {merge};
+    END
+'''.format(columns=BATTERY_ROLLUP_COLUMNS, new_row=BATTERY_ROLLUP_NEW_ROW, merge=BATTERY_ROLLUP_MERGE), '''
+    CREATE TRIGGER IF NOT EXISTS battery_logs_rollup_delete AFTER DELETE ON battery_logs
+    BEGIN
+        DELETE FROM battery_rollups WHERE battery_id = OLD.battery_id AND (
+            (bucket_kind = 'day' AND bucket = date(OLD.created_at)) OR (bucket_kind = 'event' AND bucket = OLD.event_code)
+        );
+        INSERT INTO battery_rollups ({columns})
+        SELECT battery_id, 'day', date(OLD.created_at), {aggregates} FROM battery_logs
+        WHERE battery_id = OLD.battery_id
+          AND created_at >= date(OLD.created_at) AND created_at < date(OLD.created_at, '+1 day')
+        GROUP BY battery_id;
+        INSERT INTO battery_rollups ({columns})
+        SELECT battery_id, 'event', event_code, {aggregates} FROM battery_logs
+        WHERE battery_id = OLD.battery_id AND event_code = OLD.event_code
+        GROUP BY battery_id;
+    END
+'''.format(columns=BATTERY_ROLLUP_COLUMNS, aggregates=BATTERY_ROLLUP_AGGREGATES))
+
+"""Adds battery_logs.event_code and per-battery daily and per-event rollups kept current by triggers."""
+def migration_006_battery_rollups(conn):
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(battery_logs)').fetchall()]
+    if 'event_code' not in columns:
+        conn.execute('ALTER TABLE battery_logs ADD COLUMN event_code TEXT')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS battery_rollups(
+            battery_id TEXT NOT NULL,
+            bucket_kind TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            scans INTEGER NOT NULL,
+            uses INTEGER NOT NULL,
+            charge_sum REAL NOT NULL,
+            v0_min REAL, v0_max REAL, v0_sum REAL NOT NULL,
+            v2_min REAL, v2_max REAL, v2_sum REAL NOT NULL,
+            sag_max REAL, sag_sum REAL NOT NULL,
+            rint_min REAL, rint_max REAL, rint_sum REAL NOT NULL,
+            first_scan TEXT,
+            last_scan TEXT,
+            PRIMARY KEY (battery_id, bucket_kind, bucket)
+        )
+    ''')
+    conn.execute('DELETE FROM battery_rollups')
+    conn.execute('''
+        INSERT INTO battery_rollups ({columns})
+        SELECT battery_id, 'day', date(created_at), {aggregates} FROM battery_logs GROUP BY battery_id, date(created_at)
+    '''.format(columns=BATTERY_ROLLUP_COLUMNS, aggregates=BATTERY_ROLLUP_AGGREGATES))
+    for trigger in BATTERY_ROLLUP_TRIGGERS:
+        conn.execute(trigger)
+
+"""Partitions matches by event with an (event_code, id) index so event-scoped reads skip other events."""
+def migration_007_match_event_index(conn):
+    conn.execute(MATCHES_EVENT_INDEX)
+
+"""Enables incremental auto_vacuum so freed pages can be returned in small steps; changing the mode needs one VACUUM."""
+def migration_008_incremental_vacuum(conn):
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+
+"""Adds the compressed archive tier: one zlib block per archived table and scope, plus a team lookup."""
+def migration_009_archive_blocks(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive_blocks(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            scope TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            stored_bytes INTEGER NOT NULL,
+            archived_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            data BLOB NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive_teams(
+            team_number TEXT NOT NULL,
+            block_id INTEGER NOT NULL,
+            PRIMARY KEY (team_number, block_id)
+        ) WITHOUT ROWID
+    ''')
+
+# Ordered (version, name, function, transactional). Never edit or reorder an applied entry; append a new one.
+# Non-transactional migrations (PRAGMAs, VACUUM) run outside BEGIN and must be safe to repeat.
+MIGRATIONS = [
+    (1, 'initial schema', migration_001_initial_schema, True),
+    (2, 'default admin user', migration_002_default_admin, True),
+    (3, 'write-ahead log journal', migration_003_wal_journal, False),
+    (4, 'match row versions and team index', migration_004_match_row_version, True),
+    (5, 'battery log indexes', migration_005_battery_log_indexes, True),
+    (6, 'battery log rollups', migration_006_battery_rollups, True),
+    (7, 'match event index', migration_007_match_event_index, True),
+    (8, 'incremental auto_vacuum', migration_008_incremental_vacuum, False),
+    (9, 'archive blocks', migration_009_archive_blocks, True),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+schema_checked = False
+schema_lock = threading.Lock()
+
+"""Returns the highest applied migration, or 0 for a database that has never been migrated."""
+def current_schema_version(conn):
+    try:
+        return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+"""Applies pending migrations in order and returns the versions applied.
+
+Each migration runs under BEGIN IMMEDIATE, so when several workers start together the
+first one takes the write lock and the others wait, then find the version already applied."""
+def run_migrations():
+    conn = get_db_connection()
+    conn.isolation_level = None
+    applied = []
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version(
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        for version, name, migrate, transactional in MIGRATIONS:
+            if current_schema_version(conn) >= version:
+                continue
+            if not transactional:
+                migrate(conn)
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if current_schema_version(conn) >= version:
+                    conn.execute('COMMIT')
+                    continue
+                if transactional:
+                    migrate(conn)
+                conn.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            applied.append(version)
+            print("Applied migration {}: {}".format(version, name))
+    finally:
+        conn.close()
+    return applied
+
+"""Cheap startup check: migrates only when the database is behind this server's SCHEMA_VERSION."""
+def ensure_schema():
+    global schema_checked
+    if schema_checked:
+        return
+    with schema_lock:
+        if schema_checked:
+            return
+        conn = get_db_connection()
+        version = current_schema_version(conn)
+        conn.close()
+        if version < SCHEMA_VERSION:
+            run_migrations()
+        schema_checked = True
+
+"""Makes sure the schema is current before the first request a worker serves."""
+@app.before_request
+def ensure_schema_before_request():
+    ensure_schema()
+
+
+
+
+
+
+
+# ==================== WRITE QUEUE ====================
+
+"""Single writer thread that commits queued write operations in groups.
+
+An operation is a function taking a cursor plus arguments. Everything that arrives within
+the batch window shares one transaction; each operation runs inside its own savepoint, so a
+failing operation is rolled back on its own and only its caller sees the exception."""
+class WriteQueue:
+    def __init__(self, batch_window_ms=5, max_batch=64):
+        self.queue = queue.Queue()
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch = max_batch
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        # monotonic time of the last commit containing an operation not marked as background
+        self.last_write_at = 0.0
+        self.stats = {
+            'batches': 0, 'operations': 0, 'failed_operations': 0, 'failed_batches': 0,
+            'max_batch_size': 0, 'last_batch_size': 0, 'commit_ms_total': 0.0,
+            'batch_sizes': {'1': 0, '2-4': 0, '5-16': 0, '17+': 0}
+        }
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker, name='write-queue', daemon=True)
+                self.thread.start()
+
+    def submit(self, operation, *args):
+        """Queues an operation and returns a Future for its result; restarts the writer thread if it died."""
+        self.start()
+        future = Future()
+        self.queue.put((operation, args, future))
+        return future
+
+    def run(self, operation, *args, timeout=30):
+        """Queues an operation and waits for it to be committed."""
+        return self.submit(operation, *args).result(timeout)
+
+    def _worker(self):
+        conn = get_db_connection()
+        conn.isolation_level = None
+        conn.execute('PRAGMA busy_timeout = 30000')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._commit_batch(conn, batch)
+            except Exception as e:
+                print(f"Write queue error: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            if any(not getattr(operation, 'background', False) for operation, _, _ in batch):
+                self.last_write_at = time.monotonic()
+
+    def _commit_batch(self, conn, batch):
+        start = time.perf_counter()
+        outcomes = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for operation, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                cursor = conn.cursor()
+                cursor.execute('SAVEPOINT write_op')
+                try:
+                    result = operation(cursor, *args)
+                    cursor.execute('RELEASE write_op')
+                    outcomes.append((future, result, None))
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO write_op')
+                    cursor.execute('RELEASE write_op')
+                    outcomes.append((future, None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            print(f"Write batch of {len(batch)} failed: {e}")
+            try:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+            except Exception as rollback_error:
+                print(f"Write batch rollback failed: {rollback_error}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            with self.stats_lock:
+                self.stats['failed_batches'] += 1
+            return
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        self._record_batch(len(batch), sum(1 for o in outcomes if o[2] is not None), time.perf_counter() - start)
+
+    def _record_batch(self, size, failed, elapsed):
+        bucket = '1' if size == 1 else '2-4' if size <= 4 else '5-16' if size <= 16 else '17+'
+        with self.stats_lock:
+            self.stats['batches'] += 1
+            self.stats['operations'] += size
+            self.stats['failed_operations'] += failed
+            self.stats['last_batch_size'] = size
+            self.stats['max_batch_size'] = max(self.stats['max_batch_size'], size)
+            self.stats['commit_ms_total'] += elapsed * 1000
+            self.stats['batch_sizes'][bucket] += 1
+
+    def metrics(self):
+        with self.stats_lock:
+            stats = dict(self.stats, batch_sizes=dict(self.stats['batch_sizes']))
+        batches = stats['batches']
+        stats['queue_depth'] = self.queue.qsize()
+        stats['running'] = self.thread is not None and self.thread.is_alive()
+        stats['avg_batch_size'] = round(stats['operations'] / batches, 2) if batches else 0
+        stats['avg_commit_ms'] = round(stats.pop('commit_ms_total') / batches, 2) if batches else 0
+        return stats
+
+write_queue = WriteQueue(
+    batch_window_ms=float(DB_SETTINGS.get('write_batch_ms', 5)),
+    max_batch=int(DB_SETTINGS.get('write_max_batch', 64))
+)
+
+# Per-table counters bumped after every committed write; derived data is cached against them
+data_versions = {'matches': 0, 'pits': 0}
+data_versions_lock = threading.Lock()
+
+"""Marks cached data derived from the given tables as stale. Call after the write has committed."""
+def bump_data_version(*tables):
+    with data_versions_lock:
+        for table in tables:
+            data_versions[table] += 1
+    analytics_snapshot.note_write()
+
+"""Returns the current version counter of a table, or the snapshot's when the request reads one."""
+def data_version(table):
+    snapshot = request_snapshot()
+    if snapshot is not None:
+        return snapshot['versions'][table]
+    with data_versions_lock:
+        return data_versions[table]
+
+
+
+
+
+
+
+# ==================== ANALYTICS SNAPSHOT ====================
+
+"""Read-only in-memory copy of scouting.db for heavy analytics reads.
+
+The copy is taken with the sqlite3 backup API by a background thread every refresh_seconds
+(if anything was written) or as soon as refresh_writes match/pit writes have committed. Routes
+marked @analytics_read open their connections on the newest copy, so long aggregate scans never
+hold the database file while scouts submit. A copy older than the route's max age is refreshed
+before it is used. Each copy is kept alive until the last request reading it has finished."""
+
+# Server-side snapshot settings from the "analytics" block of config.json (read once at startup)
+ANALYTICS_SETTINGS = read_config().get('analytics', {})
+
+class AnalyticsSnapshot:
+    def __init__(self, settings):
+        self.enabled = bool(settings.get('enabled', False))
+        self.refresh_seconds = float(settings.get('refresh_seconds', 30))
+        self.refresh_writes = int(settings.get('refresh_writes', 25))
+        self.max_age = float(settings.get('max_age_seconds', 60))
+        self.endpoint_max_age = {name: float(age) for name, age in settings.get('endpoints', {}).items()}
+        self.refresh_lock = threading.RLock()
+        self.state_lock = threading.Lock()
+        self.current = None
+        self.generation = 0
+        self.writes = 0
+        self.wake = threading.Event()
+        self.thread = None
+        self.stats = {'refreshes': 0, 'failed_refreshes': 0, 'forced_refreshes': 0, 'reads': 0, 'last_refresh_ms': 0.0}
+
+    def start(self):
+        with self.state_lock:
+            if self.enabled and (self.thread is None or not self.thread.is_alive()):
+                self.thread = threading.Thread(target=self._worker, name='analytics-snapshot', daemon=True)
+                self.thread.start()
+
+    def _worker(self):
+        while True:
+            self.wake.wait(self.refresh_seconds)
+            self.wake.clear()
+            with self.state_lock:
+                stale = self.current is None or self.writes > 0
+            if stale:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Error refreshing analytics snapshot: {e}")
+
+    def note_write(self):
+        """Counts a committed match/pit write and wakes the refresher after refresh_writes of them."""
+        with self.state_lock:
+            self.writes += 1
+            if self.writes >= self.refresh_writes:
+                self.wake.set()
+
+    def refresh(self):
+        with self.refresh_lock:
+            start = time.perf_counter()
+            with self.state_lock:
+                writes = self.writes
+            with data_versions_lock:
+                versions = dict(data_versions)
+            self.generation += 1
+            uri = 'file:analytics-snapshot-{}?mode=memory&cache=shared'.format(self.generation)
+            holder = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            try:
+                source = sqlite3.connect(DB_PATH)
+                try:
+                    source.backup(holder)
+                finally:
+                    source.close()
+            except Exception:
+                holder.close()
+                with self.state_lock:
+                    self.stats['failed_refreshes'] += 1
+                raise
+            snapshot = {'generation': self.generation, 'uri': uri, 'holder': holder, 'versions': versions,
+                        'taken_at': time.time(), 'readers': 0, 'retired': False}
+            with self.state_lock:
+                old, self.current = self.current, snapshot
+                self.writes -= writes
+                self.stats['refreshes'] += 1
+                self.stats['last_refresh_ms'] = round((time.perf_counter() - start) * 1000, 2)
+                if old is not None:
+                    old['retired'] = True
+                    self._close_if_unused(old)
+            return snapshot
+
+    def _close_if_unused(self, snapshot):
+        if snapshot['retired'] and snapshot['readers'] == 0:
+            snapshot['holder'].close()
+
+    def acquire(self, endpoint):
+        """Pins the newest copy for one request, refreshing it first if it is older than the endpoint allows."""
+        self.start()
+        max_age = self.endpoint_max_age.get(endpoint, self.max_age)
+        with self.state_lock:
+            snapshot = self.current
+        if snapshot is None or time.time() - snapshot['taken_at'] > max_age:
+            with self.refresh_lock:
+                with self.state_lock:
+                    snapshot = self.current
+                if snapshot is None or time.time() - snapshot['taken_at'] > max_age:
+                    snapshot = self.refresh()
+                    with self.state_lock:
+                        self.stats['forced_refreshes'] += 1
+        with self.state_lock:
+            snapshot = self.current
+            snapshot['readers'] += 1
+            self.stats['reads'] += 1
+        return snapshot
+
+    def release(self, snapshot):
+        with self.state_lock:
+            snapshot['readers'] -= 1
+            self._close_if_unused(snapshot)
+
+    def metrics(self):
+        with self.state_lock:
+            stats = dict(self.stats, enabled=self.enabled, pending_writes=self.writes,
+                         refresh_seconds=self.refresh_seconds, refresh_writes=self.refresh_writes)
+            if self.current is not None:
+                stats.update(generation=self.current['generation'], versions=self.current['versions'],
+                             age_seconds=round(time.time() - self.current['taken_at'], 2), readers=self.current['readers'])
+        return stats
+
+analytics_snapshot = AnalyticsSnapshot(ANALYTICS_SETTINGS)
+
+"""Returns the snapshot the current request reads from, or None when it reads scouting.db."""
+def request_snapshot():
+    return g.get('analytics_snapshot') if has_request_context() else None
+
+"""Decorator that serves a read-only route from the analytics snapshot and reports its freshness.
+
+Put it below @login_required so tokens are still checked against the live users table. Responses
+carry X-Snapshot-Version (data versions of the copy) and X-Snapshot-Age (seconds)."""
+def analytics_read(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not analytics_snapshot.enabled:
+            return f(*args, **kwargs)
+        try:
+            snapshot = analytics_snapshot.acquire(request.endpoint)
+        except Exception as e:
+            print(f"Analytics snapshot unavailable, reading live database: {e}")
+            return f(*args, **kwargs)
+        g.analytics_snapshot = snapshot
+        response = make_response(f(*args, **kwargs))
+        response.headers['X-Snapshot-Version'] = ','.join(
+            '{}={}'.format(table, version) for table, version in sorted(snapshot['versions'].items()))
+        response.headers['X-Snapshot-Age'] = '{:.1f}'.format(time.time() - snapshot['taken_at'])
+        return response
+    return decorated_function
+
+"""Unpins the request's snapshot once the response (including a streamed body) is done."""
+@app.teardown_request
+def release_analytics_snapshot(exc):
+    snapshot = g.pop('analytics_snapshot', None)
+    if snapshot is not None:
+        analytics_snapshot.release(snapshot)
+
+
+
+
+
+
+
+# ==================== DATABASE MAINTENANCE ====================
+
+"""Background scheduler for SQLite housekeeping that runs only while no scout writes are arriving.
+
+One step runs per tick, and only after the write queue has been idle for maintenance_idle_seconds.
+Steps that write (ANALYZE, PRAGMA optimize, incremental_vacuum) go through the write queue as short
+operations, so a submission waits behind at most one of them; the WAL checkpoint is PASSIVE and
+quick_check only reads. incremental_vacuum frees at most maintenance_vacuum_pages pages per step."""
+
+# (task, seconds between runs); a task with no previous run is due immediately
+MAINTENANCE_TASKS = (
+    ('wal_checkpoint', 300),
+    ('optimize', 3600),
+    ('analyze', 86400),
+    ('quick_check', 86400)
+)
+
+class DatabaseMaintenance:
+    def __init__(self, settings):
+        self.enabled = bool(settings.get('maintenance', True))
+        self.idle_seconds = float(settings.get('maintenance_idle_seconds', 30))
+        self.vacuum_pages = int(settings.get('maintenance_vacuum_pages', 128))
+        self.tick_seconds = 5.0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.tasks = {name: {'interval': interval, 'runs': 0, 'last_run': None, 'last_ms': None,
+                             'last_result': None, 'last_error': None, 'due_at': 0.0}
+                      for name, interval in MAINTENANCE_TASKS + (('incremental_vacuum', 0),)}
+
+    def start(self):
+        if self.thread is not None or not self.enabled:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker, name='db-maintenance', daemon=True)
+                self.thread.start()
+
+    def idle(self):
+        """True when nothing is queued and no other write has committed for idle_seconds."""
+        if write_queue.queue.qsize() > 0:
+            return False
+        return time.monotonic() - write_queue.last_write_at >= self.idle_seconds
+
+    def _worker(self):
+        while True:
+            time.sleep(self.tick_seconds)
+            try:
+                if self.idle():
+                    task = self.next_task()
+                    if task is not None:
+                        self.run(task)
+            except Exception as e:
+                print(f"Database maintenance error: {e}")
+
+    def next_task(self):
+        now = time.monotonic()
+        for name, _ in MAINTENANCE_TASKS:
+            if self.tasks[name]['due_at'] <= now:
+                return name
+        if database_pages()['freelist_count'] > 0:
+            return 'incremental_vacuum'
+        return None
+
+    def run(self, name):
+        """Runs one maintenance step now and records its duration and result."""
+        task = self.tasks[name]
+        start = time.perf_counter()
+        error = None
+        result = None
+        try:
+            if name == 'wal_checkpoint':
+                result = read_pragma('PRAGMA wal_checkpoint(PASSIVE)', ('busy', 'log_pages', 'checkpointed_pages'))
+            elif name == 'quick_check':
+                conn = get_db_connection()
+                try:
+                    result = [row[0] for row in conn.execute('PRAGMA quick_check').fetchall()]
+                finally:
+                    conn.close()
+                if result != ['ok']:
+                    print(f"quick_check reported problems: {result}")
+            else:
+                result = write_queue.run(maintenance_step, name, self.vacuum_pages)
+        except Exception as e:
+            error = str(e)
+        with self.lock:
+            task['runs'] += 1
+            task['last_run'] = datetime.now().isoformat(timespec='seconds')
+            task['last_ms'] = round((time.perf_counter() - start) * 1000, 2)
+            task['last_result'] = result
+            task['last_error'] = error
+            task['due_at'] = time.monotonic() + task['interval']
+            return {key: value for key, value in task.items() if key != 'due_at'}
+
+    def report(self):
+        now = time.monotonic()
+        with self.lock:
+            tasks = {}
+            for name, task in self.tasks.items():
+                tasks[name] = {key: value for key, value in task.items() if key != 'due_at'}
+                tasks[name]['due_in_seconds'] = max(0, round(task['due_at'] - now, 1))
+        return dict(database_pages(), enabled=self.enabled, running=self.thread is not None and self.thread.is_alive(),
+                    idle=self.idle(), idle_seconds=self.idle_seconds, tasks=tasks)
+
+"""Write operation for the maintenance steps that need the write lock."""
+def maintenance_step(cursor, name, vacuum_pages):
+    if name == 'analyze':
+        cursor.execute('ANALYZE')
+        return None
+    if name == 'optimize':
+        analyzed = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+        cursor.execute('PRAGMA optimize' if analyzed else 'ANALYZE')
+        return None
+    before = cursor.execute('PRAGMA freelist_count').fetchone()[0]
+    # Each step of the statement frees one page, and sqlite3 steps a row-less statement only once
+    for _ in range(min(before, int(vacuum_pages))):
+        cursor.execute('PRAGMA incremental_vacuum(1)')
+    return {'freed_pages': before - cursor.execute('PRAGMA freelist_count').fetchone()[0]}
+
+# Maintenance commits do not count as activity when the scheduler checks for idle periods
+maintenance_step.background = True
+
+"""Runs a single-row PRAGMA on its own connection and returns it as a dict."""
+def read_pragma(sql, names):
+    conn = get_db_connection()
+    try:
+        return dict(zip(names, conn.execute(sql).fetchone()))
+    finally:
+        conn.close()
+
+"""Returns the database file's page size, page count, free pages and auto_vacuum mode."""
+def database_pages():
+    conn = get_db_connection()
+    try:
+        pages = {name: conn.execute('PRAGMA ' + name).fetchone()[0]
+                 for name in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum')}
+    finally:
+        conn.close()
+    pages['auto_vacuum'] = {0: 'none', 1: 'full', 2: 'incremental'}.get(pages['auto_vacuum'], pages['auto_vacuum'])
+    pages['wal_bytes'] = os.path.getsize(DB_PATH + '-wal') if os.path.exists(DB_PATH + '-wal') else 0
+    return pages
+
+db_maintenance = DatabaseMaintenance(DB_SETTINGS)
+
+"""Starts the maintenance thread with the first request, in the process that serves requests."""
+@app.before_request
+def start_db_maintenance():
+    db_maintenance.start()
+
+
+
+
+
+
+
+# ==================== ONLINE BACKUPS ====================
+
+"""Rotating backups of scouting.db taken with the sqlite3 backup API while the server runs.
+
+Pages are copied pages_per_step at a time with a short pause between steps, so each step holds
+only a brief WAL read transaction and writers never wait for a backup. A write that lands
+between steps makes SQLite restart the copy; after max_restarts restarts the rest is copied in
+one step (still only a read transaction). Each backup is switched to a rollback journal so it is a
+single self-contained file, checked with quick_check, optionally gzipped and written next to a
+<file>.sha256 checksum in sha256sum format. `python server.py restore <file>` verifies the checksum
+and restores it."""
+
+# Server-side backup settings from the "backup" block of config.json (read once at startup)
+BACKUP_SETTINGS = read_config().get('backup', {})
+BACKUP_DIR = os.path.join(ROOT, BACKUP_SETTINGS.get('dir', 'backups'))
+BACKUP_NAME = re.compile(r'^scouting-\d{8}-\d{6}\.db(\.gz)?$')
+
+class BackupRestarting(Exception):
+    pass
+
+"""Copies one SQLite database into another page-step by page-step; returns step and restart counts."""
+def copy_database(source_path, target_path, pages=-1, step_sleep=0.0, max_restarts=3):
+    progress = {'steps': 0, 'restarts': 0, 'remaining': None, 'single_step': pages <= 0}
+    def on_step(status, remaining, total):
+        progress['steps'] += 1
+        if progress['remaining'] is not None and remaining > progress['remaining']:
+            progress['restarts'] += 1
+            if progress['restarts'] > max_restarts:
+                raise BackupRestarting()
+        progress['remaining'] = remaining
+        progress['pages'] = total
+        if remaining and step_sleep:
+            time.sleep(step_sleep)
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        try:
+            source.backup(target, pages=pages, progress=on_step)
+        except BackupRestarting:
+            progress['single_step'] = True
+            source.backup(target)
+        target.execute('PRAGMA journal_mode=DELETE')
+        progress['quick_check'] = target.execute('PRAGMA quick_check').fetchone()[0]
+    finally:
+        target.close()
+        source.close()
+    progress.pop('remaining')
+    return progress
+
+"""Returns the hex SHA-256 of a file, read in 1 MB chunks."""
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+"""Checks a backup against its .sha256 file; raises ValueError if it is missing or does not match."""
+def verify_backup(path):
+    checksum_path = path + '.sha256'
+    if not os.path.exists(checksum_path):
+        raise ValueError('no checksum file for {}'.format(os.path.basename(path)))
+    with open(checksum_path, 'r', encoding='utf-8') as f:
+        expected = f.read().split()[0]
+    actual = file_sha256(path)
+    if actual != expected:
+        raise ValueError('checksum mismatch for {}: expected {}, got {}'.format(os.path.basename(path), expected, actual))
+    return actual
+
+class BackupManager:
+    def __init__(self, settings):
+        self.enabled = bool(settings.get('enabled', True))
+        self.interval = float(settings.get('interval_minutes', 30)) * 60
+        self.keep = max(1, int(settings.get('keep', 24)))
+        self.compress = bool(settings.get('compress', True))
+        self.pages_per_step = int(settings.get('pages_per_step', 64))
+        self.step_sleep = float(settings.get('step_sleep_ms', 10)) / 1000.0
+        self.max_restarts = int(settings.get('max_restarts', 3))
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.thread = None
+        self.last = None
+        self.stats = {'backups': 0, 'failed': 0}
+
+    def start(self):
+        if self.thread is not None or not self.enabled:
+            return
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker, name='backups', daemon=True)
+                self.thread.start()
+
+    def _worker(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.take()
+            except Exception as e:
+                print(f"Backup failed: {e}")
+
+    def take(self):
+        """Writes one backup into BACKUP_DIR, prunes old ones and returns what was written."""
+        with self.lock:
+            start = time.perf_counter()
+            os.makedirs(BACKUP_DIR, exist_ok=True)
+            name = 'scouting-{}.db'.format(datetime.now().strftime('%Y%m%d-%H%M%S'))
+            path = os.path.join(BACKUP_DIR, name)
+            partial = path + '.partial'
+            try:
+                result = copy_database(DB_PATH, partial, self.pages_per_step, self.step_sleep, self.max_restarts)
+                if result['quick_check'] != 'ok':
+                    raise ValueError('backup failed quick_check: {}'.format(result['quick_check']))
+                if self.compress:
+                    path += '.gz'
+                    with open(partial, 'rb') as source, gzip.open(path + '.partial', 'wb') as target:
+                        shutil.copyfileobj(source, target, 1024 * 1024)
+                    os.remove(partial)
+                    partial = path + '.partial'
+                os.replace(partial, path)
+            except Exception:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                self.stats['failed'] += 1
+                raise
+            digest = file_sha256(path)
+            with open(path + '.sha256', 'w', encoding='utf-8') as f:
+                f.write('{}  {}\n'.format(digest, os.path.basename(path)))
+            self.prune()
+            result.update(file=os.path.basename(path), bytes=os.path.getsize(path), sha256=digest,
+                          ms=round((time.perf_counter() - start) * 1000, 2))
+            self.stats['backups'] += 1
+            self.last = result
+            return result
+
+    def prune(self):
+        for name in [b['file'] for b in list_backups()][self.keep:]:
+            for path in (os.path.join(BACKUP_DIR, name), os.path.join(BACKUP_DIR, name + '.sha256')):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def report(self):
+        return {'enabled': self.enabled, 'directory': BACKUP_DIR, 'interval_minutes': self.interval / 60,
+                'keep': self.keep, 'compress': self.compress, 'last': self.last, 'stats': dict(self.stats),
+                'backups': list_backups()}
+
+"""Lists backups newest first with size and recorded checksum."""
+def list_backups():
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    backups = []
+    for name in sorted((n for n in os.listdir(BACKUP_DIR) if BACKUP_NAME.match(n)), reverse=True):
+        path = os.path.join(BACKUP_DIR, name)
+        checksum = None
+        if os.path.exists(path + '.sha256'):
+            with open(path + '.sha256', 'r', encoding='utf-8') as f:
+                checksum = f.read().split()[0]
+        backups.append({'file': name, 'bytes': os.path.getsize(path), 'sha256': checksum,
+                        'created_at': datetime.fromtimestamp(os.path.getmtime(path)).isoformat(timespec='seconds')})
+    return backups
+
+"""Replaces scouting.db with a verified backup. Run it with the server stopped.
+
+The current database is first saved as scouting.db.before-restore-<time>. The backup's checksum and
+quick_check must pass, and pages are copied with the backup API so the WAL is handled by SQLite."""
+def restore_backup(path):
+    verify_backup(path)
+    restored = DB_PATH + '.restore'
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as source, open(restored, 'wb') as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+    else:
+        shutil.copyfile(path, restored)
+    try:
+        conn = sqlite3.connect(restored)
+        try:
+            check = conn.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            conn.close()
+        if check != 'ok':
+            raise ValueError('backup failed quick_check: {}'.format(check))
+        previous = None
+        if os.path.exists(DB_PATH):
+            previous = DB_PATH + '.before-restore-' + datetime.now().strftime('%Y%m%d-%H%M%S')
+            copy_database(DB_PATH, previous)
+        copy_database(restored, DB_PATH)
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+        finally:
+            conn.close()
+    finally:
+        os.remove(restored)
+    return previous
+
+backups = BackupManager(BACKUP_SETTINGS)
+
+"""Starts the periodic backup thread with the first request, in the process that serves requests."""
+@app.before_request
+def start_backups():
+    backups.start()
+
+
+
+
+
+
+
+# ==================== ADMISSION CONTROL ====================
+
+"""Per-route priority classes, concurrency limits and per-client token buckets.
+
+Every /api request is put in a class. "critical" (match, pit, checklist, battery and login
+writes) is never limited. The other classes get a concurrency cap with a short bounded wait
+queue, and signed-in clients also get a per-token token bucket; requests over either limit get
+429 with Retry-After. Anonymous requests have no bucket: behind the tunnel they all arrive from
+the same address, so a shared bucket would throttle a whole event as one client."""
+
+# Server-side admission settings from the "admission" block of config.json (read once at startup)
+ADMISSION_SETTINGS = read_config().get('admission', {})
+
+ADMISSION_DEFAULTS = {
+    'interactive': {'concurrency': 32, 'rate': 50, 'burst': 200, 'max_queue': 256, 'max_wait_ms': 5000},
+    'heavy': {'concurrency': 4, 'rate': 5, 'burst': 60, 'max_queue': 128, 'max_wait_ms': 15000},
+    'debug': {'concurrency': 1, 'rate': 2, 'burst': 5, 'max_queue': 2, 'max_wait_ms': 1000}
+}
+
+# Expensive endpoints by URL rule; other /api/debug/* rules are "debug", other writes "critical"
+ADMISSION_ROUTES = {
+    '/api/rankings': 'heavy',
+    '/api/rankings/all': 'heavy',
+    '/api/team/<team>/distribution': 'heavy',
+    '/api/teams/distribution': 'heavy',
+    '/api/teams/trends': 'heavy',
+    '/api/simulate': 'heavy',
+    '/api/projections/standings': 'heavy',
+    '/api/picklist': 'heavy',
+    '/api/query': 'heavy',
+    '/api/battery-trends': 'heavy',
+    '/api/export/matches.csv': 'heavy',
+    '/api/export/pits.csv': 'heavy',
+    '/api/upload/csv': 'heavy',
+    '/api/matches/reindex': 'heavy',
+    '/api/ratings/rebuild': 'heavy'
+}
+
+class AdmissionController:
+    def __init__(self, settings):
+        self.enabled = bool(settings.get('enabled', False))
+        self.max_clients = int(settings.get('max_clients', 10000))
+        configured = settings.get('classes', {})
+        self.classes = {}
+        for name, defaults in ADMISSION_DEFAULTS.items():
+            limits = dict(defaults, **configured.get(name, {}))
+            self.classes[name] = {
+                'concurrency': int(limits['concurrency']),
+                'rate': float(limits['rate']),
+                'burst': float(limits['burst']),
+                'max_queue': int(limits['max_queue']),
+                'max_wait': float(limits['max_wait_ms']) / 1000.0,
+                'condition': threading.Condition(),
+                'in_flight': 0,
+                'waiting': 0,
+                'stats': {'admitted': 0, 'queued': 0, 'rate_limited': 0, 'queue_full': 0, 'timed_out': 0,
+                          'max_in_flight': 0, 'max_waiting': 0, 'wait_ms_total': 0.0}
+            }
+        self.critical = {'admitted': 0, 'in_flight': 0}
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+
+    def classify(self, rule, method):
+        if rule in ADMISSION_ROUTES:
+            return ADMISSION_ROUTES[rule]
+        if rule.startswith('/api/debug/'):
+            return 'debug'
+        if method in ('POST', 'PUT', 'DELETE'):
+            return 'critical'
+        return 'interactive'
+
+    def take_token(self, client, name):
+        """Spends one token from the client's bucket for a class; returns seconds to wait if it is empty."""
+        limits = self.classes[name]
+        now = time.monotonic()
+        with self.buckets_lock:
+            tokens, stamp = self.buckets.get((client, name), (limits['burst'], now))
+            tokens = min(limits['burst'], tokens + (now - stamp) * limits['rate'])
+            if tokens < 1:
+                self.buckets[(client, name)] = (tokens, now)
+                return (1 - tokens) / limits['rate'] if limits['rate'] > 0 else 60
+            self.buckets[(client, name)] = (tokens - 1, now)
+            if len(self.buckets) > self.max_clients:
+                self.prune(now)
+        return None
+
+    def prune(self, now):
+        """Drops buckets that have refilled completely; they behave the same as a new bucket."""
+        for key, (tokens, stamp) in list(self.buckets.items()):
+            limits = self.classes[key[1]]
+            if tokens + (now - stamp) * limits['rate'] >= limits['burst']:
+                del self.buckets[key]
+
+    def acquire(self, name):
+        """Takes a concurrency slot, waiting up to max_wait; returns the rejection reason or None."""
+        limits = self.classes[name]
+        stats = limits['stats']
+        with limits['condition']:
+            if limits['in_flight'] >= limits['concurrency']:
+                if limits['waiting'] >= limits['max_queue']:
+                    stats['queue_full'] += 1
+                    return 'queue_full'
+                limits['waiting'] += 1
+                stats['queued'] += 1
+                stats['max_waiting'] = max(stats['max_waiting'], limits['waiting'])
+                start = time.monotonic()
+                deadline = start + limits['max_wait']
+                try:
+                    while limits['in_flight'] >= limits['concurrency']:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            stats['timed_out'] += 1
+                            return 'timed_out'
+                        limits['condition'].wait(remaining)
+                finally:
+                    limits['waiting'] -= 1
+                    stats['wait_ms_total'] += (time.monotonic() - start) * 1000
+            limits['in_flight'] += 1
+            stats['admitted'] += 1
+            stats['max_in_flight'] = max(stats['max_in_flight'], limits['in_flight'])
+        return None
+
+    def release(self, name):
+        if name == 'critical':
+            with self.buckets_lock:
+                self.critical['in_flight'] -= 1
+            return
+        limits = self.classes[name]
+        with limits['condition']:
+            limits['in_flight'] -= 1
+            limits['condition'].notify()
+
+    def admit(self, client, name):
+        """Returns None if the request may run (release() it afterwards), else (reason, retry_after_seconds).
+
+        client is the caller's auth token; None (anonymous) skips the token bucket."""
+        if name == 'critical':
+            with self.buckets_lock:
+                self.critical['admitted'] += 1
+                self.critical['in_flight'] += 1
+            return None
+        wait = self.take_token(client, name) if client is not None else None
+        if wait is not None:
+            with self.classes[name]['condition']:
+                self.classes[name]['stats']['rate_limited'] += 1
+            return 'rate_limited', wait
+        reason = self.acquire(name)
+        if reason is not None:
+            return reason, max(1.0, self.classes[name]['max_wait'])
+        return None
+
+    def metrics(self):
+        classes = {}
+        for name, limits in self.classes.items():
+            with limits['condition']:
+                stats = dict(limits['stats'])
+                stats.update({key: limits[key] for key in ('concurrency', 'rate', 'burst', 'max_queue', 'in_flight', 'waiting')})
+            stats['max_wait_ms'] = limits['max_wait'] * 1000
+            wait_ms_total = stats.pop('wait_ms_total')
+            stats['avg_wait_ms'] = round(wait_ms_total / stats['queued'], 2) if stats['queued'] else 0
+            classes[name] = stats
+        with self.buckets_lock:
+            critical = dict(self.critical)
+            clients = len(self.buckets)
+        return {'enabled': self.enabled, 'critical': critical, 'classes': classes, 'tracked_buckets': clients}
+
+admission = AdmissionController(ADMISSION_SETTINGS)
+
+"""Applies admission control to /api requests; only signed-in clients (by auth token) have token buckets."""
+@app.before_request
+def admit_request():
+    if not admission.enabled or request.url_rule is None or not request.url_rule.rule.startswith('/api/'):
+        return None
+    name = admission.classify(request.url_rule.rule, request.method)
+    client = request.headers.get('Authorization') or None
+    rejected = admission.admit(client, name)
+    if rejected is not None:
+        reason, retry_after = rejected
+        response = jsonify({'error': 'busy', 'details': f'{name} requests {reason.replace("_", " ")}'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return response
+    g.admission_class = name
+    return None
+
+"""Frees the request's concurrency slot once the response (including a streamed body) is done."""
+@app.teardown_request
+def release_request(exc):
+    name = g.pop('admission_class', None)
+    if name is not None:
+        admission.release(name)
 
 
 
@@ -259,68 +1553,16 @@ def create_battery():
             now = datetime.now()
             time_scanned = f"{now.month}/{now.day}/{now.year}; {now.hour}:{now.minute:02d}:{now.second:02d}"
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Check if battery already exists
-        cursor.execute('SELECT id FROM batteries WHERE id = ?', (battery_id,))
-        existing = cursor.fetchone()
-        
-        if existing:
-            # Battery exists - update it instead
-            conn.close()
-            return update_existing_battery(battery_id, data, time_scanned)
-        
-        # Determine usage count - increment if status is "In Use"
-        usage_count = 1 if data['status'] == 'In Use' else 0
-        
         # Convert all numeric values to float safely
         try:
-            charge = float(data['charge'])
-            v0 = float(data['v0'])
-            v1 = float(data['v1'])
-            v2 = float(data['v2'])
-            rint = float(data['rint'])
+            readings = [float(data[field]) for field in ('charge', 'v0', 'v1', 'v2', 'rint')]
         except (ValueError, TypeError) as e:
             return jsonify({'error': f'Invalid numeric value: {str(e)}'}), 400
+        data['event_code'] = battery_event_code(data)
         
-        # Insert battery with proper field mapping
-        cursor.execute('''
-            INSERT INTO batteries (id, time_scanned, usage_count, beakStatus, charge, v0, v1, v2, rint, status, year_bought)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            battery_id, 
-            time_scanned,
-            usage_count, 
-            data['beakStatus'], 
-            charge, 
-            v0, 
-            v1, 
-            v2, 
-            rint, 
-            data['status'],
-            data.get('year_bought', 'N/A')
-        ))
-
-        # Create log entry
-        cursor.execute('''
-            INSERT INTO battery_logs (battery_id, time_scanned, status, charge, beakStatus, v0, v1, v2, rint, year_bought)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            battery_id, 
-            time_scanned,
-            data['status'], 
-            charge, 
-            data['beakStatus'], 
-            v0, 
-            v1, 
-            v2, 
-            rint,
-            data.get('year_bought', 'N/A')
-        ))
-        
-        conn.commit()
-        conn.close()
+        if not write_queue.run(insert_battery, battery_id, time_scanned, data, readings):
+            # Battery exists - update it instead
+            return update_existing_battery(battery_id, data, time_scanned)
         
         print(f"Battery {battery_id} created successfully")  # Debug log
         return jsonify({'message': 'Battery created successfully', 'id': battery_id})
@@ -332,259 +1574,250 @@ def create_battery():
         print(f"Error creating battery: {e}")  # Debug log
         return jsonify({'error': 'Failed to create battery', 'details': str(e)}), 500
 
+def insert_battery(cursor, battery_id, time_scanned, data, readings):
+    """Write operation for create_battery; returns False when the battery already exists"""
+    cursor.execute('SELECT id FROM batteries WHERE id = ?', (battery_id,))
+    if cursor.fetchone():
+        return False
+    
+    # Determine usage count - increment if status is "In Use"
+    usage_count = 1 if data['status'] == 'In Use' else 0
+    charge, v0, v1, v2, rint = readings
+    
+    # Insert battery with proper field mapping
+    cursor.execute('''
+        INSERT INTO batteries (id, time_scanned, usage_count, beakStatus, charge, v0, v1, v2, rint, status, year_bought)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        battery_id, 
+        time_scanned,
+        usage_count, 
+        data['beakStatus'], 
+        charge, 
+        v0, 
+        v1, 
+        v2, 
+        rint, 
+        data['status'],
+        data.get('year_bought', 'N/A')
+    ))
+
+    # Create log entry
+    cursor.execute('''
+        INSERT INTO battery_logs (battery_id, time_scanned, status, charge, beakStatus, v0, v1, v2, rint, year_bought, event_code)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        battery_id, 
+        time_scanned,
+        data['status'], 
+        charge, 
+        data['beakStatus'], 
+        v0, 
+        v1, 
+        v2, 
+        rint,
+        data.get('year_bought', 'N/A'),
+        data.get('event_code')
+    ))
+    return True
+
 def update_existing_battery(battery_id, data, time_scanned):
     """Helper function to update an existing battery"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get current battery data
-        cursor.execute('SELECT * FROM batteries WHERE id = ?', (battery_id,))
-        existing_battery = cursor.fetchone()
-        
-        if not existing_battery:
-            conn.close()
+        if not write_queue.run(apply_battery_scan, battery_id, data, time_scanned):
             return jsonify({'error': 'Battery not found'}), 404
         
-        # Determine usage count - increment if status is changing to "In Use"
-        usage_count = existing_battery['usage_count']
-        new_status = data.get('status', existing_battery['status'])
-        
-        # Increment usage count if changing to "In Use" from any other status
-        if existing_battery['status'] != 'In Use' and new_status == 'In Use':
-            usage_count += 1
-        
-        # Get year_bought with proper fallback logic
-        year_bought = data.get('year_bought')  # Try to get from incoming data first
-        if year_bought is None:  # If not provided, use existing value
-            year_bought = existing_battery.get('year_bought', 'N/A')
-        
-        # Convert numeric values safely
-        try:
-            charge = float(data.get('charge', existing_battery['charge']))
-            v0 = float(data.get('v0', existing_battery['v0']))
-            v1 = float(data.get('v1', existing_battery['v1']))
-            v2 = float(data.get('v2', existing_battery['v2']))
-            rint = float(data.get('rint', existing_battery['rint']))
-        except (ValueError, TypeError) as e:
-            return jsonify({'error': f'Invalid numeric value: {str(e)}'}), 400
-        
-        # Update battery with new data including year_bought
-        cursor.execute('''
-            UPDATE batteries 
-            SET time_scanned = ?, usage_count = ?, beakStatus = ?, charge = ?, 
-                v0 = ?, v1 = ?, v2 = ?, rint = ?, status = ?, year_bought = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (
-            time_scanned,
-            usage_count,
-            data.get('beakStatus', existing_battery['beakStatus']),
-            charge,
-            v0,
-            v1,
-            v2,
-            rint,
-            new_status,
-            year_bought,
-            battery_id
-        ))
-        
-        # Create log entry for the update with year_bought
-        cursor.execute('''
-            INSERT INTO battery_logs (battery_id, time_scanned, status, charge, beakStatus, v0, v1, v2, rint, year_bought)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            battery_id,
-            time_scanned,
-            new_status,
-            charge,
-            data.get('beakStatus', existing_battery['beakStatus']),
-            v0,
-            v1,
-            v2,
-            rint,
-            year_bought
-        ))
-        
-        conn.commit()
-        conn.close()
-        
         return jsonify({'message': 'Battery updated successfully', 'id': battery_id})
         
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': f'Invalid numeric value: {str(e)}'}), 400
     except Exception as e:
         print(f"Error updating battery: {e}")
         return jsonify({'error': 'Failed to update battery', 'details': str(e)}), 500
 
+def apply_battery_scan(cursor, battery_id, data, time_scanned):
+    """Write operation for update_existing_battery; returns False when the battery is missing"""
+    # Get current battery data
+    cursor.execute('SELECT * FROM batteries WHERE id = ?', (battery_id,))
+    row = cursor.fetchone()
+    if not row:
+        return False
+    existing_battery = dict(row)
+    
+    # Determine usage count - increment if status is changing to "In Use"
+    usage_count = existing_battery['usage_count']
+    new_status = data.get('status', existing_battery['status'])
+    
+    # Increment usage count if changing to "In Use" from any other status
+    if existing_battery['status'] != 'In Use' and new_status == 'In Use':
+        usage_count += 1
+    
+    # Get year_bought with proper fallback logic
+    year_bought = data.get('year_bought')  # Try to get from incoming data first
+    if year_bought is None:  # If not provided, use existing value
+        year_bought = existing_battery.get('year_bought', 'N/A')
+    
+    # Convert numeric values safely (ValueError/TypeError reach the caller as a 400)
+    charge = float(data.get('charge', existing_battery['charge']))
+    v0 = float(data.get('v0', existing_battery['v0']))
+    v1 = float(data.get('v1', existing_battery['v1']))
+    v2 = float(data.get('v2', existing_battery['v2']))
+    rint = float(data.get('rint', existing_battery['rint']))
+    
+    # Update battery with new data including year_bought
+    cursor.execute('''
+        UPDATE batteries 
+        SET time_scanned = ?, usage_count = ?, beakStatus = ?, charge = ?, 
+            v0 = ?, v1 = ?, v2 = ?, rint = ?, status = ?, year_bought = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', (
+        time_scanned,
+        usage_count,
+        data.get('beakStatus', existing_battery['beakStatus']),
+        charge,
+        v0,
+        v1,
+        v2,
+        rint,
+        new_status,
+        year_bought,
+        battery_id
+    ))
+    
+    # Create log entry for the update with year_bought
+    cursor.execute('''
+        INSERT INTO battery_logs (battery_id, time_scanned, status, charge, beakStatus, v0, v1, v2, rint, year_bought, event_code)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        battery_id,
+        time_scanned,
+        new_status,
+        charge,
+        data.get('beakStatus', existing_battery['beakStatus']),
+        v0,
+        v1,
+        v2,
+        rint,
+        year_bought,
+        data.get('event_code')
+    ))
+    return True
+
 @app.route('/api/batteries/<battery_id>', methods=['PUT'])
 @login_required()
 def update_battery(battery_id):
     """Update an existing battery"""
     try:
         data = request.get_json()
+        data['event_code'] = battery_event_code(data)
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get current battery data
-        cursor.execute('SELECT * FROM batteries WHERE id = ?', (battery_id,))
-        existing_battery = cursor.fetchone()
-        
-        if not existing_battery:
-            conn.close()
+        if not write_queue.run(apply_battery_update, battery_id, data):
             return jsonify({'error': 'Battery not found'}), 404
         
-        # Determine usage count - increment if status is changing to "In Use"
-        usage_count = existing_battery['usage_count']
-        new_status = data.get('status', existing_battery['status'])
-        
-        # Increment usage count if changing to "In Use" from any other status
-        if existing_battery['status'] != 'In Use' and new_status == 'In Use':
-            usage_count += 1
-        
-        time_scanned = data.get('timeScanned') or data.get('time_scanned', existing_battery['time_scanned'])
-        
-        # Get year_bought with default value
-        # Get year_bought with proper fallback logic
-        year_bought = data.get('year_bought')  # Try to get from incoming data first
-        if year_bought is None:  # If not provided, use existing value
-            year_bought = existing_battery.get('year_bought', 'N/A')
-        
-        # Update battery including year_bought
-        cursor.execute('''
-            UPDATE batteries 
-            SET time_scanned = ?, usage_count = ?, beakStatus = ?, charge = ?, 
-                v0 = ?, v1 = ?, v2 = ?, rint = ?, status = ?, year_bought = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (
-            time_scanned,
-            usage_count,
-            data.get('beakStatus', existing_battery['beakStatus']),
-            float(data.get('charge', existing_battery['charge'])),
-            float(data.get('v0', existing_battery['v0'])),
-            float(data.get('v1', existing_battery['v1'])),
-            float(data.get('v2', existing_battery['v2'])),
-            float(data.get('rint', existing_battery['rint'])),
-            new_status,
-            year_bought,  # Add this
-            battery_id
-        ))
-        
-        # Create log entry for significant changes with year_bought
-        cursor.execute('''
-            INSERT INTO battery_logs (battery_id, time_scanned, status, charge, beakStatus, v0, v1, v2, rint, year_bought)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            battery_id,
-            data.get('timeScanned', existing_battery['time_scanned']),
-            new_status,
-            float(data.get('charge', existing_battery['charge'])),
-            data.get('beakStatus', existing_battery['beakStatus']),
-            float(data.get('v0', existing_battery['v0'])),
-            float(data.get('v1', existing_battery['v1'])),
-            float(data.get('v2', existing_battery['v2'])),
-            float(data.get('rint', existing_battery['rint'])),
-            year_bought  # Add this
-        ))
-        
-        conn.commit()
-        conn.close()
-        
         return jsonify({'message': 'Battery updated successfully'})
     except Exception as e:
         return jsonify({'error': 'Failed to update battery', 'details': str(e)}), 500
 
+def apply_battery_update(cursor, battery_id, data):
+    """Write operation for update_battery; returns False when the battery is missing"""
+    # Get current battery data
+    cursor.execute('SELECT * FROM batteries WHERE id = ?', (battery_id,))
+    row = cursor.fetchone()
+    if not row:
+        return False
+    existing_battery = dict(row)
+    
+    # Determine usage count - increment if status is changing to "In Use"
+    usage_count = existing_battery['usage_count']
+    new_status = data.get('status', existing_battery['status'])
+    
+    # Increment usage count if changing to "In Use" from any other status
+    if existing_battery['status'] != 'In Use' and new_status == 'In Use':
+        usage_count += 1
+    
+    time_scanned = data.get('timeScanned') or data.get('time_scanned', existing_battery['time_scanned'])
+    
+    # Get year_bought with proper fallback logic
+    year_bought = data.get('year_bought')  # Try to get from incoming data first
+    if year_bought is None:  # If not provided, use existing value
+        year_bought = existing_battery.get('year_bought', 'N/A')
+    
+    # Update battery including year_bought
+    cursor.execute('''
+        UPDATE batteries 
+        SET time_scanned = ?, usage_count = ?, beakStatus = ?, charge = ?, 
+            v0 = ?, v1 = ?, v2 = ?, rint = ?, status = ?, year_bought = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', (
+        time_scanned,
+        usage_count,
+        data.get('beakStatus', existing_battery['beakStatus']),
+        float(data.get('charge', existing_battery['charge'])),
+        float(data.get('v0', existing_battery['v0'])),
+        float(data.get('v1', existing_battery['v1'])),
+        float(data.get('v2', existing_battery['v2'])),
+        float(data.get('rint', existing_battery['rint'])),
+        new_status,
+        year_bought,
+        battery_id
+    ))
+    
+    # Create log entry for significant changes with year_bought
+    cursor.execute('''
+        INSERT INTO battery_logs (battery_id, time_scanned, status, charge, beakStatus, v0, v1, v2, rint, year_bought, event_code)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        battery_id,
+        data.get('timeScanned', existing_battery['time_scanned']),
+        new_status,
+        float(data.get('charge', existing_battery['charge'])),
+        data.get('beakStatus', existing_battery['beakStatus']),
+        float(data.get('v0', existing_battery['v0'])),
+        float(data.get('v1', existing_battery['v1'])),
+        float(data.get('v2', existing_battery['v2'])),
+        float(data.get('rint', existing_battery['rint'])),
+        year_bought,
+        data.get('event_code')
+    ))
+    return True
+
 @app.route('/api/batteries/<battery_id>', methods=['DELETE'])
 @login_required(role="admin")
 def delete_battery(battery_id):
     """Delete a battery and its logs"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Delete logs first
-        cursor.execute('DELETE FROM battery_logs WHERE battery_id = ?', (battery_id,))
-        # Delete battery
-        cursor.execute('DELETE FROM batteries WHERE id = ?', (battery_id,))
-        
-        conn.commit()
-        conn.close()
+        write_queue.run(remove_battery, battery_id)
         
         return jsonify({'message': 'Battery deleted successfully'})
     except Exception as e:
         return jsonify({'error': 'Failed to delete battery', 'details': str(e)}), 500
 
+def remove_battery(cursor, battery_id):
+    """Write operation for delete_battery"""
+    # Delete logs first
+    cursor.execute('DELETE FROM battery_logs WHERE battery_id = ?', (battery_id,))
+    # Delete battery
+    cursor.execute('DELETE FROM batteries WHERE id = ?', (battery_id,))
+
+BATTERY_STATUS_ORDER = [
+    "Charging",
+    "Cooldown to Robot", 
+    "Ready for Robot",
+    "In Use",
+    "Cooldown to Charge",
+    "Ready for Charging"
+]
+
 @app.route('/api/batteries/<battery_id>/advance-status', methods=['POST'])
 @login_required()
 def advance_battery_status(battery_id):
     """Advance battery to next status in the cycle"""
     try:
-        status_order = [
-            "Charging",
-            "Cooldown to Robot", 
-            "Ready for Robot",
-            "In Use",
-            "Cooldown to Charge",
-            "Ready for Charging"
-        ]
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get current battery data
-        cursor.execute('SELECT * FROM batteries WHERE id = ?', (battery_id,))
-        battery = cursor.fetchone()
-        
-        if not battery:
-            conn.close()
+        event_code = battery_event_code(request.get_json(silent=True) or {})
+        advanced = write_queue.run(advance_battery, battery_id, event_code)
+        if not advanced:
             return jsonify({'error': 'Battery not found'}), 404
-        
-        # Convert battery row to dict for safe access
-        battery_dict = dict(battery)
-        
-        # Determine next status
-        current_status = battery_dict['status']
-        if current_status not in status_order:
-            current_status = "Charging"  # Default to start
-        
-        current_status_index = status_order.index(current_status)
-        next_status_index = (current_status_index + 1) % len(status_order)
-        next_status = status_order[next_status_index]
-        
-        # Update usage count if advancing to "In Use"
-        usage_count = battery_dict['usage_count']
-        if next_status == "In Use" and current_status != "In Use":
-            usage_count += 1
-        
-        # Update timestamp
-        now = datetime.now()
-        time_scanned = f"{now.month}/{now.day}/{now.year}; {now.hour}:{now.minute:02d}:{now.second:02d}"
-        
-        # Update battery
-        cursor.execute('''
-            UPDATE batteries 
-            SET time_scanned = ?, usage_count = ?, status = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (time_scanned, usage_count, next_status, battery_id))
-        
-        # Create log entry - FIXED: Use battery_dict for safe access
-        cursor.execute('''
-            INSERT INTO battery_logs (battery_id, time_scanned, status, charge, beakStatus, v0, v1, v2, rint, year_bought)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            battery_id, 
-            time_scanned, 
-            next_status, 
-            battery_dict['charge'], 
-            battery_dict['beakStatus'], 
-            battery_dict['v0'], 
-            battery_dict['v1'], 
-            battery_dict['v2'], 
-            battery_dict['rint'],
-            battery_dict.get('year_bought', 'N/A')  # Safe access with get()
-        ))
-        
-        conn.commit()
-        conn.close()
+        next_status, time_scanned = advanced
         
         return jsonify({
             'message': f'Battery status advanced to {next_status}',
@@ -594,46 +1827,275 @@ def advance_battery_status(battery_id):
     except Exception as e:
         print(f"Error advancing battery status: {e}")
         return jsonify({'error': 'Failed to advance battery status', 'details': str(e)}), 500
+
+def advance_battery(cursor, battery_id, event_code=None):
+    """Write operation for advance_battery_status; returns (next_status, time_scanned) or None"""
+    # Get current battery data
+    cursor.execute('SELECT * FROM batteries WHERE id = ?', (battery_id,))
+    battery = cursor.fetchone()
+    if not battery:
+        return None
+    
+    # Convert battery row to dict for safe access
+    battery_dict = dict(battery)
+    
+    # Determine next status
+    current_status = battery_dict['status']
+    if current_status not in BATTERY_STATUS_ORDER:
+        current_status = "Charging"  # Default to start
+    
+    current_status_index = BATTERY_STATUS_ORDER.index(current_status)
+    next_status_index = (current_status_index + 1) % len(BATTERY_STATUS_ORDER)
+    next_status = BATTERY_STATUS_ORDER[next_status_index]
+    
+    # Update usage count if advancing to "In Use"
+    usage_count = battery_dict['usage_count']
+    if next_status == "In Use" and current_status != "In Use":
+        usage_count += 1
+    
+    # Update timestamp
+    now = datetime.now()
+    time_scanned = f"{now.month}/{now.day}/{now.year}; {now.hour}:{now.minute:02d}:{now.second:02d}"
+    
+    # Update battery
+    cursor.execute('''
+        UPDATE batteries 
+        SET time_scanned = ?, usage_count = ?, status = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', (time_scanned, usage_count, next_status, battery_id))
+    
+    # Create log entry - FIXED: Use battery_dict for safe access
+    cursor.execute('''
+        INSERT INTO battery_logs (battery_id, time_scanned, status, charge, beakStatus, v0, v1, v2, rint, year_bought, event_code)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        battery_id, 
+        time_scanned, 
+        next_status, 
+        battery_dict['charge'], 
+        battery_dict['beakStatus'], 
+        battery_dict['v0'], 
+        battery_dict['v1'], 
+        battery_dict['v2'], 
+        battery_dict['rint'],
+        battery_dict.get('year_bought', 'N/A'),  # Safe access with get()
+        event_code
+    ))
+    return next_status, time_scanned
     
 @app.route('/api/battery-logs', methods=['GET'])
 @login_required()
 def get_battery_logs():
-    """Retrieve battery logs"""
+    """Retrieve battery logs, newest first.
+
+    Query parameters (all optional; with none, every log is returned):
+      battery_id   only this battery's logs
+      since/until  created_at window, since inclusive and until exclusive ('YYYY-MM-DD[ HH:MM:SS]')
+      limit        page size; when more rows remain, X-Next-Cursor holds the cursor for the next page
+      cursor       continue after the page that returned it
+      latest       the newest N logs of each battery instead of one list
+    """
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        
+        battery_id = request.args.get('battery_id')
+        where, params = [], []
+        if request.args.get('since'):
+            where.append('created_at >= ?')
+            params.append(request.args['since'])
+        if request.args.get('until'):
+            where.append('created_at < ?')
+            params.append(request.args['until'])
+
+        try:
+            limit = int(request.args.get('limit', -1))
+            latest = int(request.args.get('latest') or 1)
+        except ValueError:
+            conn.close()
+            return jsonify({'error': 'limit and latest must be whole numbers'}), 400
+        if 'limit' in request.args and limit < 1:
+            conn.close()
+            return jsonify({'error': 'limit must be at least 1'}), 400
+        if request.args.get('cursor'):
+            created_at, separator, log_id = request.args['cursor'].rpartition('|')
+            try:
+                log_id = int(log_id)
+            except ValueError:
+                separator = ''
+            if not separator:
+                conn.close()
+                return jsonify({'error': 'invalid cursor'}), 400
+
+        if request.args.get('latest'):
+            latest = max(1, latest)
+            logs_list = []
+            for log_battery_id in ([battery_id] if battery_id else battery_log_ids(cursor)):
+                cursor.execute('''
+                    SELECT * FROM battery_logs WHERE {}
+                    ORDER BY created_at DESC, id DESC LIMIT ?
+                '''.format(' AND '.join(['battery_id = ?'] + where)), [log_battery_id] + params + [latest])
+                logs_list.extend(dict(log) for log in cursor.fetchall())
+            conn.close()
+            return jsonify(logs_list)
+
+        if battery_id:
+            where.append('battery_id = ?')
+            params.append(battery_id)
+        if request.args.get('cursor'):
+            where.append('(created_at, id) < (?, ?)')
+            params.extend([created_at, log_id])
         cursor.execute('''
-            SELECT * FROM battery_logs 
-            ORDER BY created_at DESC
-        ''')
+            SELECT * FROM battery_logs {}
+            ORDER BY created_at DESC, id DESC LIMIT ?
+        '''.format('WHERE ' + ' AND '.join(where) if where else ''), params + [limit + 1 if limit >= 0 else -1])
         logs = cursor.fetchall()
         conn.close()
         
+        headers = {}
+        if limit >= 0 and len(logs) > limit:
+            logs = logs[:limit]
+            headers['X-Next-Cursor'] = '{}|{}'.format(logs[-1]['created_at'], logs[-1]['id'])
         logs_list = []
         for log in logs:
             log_dict = dict(log)
             logs_list.append(log_dict)
             
-        return jsonify(logs_list)
+        return jsonify(logs_list), 200, headers
     except Exception as e:
         return jsonify({'error': 'Failed to fetch battery logs', 'details': str(e)}), 500
 
+def battery_log_ids(cursor):
+    """Distinct battery IDs in battery_logs, found with one index seek per battery"""
+    cursor.execute('''
+        WITH RECURSIVE ids(battery_id) AS (
+            SELECT MIN(battery_id) FROM battery_logs
+            UNION ALL
+            SELECT (SELECT MIN(battery_id) FROM battery_logs WHERE battery_id > ids.battery_id)
+            FROM ids WHERE ids.battery_id IS NOT NULL
+        )
+        SELECT battery_id FROM ids WHERE battery_id IS NOT NULL
+    ''')
+    return [row[0] for row in cursor.fetchall()]
+
+def battery_event_code(data):
+    """Event a battery log belongs to: the request's event_code, else config.json current_event"""
+    return data.get('event_code') or read_config().get('current_event') or None
+
+@app.route('/api/battery-rollups', methods=['GET'])
+@login_required()
+def get_battery_rollups():
+    """Daily (kind=day) or per-event (kind=event) battery aggregates, optionally for one battery_id"""
+    try:
+        kind = request.args.get('kind', 'day')
+        if kind not in ('day', 'event'):
+            return jsonify({'error': 'kind must be day or event'}), 400
+        where, params = ['bucket_kind = ?'], [kind]
+        if request.args.get('battery_id'):
+            where.append('battery_id = ?')
+            params.append(request.args['battery_id'])
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM battery_rollups WHERE {} ORDER BY battery_id, first_scan
+        '''.format(' AND '.join(where)), params)
+        rollups = []
+        for row in cursor.fetchall():
+            rollup = dict(row)
+            scans = rollup['scans']
+            rollup['charge_mean'] = rollup.pop('charge_sum') / scans
+            rollup['v0_mean'] = rollup.pop('v0_sum') / scans
+            rollup['v2_mean'] = rollup.pop('v2_sum') / scans
+            rollup['sag_mean'] = rollup.pop('sag_sum') / scans
+            rollup['rint_mean'] = rollup.pop('rint_sum') / scans
+            rollups.append(rollup)
+        conn.close()
+        return jsonify(rollups)
+    except Exception as e:
+        return jsonify({'error': 'Failed to fetch battery rollups', 'details': str(e)}), 500
+
+@app.route('/api/battery-trends', methods=['GET'])
+@login_required()
+def get_battery_trends():
+    """Flags batteries whose internal resistance is rising or whose voltage sag is worsening.
+
+    Fits a least-squares line to each battery's daily mean rint and sag (v0 - v2) from
+    battery_rollups, all batteries at once. A battery is flagged when the fitted change over 30 days
+    is at least rint_pct / sag_pct percent (default 10) of its mean, over at least min_days days (3).
+    """
+    try:
+        try:
+            rint_pct = float(request.args.get('rint_pct', 10))
+            sag_pct = float(request.args.get('sag_pct', 10))
+            min_days = max(2, int(request.args.get('min_days', 3)))
+        except ValueError:
+            return jsonify({'error': 'rint_pct and sag_pct must be numbers and min_days a whole number'}), 400
+        if not (math.isfinite(rint_pct) and math.isfinite(sag_pct)):
+            return jsonify({'error': 'rint_pct and sag_pct must be finite'}), 400
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT battery_id, julianday(bucket) AS day, rint_sum / scans AS rint, sag_sum / scans AS sag
+            FROM battery_rollups WHERE bucket_kind = 'day'
+        ''')
+        rows = cursor.fetchall()
+        conn.close()
+        if not rows:
+            return jsonify([])
+
+        battery_ids, index = np.unique([row['battery_id'] for row in rows], return_inverse=True)
+        index = index.reshape(-1)
+        day = np.array([row['day'] for row in rows], dtype=float)
+        day -= day.min()
+        n = np.bincount(index).astype(float)
+
+        def group_sum(values):
+            return np.bincount(index, weights=values, minlength=len(battery_ids))
+
+        sum_x = group_sum(day)
+        sum_xx = group_sum(day * day)
+        denominator = n * sum_xx - sum_x ** 2
+        fits = {}
+        for name in ('rint', 'sag'):
+            y = np.array([row[name] for row in rows], dtype=float)
+            sum_y = group_sum(y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                slope = np.where(denominator > 0, (n * group_sum(day * y) - sum_x * sum_y) / denominator, 0.0)
+                mean = sum_y / n
+                change_pct = np.where(mean != 0, slope * 30 / np.abs(mean) * 100, 0.0)
+            fits[name] = (mean, slope, change_pct)
+
+        trends = []
+        for i, battery_id in enumerate(battery_ids.tolist()):
+            flags = []
+            if n[i] >= min_days and fits['rint'][2][i] >= rint_pct:
+                flags.append('rint_rising')
+            if n[i] >= min_days and fits['sag'][2][i] >= sag_pct:
+                flags.append('sag_worsening')
+            trend = {'battery_id': battery_id, 'days': int(n[i]), 'flags': flags}
+            for name, (mean, slope, change_pct) in fits.items():
+                trend[name + '_mean'] = float(mean[i])
+                trend[name + '_slope_per_day'] = float(slope[i])
+                trend[name + '_change_pct_30d'] = float(change_pct[i])
+            trends.append(trend)
+        trends.sort(key=lambda t: (-len(t['flags']), -t['rint_change_pct_30d']))
+        return jsonify(trends)
+    except Exception as e:
+        return jsonify({'error': 'Failed to compute battery trends', 'details': str(e)}), 500
+
 @app.route('/api/battery-logs/<int:log_id>', methods=['DELETE'])
 @login_required(role="admin")
 def delete_battery_log(log_id):
     """Delete a battery log entry"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('DELETE FROM battery_logs WHERE id = ?', (log_id,))
-        conn.commit()
-        conn.close()
+        write_queue.run(remove_battery_log, log_id)
         
         return jsonify({'message': 'Log entry deleted successfully'})
     except Exception as e:
         return jsonify({'error': 'Failed to delete log entry', 'details': str(e)}), 500
+
+def remove_battery_log(cursor, log_id):
+    """Write operation for delete_battery_log"""
+    cursor.execute('DELETE FROM battery_logs WHERE id = ?', (log_id,))
     
 @app.route('/api/debug/batteries', methods=['GET'])
 @login_required()
@@ -793,58 +2255,272 @@ def to_csv(rows):
 
 """Calculate ranking metric based on the option name and config"""
 def calculate_ranking_metric(option, matches, conf):
-    if option == "Average Points":
-        total = 0
-        for match in matches:
-            auto_pts = auto_score(match['auto'], conf)
-            tele_pts = tele_score(match['teleop'], conf)
-            end_pts = endgame_score(match['endgame'], conf)
-            total += auto_pts + tele_pts + end_pts
-        return total / len(matches) if matches else 0
-    elif option == "Average L4 Auto":
-        total = sum(match['auto'].get('L4', {}).get('Made', 0) for match in matches)
-        return total / len(matches) if matches else 0
-    elif option == "Max Auto L4":
-        return max(match['auto'].get('L4', {}).get('Made', 0) for match in matches) if matches else 0
-    elif option == "Average Teleop L4":
-        total = sum(match['teleop'].get('L4', {}).get('Made', 0) for match in matches)
-        return total / len(matches) if matches else 0
-    elif option == "Died %":
-        died_count = sum(1 for match in matches if match['misc'].get('died', False))
-        return (died_count / len(matches) * 100) if matches else 0
-    elif option == "Tippy %":
-        tippy_count = sum(1 for match in matches if match['misc'].get('tippy', False))
-        return (tippy_count / len(matches) * 100) if matches else 0
-    elif option == "Auto Coral %":
-        match_accuracies = []
-        for match in matches:
-            match_made = 0
-            match_attempted = 0
-            for level in ['L1', 'L2', 'L3', 'L4']:
-                if level in match['auto']:
-                    match_made += match['auto'][level].get('Made', 0)
-                    match_attempted += match['auto'][level].get('Made', 0) + match['auto'][level].get('Missed', 0)
-            if match_attempted > 0:
-                match_accuracies.append((match_made / match_attempted) * 100)
-            else:
-                match_accuracies.append(0)
-        return sum(match_accuracies) / len(match_accuracies) if match_accuracies else 0
-    elif option == "Teleop Coral %":
-        match_accuracies = []
-        for match in matches:
-            match_made = 0
-            match_attempted = 0
-            for level in ['L1', 'L2', 'L3', 'L4']:
-                if level in match['teleop']:
-                    match_made += match['teleop'][level].get('Made', 0)
-                    match_attempted += match['teleop'][level].get('Made', 0) + match['teleop'][level].get('Missed', 0)
-            if match_attempted > 0:
-                match_accuracies.append((match_made / match_attempted) * 100)
-            else:
-                match_accuracies.append(0)
-        
-        return sum(match_accuracies) / len(match_accuracies) if match_accuracies else 0
-        return 0
+    return get_ranking_engine(conf).evaluate({'': matches}, [option], conf)[''].get(option)
+
+
+
+
+
+
+
+# ==================== RANKING METRIC ENGINE ====================
+
+"""Raised when a rankings_options metric expression cannot be parsed."""
+class MetricSyntaxError(ValueError):
+    pass
+
+METRIC_TOKEN = re.compile(r'''\s*(?:
+    (?P<number>-?\d+(?:\.\d+)?)
+  | (?P<string>"[^"]*"|'[^']*')
+  | (?P<op>==|!=|>=|<=|>|<)
+  | (?P<punct>[(),])
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z0-9_]+)*)
+)''', re.VERBOSE)
+
+# Names a metric path may start with, mapped to the key used in decoded match records
+METRIC_SECTIONS = {
+    'pre_match': 'pre_match', 'auto': 'auto', 'auto_period': 'auto',
+    'teleop': 'teleop', 'teleop_period': 'teleop', 'endgame': 'endgame', 'misc': 'misc'
+}
+METRIC_COMPUTED_FIELDS = ('auto_points', 'teleop_points', 'endgame_points', 'total_points')
+METRIC_AGGREGATIONS = ('avg', 'sum', 'min', 'max', 'count', 'rate', 'accuracy')
+METRIC_COMPARISONS = {
+    '==': lambda a, b: a == b, '!=': lambda a, b: a != b,
+    '>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b, '<=': lambda a, b: a <= b
+}
+
+"""Splits a metric expression into (kind, text) tokens."""
+def tokenize_metric(expression):
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = METRIC_TOKEN.match(expression, pos)
+        if not match or match.end() == pos:
+            raise MetricSyntaxError("Unexpected text at '{}'".format(expression[pos:]))
+        pos = match.end()
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+    return tokens
+
+"""Returns a function that walks a dotted path through a decoded match record (None when missing)."""
+def compile_metric_path(path):
+    parts = path.split('.')
+    if parts[0] in METRIC_COMPUTED_FIELDS and len(parts) == 1:
+        field = parts[0]
+        return lambda match: match.get(field)
+    if parts[0] not in METRIC_SECTIONS:
+        raise MetricSyntaxError("Unknown section '{}' in path '{}'".format(parts[0], path))
+    section = METRIC_SECTIONS[parts[0]]
+    keys = tuple(parts[1:])
+    def resolve(match):
+        value = match.get(section)
+        for key in keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+    return resolve
+
+"""Turns a filter literal into a Python value: numbers, true/false, or text."""
+def parse_metric_literal(kind, text):
+    if kind == 'number':
+        return float(text) if '.' in text else int(text)
+    if kind == 'string':
+        return text[1:-1]
+    if text in ('true', 'false'):
+        return text == 'true'
+    return text
+
+"""Returns a predicate for one 'path op literal' filter condition."""
+def compile_metric_filter(path, op, literal):
+    resolve = compile_metric_path(path)
+    compare = METRIC_COMPARISONS[op]
+    if isinstance(literal, bool):
+        return lambda match: compare(bool(resolve(match)), literal)
+    if isinstance(literal, (int, float)):
+        def numeric(match):
+            value = resolve(match)
+            try:
+                return compare(float(value), literal)
+            except (TypeError, ValueError):
+                return False
+        return numeric
+    return lambda match: compare(str(resolve(match)), literal)
+
+"""A compiled aggregation. State is a [matches, total, extreme] list updated one match at a time."""
+class RankingMetric:
+    def __init__(self, aggregation, paths, filters):
+        self.aggregation = aggregation
+        self.resolvers = [compile_metric_path(path) for path in paths]
+        self.filters = filters
+        self.needs_scores = any(path.split('.')[0] in METRIC_COMPUTED_FIELDS for path in paths)
+        self.update = getattr(self, '_update_' + aggregation)
+
+    def new_state(self):
+        return [0, 0, None]
+
+    def _accepts(self, match):
+        for accept in self.filters:
+            if not accept(match):
+                return False
+        return True
+
+    def _number(self, match):
+        value = self.resolvers[0](match)
+        return value if isinstance(value, (int, float)) else 0
+
+    def _update_avg(self, state, match):
+        if self._accepts(match):
+            state[0] += 1
+            state[1] += self._number(match)
+
+    _update_sum = _update_avg
+
+    def _update_max(self, state, match):
+        if self._accepts(match):
+            state[0] += 1
+            value = self._number(match)
+            if state[2] is None or value > state[2]:
+                state[2] = value
+
+    def _update_min(self, state, match):
+        if self._accepts(match):
+            state[0] += 1
+            value = self._number(match)
+            if state[2] is None or value < state[2]:
+                state[2] = value
+
+    def _update_count(self, state, match):
+        if self._accepts(match):
+            state[0] += 1
+
+    def _update_rate(self, state, match):
+        if self._accepts(match):
+            state[0] += 1
+            if self.resolvers[0](match):
+                state[1] += 1
+
+    def _update_accuracy(self, state, match):
+        if not self._accepts(match):
+            return
+        made = attempted = 0
+        for resolve in self.resolvers:
+            scoring = resolve(match)
+            if isinstance(scoring, dict):
+                made += scoring.get('Made', 0)
+                attempted += scoring.get('Made', 0) + scoring.get('Missed', 0)
+        state[0] += 1
+        state[1] += (made / attempted) * 100 if attempted > 0 else 0
+
+    def result(self, state):
+        n, total, extreme = state
+        if self.aggregation in ('avg', 'accuracy'):
+            return total / n if n else 0
+        if self.aggregation == 'rate':
+            return (total / n * 100) if n else 0
+        if self.aggregation in ('max', 'min'):
+            return extreme if n else 0
+        if self.aggregation == 'count':
+            return n
+        return total
+
+"""Parses 'agg(path, ...) [where path op value [and ...]]' into a RankingMetric."""
+def compile_metric(expression):
+    tokens = tokenize_metric(expression)
+    def expect(index, kind, text=None):
+        if index >= len(tokens) or tokens[index][0] != kind or (text is not None and tokens[index][1] != text):
+            raise MetricSyntaxError("Expected {} in '{}'".format(text or kind, expression))
+        return tokens[index][1]
+    aggregation = expect(0, 'name')
+    if aggregation not in METRIC_AGGREGATIONS:
+        raise MetricSyntaxError("Unknown aggregation '{}'".format(aggregation))
+    expect(1, 'punct', '(')
+    paths = []
+    index = 2
+    while not (tokens[index:index + 1] and tokens[index] == ('punct', ')')):
+        if paths:
+            expect(index, 'punct', ',')
+            index += 1
+        paths.append(expect(index, 'name'))
+        index += 1
+    index += 1
+    if aggregation != 'count' and not paths:
+        raise MetricSyntaxError("{}() needs a field path".format(aggregation))
+    if aggregation not in ('count', 'accuracy') and len(paths) > 1:
+        raise MetricSyntaxError("{}() takes a single field path".format(aggregation))
+    filters = []
+    if index < len(tokens):
+        expect(index, 'name', 'where')
+        index += 1
+        while True:
+            path = expect(index, 'name')
+            op = expect(index + 1, 'op')
+            if index + 2 >= len(tokens) or tokens[index + 2][0] not in ('number', 'string', 'name'):
+                raise MetricSyntaxError("Expected a value after '{} {}'".format(path, op))
+            filters.append(compile_metric_filter(path, op, parse_metric_literal(*tokens[index + 2])))
+            index += 3
+            if index >= len(tokens):
+                break
+            expect(index, 'name', 'and')
+            index += 1
+    return RankingMetric(aggregation, paths, filters)
+
+"""Computes every compiled rankings option for every team in a single pass over their matches."""
+class RankingEngine:
+    def __init__(self, rankings_options):
+        self.metrics = {}
+        self.errors = {}
+        for option, spec in rankings_options.items():
+            try:
+                if not spec.get('metric'):
+                    raise MetricSyntaxError("Ranking option '{}' has no metric".format(option))
+                self.metrics[option] = compile_metric(spec['metric'])
+            except MetricSyntaxError as e:
+                self.errors[option] = str(e)
+
+    def evaluate(self, team_matches, options=None, conf=None):
+        """Returns {team: {option: value}} for the given options (all compiled options by default)."""
+        options = [o for o in (options or self.metrics) if o in self.metrics]
+        metrics = [self.metrics[o] for o in options]
+        needs_scores = any(m.needs_scores for m in metrics)
+        results = {}
+        for team, matches in team_matches.items():
+            states = [m.new_state() for m in metrics]
+            for match in matches:
+                if needs_scores and 'total_points' not in match:
+                    score_match_record(match, conf)
+                for metric, state in zip(metrics, states):
+                    metric.update(state, match)
+            results[team] = {o: m.result(s) for o, m, s in zip(options, metrics, states)}
+        return results
+
+ranking_engine_cache = {'version': None, 'engine': None}
+ranking_engine_lock = threading.Lock()
+
+"""Returns a config.json version stamp that changes whenever the file is saved."""
+def config_version():
+    stat = os.stat(CONFIG_PATH)
+    return (stat.st_mtime_ns, stat.st_size)
+
+"""Returns the RankingEngine for the current config, compiling it only when config.json changed."""
+def get_ranking_engine(conf):
+    version = config_version()
+    with ranking_engine_lock:
+        if ranking_engine_cache['version'] != version:
+            ranking_engine_cache['engine'] = RankingEngine(conf.get('rankings_options', {}))
+            ranking_engine_cache['version'] = version
+        return ranking_engine_cache['engine']
+
+"""Adds auto/teleop/endgame/total points to a decoded match record."""
+def score_match_record(match, conf):
+    conf = conf if conf is not None else read_config()
+    match['auto_points'] = auto_score(match['auto'], conf)
+    match['teleop_points'] = tele_score(match['teleop'], conf)
+    match['endgame_points'] = endgame_score(match['endgame'], conf)
+    match['total_points'] = match['auto_points'] + match['teleop_points'] + match['endgame_points']
+    return match
 
 
 
@@ -1092,6 +2768,97 @@ def debug_check_auth():
     else:
         return jsonify({'authenticated': False, 'message': 'Invalid token'})
 
+"""Returns the rolling top-N slow-query summary and the most recent slow statements (admin only)."""
+@app.route('/api/debug/slow-queries', methods=['GET'])
+@login_required(role="admin")
+def debug_slow_queries():
+    try:
+        recent = int(request.args.get('recent', 20))
+        with slow_queries_lock:
+            recent_entries = list(slow_queries)[-recent:] if recent > 0 else []
+        return jsonify({
+            'enabled': query_trace['enabled'],
+            'threshold_ms': query_trace['threshold_ms'],
+            'window': slow_queries.maxlen,
+            'top': slow_query_summary(),
+            'recent': recent_entries[::-1]
+        })
+    except Exception as e:
+        return jsonify({'error': 'Failed to fetch slow queries', 'details': str(e)}), 500
+
+"""Turns query tracing on or off, changes the slow threshold, or clears the window (admin only)."""
+@app.route('/api/debug/slow-queries', methods=['POST'])
+@login_required(role="admin")
+def update_slow_query_settings():
+    try:
+        data = request.get_json() or {}
+        if 'enabled' in data:
+            query_trace['enabled'] = bool(data['enabled'])
+        if 'threshold_ms' in data:
+            query_trace['threshold_ms'] = float(data['threshold_ms'])
+        if 'top_n' in data:
+            query_trace['top_n'] = int(data['top_n'])
+        if data.get('reset'):
+            with slow_queries_lock:
+                slow_queries.clear()
+        return jsonify({'ok': True, 'enabled': query_trace['enabled'], 'threshold_ms': query_trace['threshold_ms']})
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': 'Invalid setting', 'details': str(e)}), 400
+
+"""Returns write queue depth and group-commit batch statistics (admin only)."""
+@app.route('/api/debug/write-queue', methods=['GET'])
+@login_required(role="admin")
+def debug_write_queue():
+    return jsonify(write_queue.metrics())
+
+"""Lists backups with sizes and checksums, plus the last backup's step and restart counts (admin only)."""
+@app.route('/api/debug/backups', methods=['GET'])
+@login_required(role="admin")
+def debug_backups():
+    return jsonify(backups.report())
+
+"""Takes a backup now and returns it (admin only)."""
+@app.route('/api/debug/backups', methods=['POST'])
+@login_required(role="admin")
+def take_backup():
+    try:
+        return jsonify(backups.take())
+    except Exception as e:
+        return jsonify({'error': 'backup', 'details': str(e)}), 500
+
+"""Returns page counts, free pages and the last run, duration and result of each maintenance task (admin only)."""
+@app.route('/api/debug/maintenance', methods=['GET'])
+@login_required(role="admin")
+def debug_maintenance():
+    return jsonify(db_maintenance.report())
+
+"""Runs one maintenance task immediately, e.g. {"task": "quick_check"} (admin only)."""
+@app.route('/api/debug/maintenance', methods=['POST'])
+@login_required(role="admin")
+def run_maintenance_task():
+    task = (request.get_json(silent=True) or {}).get('task')
+    if task not in db_maintenance.tasks:
+        return jsonify({'error': 'task', 'details': 'task must be one of ' + ', '.join(db_maintenance.tasks)}), 400
+    return jsonify(dict(db_maintenance.run(task), task=task))
+
+"""Returns analytics snapshot generation, age, refresh and read statistics (admin only)."""
+@app.route('/api/debug/analytics-snapshot', methods=['GET'])
+@login_required(role="admin")
+def debug_analytics_snapshot():
+    return jsonify(analytics_snapshot.metrics())
+
+"""Returns admission-control queue, concurrency and rate-limit statistics per priority class (admin only)."""
+@app.route('/api/debug/admission', methods=['GET'])
+@login_required(role="admin")
+def debug_admission():
+    return jsonify(admission.metrics())
+
+"""Returns decoded-match cache hit/miss, eviction and memory statistics (admin only)."""
+@app.route('/api/debug/match-cache', methods=['GET'])
+@login_required(role="admin")
+def debug_match_cache():
+    return jsonify(match_cache.metrics())
+
 
 
 
@@ -1102,32 +2869,67 @@ def debug_check_auth():
 
 checklist_state = {}
 checklist_lock = threading.Lock()
+checklist_meta = {'loaded': False, 'epoch': secrets.token_hex(4), 'version': 0, 'body': None, 'body_version': None}
+checklist_dirty = set()
+# Longest wait between retries of a checklist flush that failed
+CHECKLIST_RETRY_MAX_S = 60
+checklist_definitions_cache = {'version': None, 'definitions': {}}
+
+"""Loads checklist rows into checklist_state the first time they are needed; call with checklist_lock held."""
+def ensure_checklist_state():
+    if checklist_meta['loaded']:
+        return
+    conn = get_db_connection()
+    rows = conn.execute('SELECT checklist_key, title, options_json, checked_json FROM checklist_items').fetchall()
+    conn.close()
+    for row in rows:
+        checklist_state[row['checklist_key']] = {
+            'title': row['title'],
+            'options': json.loads(row['options_json']),
+            'checked': json.loads(row['checked_json'])
+        }
+    checklist_meta['loaded'] = True
 
-"""Retrieves all checklist items from the database."""
+"""Returns {key: (title, options)} for every checklist in config.json, rebuilt only when the file changes."""
+def checklist_definitions():
+    version = config_version()
+    with checklist_lock:
+        if checklist_definitions_cache['version'] != version:
+            conf = read_config()
+            definitions = {}
+            for section in ('pitProcedures', 'Home'):
+                for key, item in conf.get(section, {}).get('body', {}).items():
+                    if isinstance(item, dict) and item.get('type') == 'checklist':
+                        definitions[key] = (item.get('title', 'Checklist'), item.get('options', []))
+            checklist_definitions_cache['definitions'] = definitions
+            checklist_definitions_cache['version'] = version
+        return checklist_definitions_cache['definitions']
+
+"""Returns the ETag for the current checklist version; call with checklist_lock held."""
+def checklist_etag():
+    return f'"{checklist_meta["epoch"]}-{checklist_meta["version"]}"'
+
+"""Retrieves all checklist items from memory, answering 304 when the client already has this version."""
 @app.route('/api/checklist', methods=['GET'])
 def get_checklist():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM checklist_items')
-        rows = cursor.fetchall()
-        conn.close()
-       #print("Database checklist items:")
-        #for row in rows:
-            #print(f"  Key: {row['checklist_key']}, Checked: {row['checked_json']}")
-        checklist_data = {}
-        for row in rows:
-            checklist_data[row['checklist_key']] = {
-                'title': row['title'],
-                'options': json.loads(row['options_json']),
-                'checked': json.loads(row['checked_json'])
-            }
-        return jsonify(checklist_data)
+        with checklist_lock:
+            ensure_checklist_state()
+            etag = checklist_etag()
+            version = checklist_meta['version']
+            if checklist_meta['body_version'] != checklist_meta['version']:
+                checklist_meta['body'] = json.dumps(checklist_state)
+                checklist_meta['body_version'] = checklist_meta['version']
+            body = checklist_meta['body']
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'X-Checklist-Version': str(version)}
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(status=304, headers=headers)
+        return Response(body, mimetype='application/json', headers=headers)
     except Exception as e:
         print(f"Error getting checklist: {e}")
         return jsonify({'error': 'db', 'details': str(e)}), 500
 
-"""Updates or creates a checklist item with the specified checked items."""
+"""Updates or creates a checklist item in memory and queues its write-behind flush."""
 @app.route('/api/checklist/<path:checklist_key>', methods=['POST'])
 def update_checklist(checklist_key):
     try:
@@ -1137,45 +2939,59 @@ def update_checklist(checklist_key):
         
         data = request.get_json()
         checked_items = data.get('checked', [])
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM checklist_items WHERE checklist_key = ?', (checklist_key,))
-        row = cursor.fetchone()
-        if row:
-            cursor.execute('''
-                UPDATE checklist_items 
-                SET checked_json = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE checklist_key = ?
-            ''', (json.dumps(checked_items), checklist_key))
-        else:
-            conf = read_config()
-            checklist_config = None
-            home_body = conf.get('Home', {}).get('body', {})
-            if checklist_key in home_body and home_body[checklist_key].get('type') == 'checklist':
-                checklist_config = home_body[checklist_key]
-            if not checklist_config:
-                pit_body = conf.get('pitProcedures', {}).get('body', {})
-                if checklist_key in pit_body and pit_body[checklist_key].get('type') == 'checklist':
-                    checklist_config = pit_body[checklist_key]
-            if not checklist_config:
-                conn.close()
-                return jsonify({'error': 'Checklist not found in config'}), 404
-            cursor.execute('''
-                INSERT INTO checklist_items (checklist_key, title, options_json, checked_json)
-                VALUES (?, ?, ?, ?)
-            ''', (
-                checklist_key,
-                checklist_config.get('title', 'Checklist'),
-                json.dumps(checklist_config.get('options', [])),
-                json.dumps(checked_items)
-            ))
-        conn.commit()
-        conn.close()
-        return jsonify({'ok': True})
+        definitions = checklist_definitions()
+        with checklist_lock:
+            ensure_checklist_state()
+            item = checklist_state.get(checklist_key)
+            if item is None:
+                if checklist_key not in definitions:
+                    return jsonify({'error': 'Checklist not found in config'}), 404
+                title, options = definitions[checklist_key]
+                item = checklist_state[checklist_key] = {'title': title, 'options': options, 'checked': []}
+            item['checked'] = checked_items
+            checklist_meta['version'] += 1
+            version = checklist_meta['version']
+            if checklist_key not in checklist_dirty:
+                checklist_dirty.add(checklist_key)
+                submit_checklist_flush(checklist_key)
+        return jsonify({'ok': True, 'version': version})
     except Exception as e:
         print(f"Error updating checklist: {e}")
         return jsonify({'error': 'update', 'details': str(e)}), 500
 
+"""Write operation that upserts the latest in-memory state of a checklist, coalescing toggles made since it was queued."""
+def flush_checklist_item(cursor, checklist_key):
+    with checklist_lock:
+        checklist_dirty.discard(checklist_key)
+        item = checklist_state[checklist_key]
+        params = (checklist_key, item['title'], json.dumps(item['options']), json.dumps(item['checked']))
+    cursor.execute('''
+        INSERT INTO checklist_items (checklist_key, title, options_json, checked_json)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(checklist_key) DO UPDATE SET checked_json = excluded.checked_json, updated_at = CURRENT_TIMESTAMP
+    ''', params)
+
+"""Queues the write-behind flush of a checklist; attempt counts earlier failed flushes."""
+def submit_checklist_flush(checklist_key, attempt=0):
+    write_queue.submit(flush_checklist_item, checklist_key).add_done_callback(
+        lambda future: checklist_flush_done(future, checklist_key, attempt))
+
+"""Retries a failed checklist flush after a backoff (1s, doubling up to CHECKLIST_RETRY_MAX_S).
+
+The key stays dirty until the retry runs, so toggles made meanwhile ride along with it instead of
+queueing their own flush. If a toggle already queued a newer flush, that one writes the full state."""
+def checklist_flush_done(future, checklist_key, attempt):
+    if future.exception() is None:
+        return
+    print(f"Error saving checklist {checklist_key}: {future.exception()}")
+    with checklist_lock:
+        if checklist_key in checklist_dirty:
+            return
+        checklist_dirty.add(checklist_key)
+    retry = threading.Timer(min(CHECKLIST_RETRY_MAX_S, 2 ** attempt), submit_checklist_flush, (checklist_key, attempt + 1))
+    retry.daemon = True
+    retry.start()
+
 
 
 
@@ -1245,6 +3061,202 @@ def upload_file():
 
 
 
+# ==================== SUBMISSION VALIDATION ====================
+
+# Submission key for each match_form section; pit_form fields all live under pit_json
+MATCH_FORM_SECTIONS = (('pre_match', 'pre_match_json'), ('auto_period', 'auto_json'),
+                       ('teleop_period', 'teleop_json'), ('endgame', 'endgame_json'), ('misc', 'misc_json'))
+REQUIRED_FIELDS = {'pre_match_json': ('team_number',), 'pit_json': ('team_number',)}
+BOOLEAN_WORDS = {'true': True, 'yes': True, 'on': True, '1': True,
+                 'false': False, 'no': False, 'off': False, '0': False}
+
+"""Raised when a submission has fields that cannot be coerced; errors is a list of {field, error}."""
+class SubmissionError(ValueError):
+    def __init__(self, errors):
+        super().__init__('; '.join('{}: {}'.format(e['field'], e['error']) for e in errors))
+        self.errors = errors
+
+"""Returns an option's lookup key: case-insensitive with runs of whitespace collapsed."""
+def option_key(value):
+    return ' '.join(value.split()).casefold()
+
+"""Coerces ints, integral floats and numeric strings to int."""
+def coerce_int(value):
+    if isinstance(value, bool):
+        raise ValueError('expected a whole number')
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = value.strip()
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('expected a whole number')
+    if not number.is_integer():
+        raise ValueError('expected a whole number')
+    return int(number)
+
+"""Coerces ints, floats and numeric strings to a finite float."""
+def coerce_float(value):
+    if isinstance(value, bool):
+        raise ValueError('expected a number')
+    try:
+        number = float(value.strip() if isinstance(value, str) else value)
+    except (TypeError, ValueError):
+        raise ValueError('expected a number')
+    if not math.isfinite(number):
+        raise ValueError('expected a finite number')
+    return number
+
+"""Coerces booleans, 0/1 and true/false/yes/no/on/off strings to bool."""
+def coerce_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in BOOLEAN_WORDS:
+        return BOOLEAN_WORDS[value.strip().lower()]
+    raise ValueError('expected true or false')
+
+"""Compiles a Single Choice lookup that maps any spelling of an option (or a configured alias) to it."""
+def compile_choice(spec):
+    options = spec.get('options') or spec.get('List') or spec.get('list') or []
+    lookup = {option_key(str(o)): o for o in options}
+    for alias, option in (spec.get('aliases') or {}).items():
+        if option in options:
+            lookup[option_key(alias)] = option
+    def choose(value):
+        if isinstance(value, str) and option_key(value) in lookup:
+            return lookup[option_key(value)]
+        if value in options:
+            return value
+        raise ValueError('{!r} is not one of {}'.format(value, ', '.join(map(str, options))))
+    return choose
+
+"""Compiles one form field spec into a function that returns the normalized value or raises ValueError."""
+def compile_field(name, spec):
+    spec = spec if isinstance(spec, dict) else {}
+    kind = str(spec.get('type') or spec.get('Type') or '').strip().lower()
+    if not kind and ('Made' in spec or 'Value' in spec):
+        kind = 'scoring object'
+    if kind in ('integer', 'typed integer'):
+        if name == 'team_number':
+            def check_team(value):
+                number = coerce_int(value)
+                if number <= 0:
+                    raise ValueError('team number must be positive')
+                return number
+            return check_team
+        return coerce_int
+    if kind == 'float':
+        return coerce_float
+    if kind == 'boolean':
+        return coerce_bool
+    if kind == 'boolean with value':
+        points = spec.get('value', spec.get('Value', 1))
+        def check_valued(value):
+            if not isinstance(value, bool) and value == points:
+                return points
+            return points if coerce_bool(value) else 0
+        return check_valued
+    if kind == 'scoring object':
+        counters = [k for k in ('Made', 'Missed') if spec.get(k, True)]
+        def check_counts(value):
+            if not isinstance(value, dict):
+                raise ValueError('expected an object with {}'.format(' and '.join(counters)))
+            counts = dict(value)
+            for counter in counters:
+                try:
+                    counts[counter] = max(0, coerce_int(counts.get(counter) or 0))
+                except ValueError as e:
+                    raise ValueError('{}: {}'.format(counter, e))
+            return counts
+        return check_counts
+    if 'multiple choice' in kind:
+        choose = compile_choice(spec)
+        def check_many(value):
+            if not isinstance(value, list):
+                raise ValueError('expected a list of options')
+            return list(dict.fromkeys(choose(v) for v in value))
+        return check_many
+    if 'single choice' in kind:
+        return compile_choice(spec)
+    if kind == 'string':
+        def check_text(value):
+            if isinstance(value, (dict, list)):
+                raise ValueError('expected text')
+            return str(value).strip()
+        return check_text
+    return lambda value: value
+
+"""Type-checks, coerces and normalizes submissions against match_form or pit_form in one pass."""
+class FormValidator:
+    def __init__(self, sections):
+        self.sections = {key: {name: compile_field(name, spec) for name, spec in fields.items()
+                               if isinstance(spec, dict)}
+                         for key, fields in sections.items()}
+
+    def validate(self, data, partial=False):
+        """Returns {section key: normalized section}; partial only covers the sections present in data."""
+        if not isinstance(data, dict):
+            raise SubmissionError([{'field': '', 'error': 'expected a JSON object'}])
+        errors = []
+        result = {}
+        for key, checks in self.sections.items():
+            if key not in data and partial:
+                continue
+            section = data.get(key)
+            if section is None:
+                section = {}
+            if not isinstance(section, dict):
+                errors.append({'field': key, 'error': 'expected an object'})
+                continue
+            clean = dict(section)
+            for name, value in section.items():
+                if value is None or value == '' or name not in checks:
+                    continue
+                try:
+                    clean[name] = checks[name](value)
+                except ValueError as e:
+                    errors.append({'field': '{}.{}'.format(key, name), 'error': str(e)})
+            for name in REQUIRED_FIELDS.get(key, ()):
+                if name in checks and clean.get(name) in (None, ''):
+                    errors.append({'field': '{}.{}'.format(key, name), 'error': 'is required'})
+            result[key] = clean
+        if errors:
+            raise SubmissionError(errors)
+        return result
+
+form_validator_cache = {'version': None, 'match': None, 'pit': None}
+form_validator_lock = threading.Lock()
+
+"""Returns the compiled 'match' or 'pit' FormValidator, recompiling only when config.json changed."""
+def get_form_validator(kind):
+    version = config_version()
+    with form_validator_lock:
+        if form_validator_cache['version'] != version:
+            conf = read_config()
+            match_form = conf.get('match_form', {})
+            form_validator_cache['match'] = FormValidator(
+                {key: match_form.get(section, {}) for section, key in MATCH_FORM_SECTIONS})
+            form_validator_cache['pit'] = FormValidator({'pit_json': conf.get('pit_form', {}).get('fields', {})})
+            form_validator_cache['version'] = version
+        return form_validator_cache[kind]
+
+"""Returns the 400 response for a submission that failed validation."""
+def validation_response(error):
+    return jsonify({'error': 'validation', 'details': error.errors}), 400
+
+
+
+
+
+
+
 # ==================== MATCH DATA ENDPOINTS ====================
 
 """Creates a new match record with scoring data and calculates points based on configuration."""
@@ -1253,25 +3265,22 @@ def upload_file():
 def create_match():
     try:
         conf = read_config()
-        data = request.get_json()
-        pre = data.get('pre_match_json', {})
-        auto = data.get('auto_json', {})
-        tele = data.get('teleop_json', {})
-        endg = data.get('endgame_json', {})
-        misc = data.get('misc_json', {})
+        data = get_form_validator('match').validate(request.get_json(silent=True))
+        pre = data['pre_match_json']
+        auto = data['auto_json']
+        tele = data['teleop_json']
+        endg = data['endgame_json']
+        misc = data['misc_json']
         auto_pts = auto_score(auto, conf)
         tele_pts = tele_score(tele, conf)
         end_pts = endgame_score(endg, conf)
         total_pts = auto_pts + tele_pts + end_pts
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO matches(pre_match_json, auto_json, teleop_json, endgame_json, misc_json)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (json.dumps(pre), json.dumps(auto), json.dumps(tele), json.dumps(endg), json.dumps(misc)))
-        match_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        match_id = write_queue.run(insert_match, pre, auto, tele, endg, misc)
+        bump_data_version('matches')
+        team_ratings.add(score_match_record({
+            'id': match_id, 'team_number': str(pre.get('team_number')), 'pre_match': pre,
+            'auto': auto, 'teleop': tele, 'endgame': endg, 'misc': misc
+        }, conf))
         return jsonify({
             'id': match_id,
             'autoPts': auto_pts,
@@ -1279,33 +3288,44 @@ def create_match():
             'endPts': end_pts,
             'total': total_pts
         })
+    except SubmissionError as e:
+        return validation_response(e)
     except Exception as e:
         return jsonify({'error': 'insert', 'details': str(e)}), 500
 
+"""Write operation that inserts a match and returns its new ID."""
+def insert_match(cursor, pre, auto, tele, endg, misc):
+    cursor.execute('''
+        INSERT INTO matches(pre_match_json, auto_json, teleop_json, endgame_json, misc_json)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (json.dumps(pre), json.dumps(auto), json.dumps(tele), json.dumps(endg), json.dumps(misc)))
+    return cursor.lastrowid
+
 """Retrieves match records with pagination support and JSON parsing."""
 @app.route('/api/matches', methods=['GET'])
 def get_matches():
+    try:
+        projection = requested_projection('matches')
+    except ValueError as e:
+        return jsonify({'error': 'fields', 'details': str(e)}), 400
     try:
         conf = read_config()
         cap = conf.get('limits', {}).get('raw_table_cap', 50)
         limit = int(request.args.get('limit', cap))
         offset = max(0, int(request.args.get('offset', 0)))
+        event_code = request.args.get('event_code', 'all')
+        where, params = match_filters(event_code=event_code)
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM matches ORDER BY id DESC LIMIT ? OFFSET ?', (limit, offset))
-        rows = cursor.fetchall()
-        conn.close()
-        matches = []
-        for row in rows:
-            match_data = dict(row)
-            match_data['pre_match_json'] = json.loads(row['pre_match_json'])
-            match_data['auto_json'] = json.loads(row['auto_json'])
-            match_data['teleop_json'] = json.loads(row['teleop_json'])
-            match_data['endgame_json'] = json.loads(row['endgame_json'])
-            match_data['misc_json'] = json.loads(row['misc_json'])
-            matches.append(match_data)
-        return jsonify(matches)
+        if projection:
+            records = None
+            if projection.computed:
+                records = {r['id']: r for r in read_match_records(
+                    newest_first=True, limit=limit, offset=offset, event_code=event_code)}
+            rows = iter_rows(projection.select + ' {} ORDER BY id DESC LIMIT ? OFFSET ?'.format(where),
+                             projection.params + params + [limit, offset])
+            return json_array_response(projection.row_json(row, records) for row in rows)
+        rows = iter_rows(MATCH_SELECT + ' {} ORDER BY id DESC LIMIT ? OFFSET ?'.format(where), params + [limit, offset])
+        return json_array_response(match_json(row) for row in rows)
     except Exception as e:
         return jsonify({'error': 'list', 'details': str(e)}), 500
 
@@ -1314,43 +3334,53 @@ def get_matches():
 @login_required(role="admin")
 def update_match(match_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM matches WHERE id = ?', (match_id,))
-        row = cursor.fetchone()
-        if not row:
-            conn.close()
+        data = get_form_validator('match').validate(request.get_json(silent=True), partial=True)
+        if not write_queue.run(apply_match_update, match_id, data):
             return jsonify({'error': 'not found'}), 404
-        data = request.get_json()
-        pre = data.get('pre_match_json', json.loads(row['pre_match_json']))
-        auto = data.get('auto_json', json.loads(row['auto_json']))
-        tele = data.get('teleop_json', json.loads(row['teleop_json']))
-        endg = data.get('endgame_json', json.loads(row['endgame_json']))
-        misc = data.get('misc_json', json.loads(row['misc_json']))
-        cursor.execute('''
-            UPDATE matches SET pre_match_json=?, auto_json=?, teleop_json=?, endgame_json=?, misc_json=?
-            WHERE id=?
-        ''', (json.dumps(pre), json.dumps(auto), json.dumps(tele), json.dumps(endg), json.dumps(misc), match_id))
-        conn.commit()
-        conn.close()
+        match_cache.invalidate([match_id])
+        bump_data_version('matches')
+        team = data.get('pre_match_json', {}).get('team_number') if 'pre_match_json' in data else None
+        team_ratings.changed(match_id, str(team) if team is not None else None)
         return jsonify({'ok': True})
+    except SubmissionError as e:
+        return validation_response(e)
     except Exception as e:
         return jsonify({'error': 'update', 'details': str(e)}), 500
 
+"""Write operation that replaces the sections present in data; returns False if the match is missing."""
+def apply_match_update(cursor, match_id, data):
+    cursor.execute('SELECT * FROM matches WHERE id = ?', (match_id,))
+    row = cursor.fetchone()
+    if not row:
+        return False
+    pre = data.get('pre_match_json', json.loads(row['pre_match_json']))
+    auto = data.get('auto_json', json.loads(row['auto_json']))
+    tele = data.get('teleop_json', json.loads(row['teleop_json']))
+    endg = data.get('endgame_json', json.loads(row['endgame_json']))
+    misc = data.get('misc_json', json.loads(row['misc_json']))
+    cursor.execute('''
+        UPDATE matches SET pre_match_json=?, auto_json=?, teleop_json=?, endgame_json=?, misc_json=?
+        WHERE id=?
+    ''', (json.dumps(pre), json.dumps(auto), json.dumps(tele), json.dumps(endg), json.dumps(misc), match_id))
+    return True
+
 """Deletes a match record by ID (admin only)."""
 @app.route('/api/matches/<int:match_id>', methods=['DELETE'])
 @login_required(role="admin")
 def delete_match(match_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM matches WHERE id = ?', (match_id,))
-        conn.commit()
-        conn.close()
+        write_queue.run(remove_match, match_id)
+        match_cache.invalidate([match_id])
+        bump_data_version('matches')
+        team_ratings.changed(match_id)
         return jsonify({'ok': True})
     except Exception as e:
         return jsonify({'error': 'delete', 'details': str(e)}), 500
 
+"""Write operation that deletes a match."""
+def remove_match(cursor, match_id):
+    cursor.execute('DELETE FROM matches WHERE id = ?', (match_id,))
+
 
 
 
@@ -1364,56 +3394,62 @@ def delete_match(match_id):
 @login_required(role="admin")
 def reindex_matches():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM matches ORDER BY id ASC')
-        matches = cursor.fetchall()
-        cursor.execute('''
-            CREATE TEMPORARY TABLE matches_temp (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                created_at TEXT,
-                pre_match_json TEXT,
-                auto_json TEXT,
-                teleop_json TEXT,
-                endgame_json TEXT,
-                misc_json TEXT
-            )
-        ''')
-        for match in matches:
-            cursor.execute('''
-                INSERT INTO matches_temp (created_at, pre_match_json, auto_json, teleop_json, endgame_json, misc_json)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (match['created_at'], match['pre_match_json'], match['auto_json'], 
-                  match['teleop_json'], match['endgame_json'], match['misc_json']))
-        cursor.execute('DROP TABLE matches')
-        cursor.execute('''
-            CREATE TABLE matches(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                pre_match_json TEXT NOT NULL,
-                auto_json TEXT NOT NULL,
-                teleop_json TEXT NOT NULL,
-                endgame_json TEXT NOT NULL,
-                misc_json TEXT NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            INSERT INTO matches (id, created_at, pre_match_json, auto_json, teleop_json, endgame_json, misc_json)
-            SELECT id, created_at, pre_match_json, auto_json, teleop_json, endgame_json, misc_json 
-            FROM matches_temp 
-            ORDER BY id
-        ''')
-        cursor.execute('DROP TABLE matches_temp')
-        conn.commit()
-        conn.close()
+        reindexed_count = write_queue.run(rebuild_matches_table)
+        match_cache.invalidate()
+        bump_data_version('matches')
+        team_ratings.invalidate()
         return jsonify({
             'message': 'Matches reindexed successfully',
-            'reindexed_count': len(matches)
+            'reindexed_count': reindexed_count
         })
     except Exception as e:
-        conn.rollback()
-        conn.close()
         return jsonify({'error': 'reindex failed', 'details': str(e)}), 500
+
+"""Write operation that renumbers matches 1..N in ID order and returns the number of matches."""
+def rebuild_matches_table(cursor):
+    cursor.execute('SELECT * FROM matches ORDER BY id ASC')
+    matches = cursor.fetchall()
+    cursor.execute('''
+        CREATE TEMPORARY TABLE matches_temp (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT,
+            pre_match_json TEXT,
+            auto_json TEXT,
+            teleop_json TEXT,
+            endgame_json TEXT,
+            misc_json TEXT
+        )
+    ''')
+    for match in matches:
+        cursor.execute('''
+            INSERT INTO matches_temp (created_at, pre_match_json, auto_json, teleop_json, endgame_json, misc_json)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (match['created_at'], match['pre_match_json'], match['auto_json'], 
+              match['teleop_json'], match['endgame_json'], match['misc_json']))
+    cursor.execute('DROP TABLE matches')
+    cursor.execute('''
+        CREATE TABLE matches(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            pre_match_json TEXT NOT NULL,
+            auto_json TEXT NOT NULL,
+            teleop_json TEXT NOT NULL,
+            endgame_json TEXT NOT NULL,
+            misc_json TEXT NOT NULL,
+            row_version INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO matches (id, created_at, pre_match_json, auto_json, teleop_json, endgame_json, misc_json)
+        SELECT id, created_at, pre_match_json, auto_json, teleop_json, endgame_json, misc_json 
+        FROM matches_temp 
+        ORDER BY id
+    ''')
+    cursor.execute('DROP TABLE matches_temp')
+    cursor.execute(MATCHES_ROW_VERSION_TRIGGER)
+    cursor.execute(MATCHES_TEAM_INDEX)
+    cursor.execute(MATCHES_EVENT_INDEX)
+    return len(matches)
     
     
     
@@ -1427,39 +3463,41 @@ def reindex_matches():
 @app.route('/api/pits', methods=['POST'])
 def create_pit():
     try:
-        data = request.get_json()
-        pit = data.get('pit_json', {})
+        data = request.get_json(silent=True)
+        pit = get_form_validator('pit').validate(data)['pit_json']
         image_path = data.get('image_path')
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO pits(pit_json, image_path) VALUES (?, ?)', 
-                      (json.dumps(pit), image_path))
-        pit_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        pit_id = write_queue.run(insert_pit, pit, image_path)
+        bump_data_version('pits')
         return jsonify({'id': pit_id})
+    except SubmissionError as e:
+        return validation_response(e)
     except Exception as e:
         return jsonify({'error': 'insert', 'details': str(e)}), 500
 
+"""Write operation that inserts a pit record and returns its new ID."""
+def insert_pit(cursor, pit, image_path):
+    cursor.execute('INSERT INTO pits(pit_json, image_path) VALUES (?, ?)', 
+                  (json.dumps(pit), image_path))
+    return cursor.lastrowid
+
 """Retrieves pit scouting records with pagination support."""
 @app.route('/api/pits', methods=['GET'])
 def get_pits():
+    try:
+        projection = requested_projection('pits')
+    except ValueError as e:
+        return jsonify({'error': 'fields', 'details': str(e)}), 400
     try:
         conf = read_config()
         cap = conf.get('limits', {}).get('raw_table_cap', 50)
         limit = min(int(request.args.get('limit', cap)), 200)
         offset = max(0, int(request.args.get('offset', 0)))
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM pits ORDER BY id DESC LIMIT ? OFFSET ?', (limit, offset))
-        rows = cursor.fetchall()
-        conn.close()
-        pits = []
-        for row in rows:
-            pit_data = dict(row)
-            pit_data['pit_json'] = json.loads(row['pit_json'])
-            pits.append(pit_data)
-        return jsonify(pits)
+        if projection:
+            rows = iter_rows(projection.select + ' ORDER BY id DESC LIMIT ? OFFSET ?',
+                             projection.params + [limit, offset])
+            return json_array_response(projection.row_json(row) for row in rows)
+        rows = iter_rows('SELECT * FROM pits ORDER BY id DESC LIMIT ? OFFSET ?', (limit, offset))
+        return json_array_response(splice_json_object(dict(row), ('pit_json',)) for row in rows)
     except Exception as e:
         return jsonify({'error': 'list', 'details': str(e)}), 500
 
@@ -1468,38 +3506,619 @@ def get_pits():
 @login_required(role="admin")
 def update_pit(pit_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM pits WHERE id = ?', (pit_id,))
-        row = cursor.fetchone()
-        if not row:
-            conn.close()
+        data = request.get_json(silent=True)
+        data = dict(data, **get_form_validator('pit').validate(data, partial=True))
+        if not write_queue.run(apply_pit_update, pit_id, data):
             return jsonify({'error': 'not found'}), 404
-        data = request.get_json()
-        pit = data.get('pit_json', json.loads(row['pit_json']))
-        image_path = data.get('image_path', row['image_path'])
-        cursor.execute('UPDATE pits SET pit_json=?, image_path=? WHERE id=?', 
-                      (json.dumps(pit), image_path, pit_id))
-        conn.commit()
-        conn.close()
+        bump_data_version('pits')
         return jsonify({'ok': True})
+    except SubmissionError as e:
+        return validation_response(e)
     except Exception as e:
         return jsonify({'error': 'update', 'details': str(e)}), 500
 
+"""Write operation that updates a pit record; returns False if it is missing."""
+def apply_pit_update(cursor, pit_id, data):
+    cursor.execute('SELECT * FROM pits WHERE id = ?', (pit_id,))
+    row = cursor.fetchone()
+    if not row:
+        return False
+    pit = data.get('pit_json', json.loads(row['pit_json']))
+    image_path = data.get('image_path', row['image_path'])
+    cursor.execute('UPDATE pits SET pit_json=?, image_path=? WHERE id=?', 
+                  (json.dumps(pit), image_path, pit_id))
+    return True
+
 """Deletes a pit scouting record by ID (admin only)."""
 @app.route('/api/pits/<int:pit_id>', methods=['DELETE'])
 @login_required(role="admin")
 def delete_pit(pit_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM pits WHERE id = ?', (pit_id,))
-        conn.commit()
-        conn.close()
+        write_queue.run(remove_pit, pit_id)
+        bump_data_version('pits')
         return jsonify({'ok': True})
     except Exception as e:
         return jsonify({'error': 'delete', 'details': str(e)}), 500
 
+"""Write operation that deletes a pit record."""
+def remove_pit(cursor, pit_id):
+    cursor.execute('DELETE FROM pits WHERE id = ?', (pit_id,))
+
+
+
+
+
+
+
+# ==================== MATCH RECORD CACHE ====================
+
+# Columns of the matches table as clients and CSV exports see them (row_version is internal)
+MATCH_COLUMNS = ('id', 'created_at', 'pre_match_json', 'auto_json', 'teleop_json', 'endgame_json', 'misc_json')
+MATCH_SELECT = 'SELECT ' + ', '.join(MATCH_COLUMNS) + ', row_version FROM matches'
+MATCH_JSON_COLUMNS = MATCH_COLUMNS[2:]
+# Matches a team the same way str(pre_match['team_number']) == str(team) does, using idx_matches_team
+MATCH_TEAM_FILTER = "CAST(json_extract(pre_match_json, '$.team_number') AS TEXT) = ?"
+# Selects one event's rows through idx_matches_event; a missing event_code counts as 'Unknown' like pre_match.get does
+MATCH_EVENT_FILTER = "COALESCE(json_extract(pre_match_json, '$.event_code'), 'Unknown') = ?"
+
+"""Approximate memory used by a decoded JSON value."""
+def json_value_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += sys.getsizeof(key) + json_value_size(item)
+    elif isinstance(value, list):
+        for item in value:
+            size += json_value_size(item)
+    return size
+
+"""Process-wide LRU cache of decoded, scored match records keyed by (id, row_version).
+
+Records are shared between requests and must be treated as read-only. Scores depend on
+config.json, so the whole cache is dropped when the config version changes."""
+class MatchRecordCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.config_key = None
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def check_config(self, key):
+        with self.lock:
+            if self.config_key != key:
+                self.entries.clear()
+                self.bytes = 0
+                self.config_key = key
+
+    def get(self, match_id, row_version):
+        with self.lock:
+            entry = self.entries.get(match_id)
+            if entry is None or entry[0] != row_version:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(match_id)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, match_id, row_version, record, size):
+        with self.lock:
+            old = self.entries.pop(match_id, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self.entries[match_id] = (row_version, record, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted[2]
+                self.stats['evictions'] += 1
+
+    def invalidate(self, match_ids=None):
+        """Drops the given match IDs, or everything when match_ids is None."""
+        with self.lock:
+            if match_ids is None:
+                self.stats['invalidations'] += len(self.entries)
+                self.entries.clear()
+                self.bytes = 0
+                return
+            for match_id in match_ids:
+                entry = self.entries.pop(match_id, None)
+                if entry is not None:
+                    self.bytes -= entry[2]
+                    self.stats['invalidations'] += 1
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(
+                self.stats,
+                entries=len(self.entries),
+                bytes=self.bytes,
+                max_bytes=self.max_bytes,
+                hit_rate=round(self.stats['hits'] / lookups, 4) if lookups else 0
+            )
+
+match_cache = MatchRecordCache(int(float(DB_SETTINGS.get('match_cache_mb', 32)) * 1024 * 1024))
+
+"""Decodes a matches row into a scored record keyed by section name."""
+def decode_match_row(row, conf):
+    pre_match = json.loads(row['pre_match_json'])
+    record = {
+        'id': row['id'],
+        'created_at': row['created_at'],
+        'row_version': row['row_version'],
+        'team_number': str(pre_match.get('team_number')),
+        'pre_match': pre_match,
+        'auto': json.loads(row['auto_json']),
+        'teleop': json.loads(row['teleop_json']),
+        'endgame': json.loads(row['endgame_json']),
+        'misc': json.loads(row['misc_json'])
+    }
+    return score_match_record(record, conf)
+
+"""The single accessor for decoded matches, in ID order (newest first if asked).
+
+Only (id, row_version) pairs are read up front; JSON is fetched and decoded just for rows
+missing from the cache, so repeated reads of unchanged data do no JSON parsing. An event_code
+other than 'all' reads only that event's index range."""
+def read_match_records(team=None, newest_first=False, limit=-1, offset=0, event_code='all'):
+    match_cache.check_config(config_version())
+    where, params = match_filters(team, event_code)
+    order = 'DESC' if newest_first else 'ASC'
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT id, row_version FROM matches {} ORDER BY id {} LIMIT ? OFFSET ?'.format(where, order),
+            params + [limit, offset]
+        )
+        versions = cursor.fetchall()
+        records = {}
+        missing = []
+        for match_id, row_version in versions:
+            record = match_cache.get(match_id, row_version)
+            if record is None:
+                missing.append(match_id)
+            else:
+                records[match_id] = record
+        if missing:
+            conf = read_config()
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                cursor.execute(
+                    MATCH_SELECT + ' WHERE id IN ({})'.format(','.join('?' * len(chunk))), chunk
+                )
+                for row in cursor.fetchall():
+                    record = decode_match_row(row, conf)
+                    size = sum(len(row[c]) for c in MATCH_JSON_COLUMNS) + json_value_size(record)
+                    match_cache.put(row['id'], row['row_version'], record, size)
+                    records[row['id']] = record
+    finally:
+        conn.close()
+    return [records[match_id] for match_id, _ in versions if match_id in records]
+
+"""Returns the WHERE clause and parameters selecting a team's and/or an event's matches."""
+def match_filters(team=None, event_code='all'):
+    clauses, params = [], []
+    if team is not None:
+        clauses.append(MATCH_TEAM_FILTER)
+        params.append(str(team))
+    if event_code != 'all':
+        clauses.append(MATCH_EVENT_FILTER)
+        params.append(event_code)
+    return ('WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+"""Serializes a matches row with its stored JSON spliced in.
+
+If cached records are given, the computed points are added from them; a row written between the
+cache read and this query is scored from the row itself."""
+def match_json(row, records=None):
+    fields = {column: row[column] for column in MATCH_COLUMNS}
+    if records is not None:
+        record = records.get(row['id'])
+        if record is None or record['row_version'] != row['row_version']:
+            record = decode_match_row(row, read_config())
+        for field in METRIC_COMPUTED_FIELDS:
+            fields[field] = record[field]
+    return splice_json_object(fields, MATCH_JSON_COLUMNS)
+
+
+
+
+
+
+
+# ==================== JSON PASSTHROUGH ====================
+
+"""Serializes a row as a JSON object, splicing the stored JSON text of raw_keys in verbatim.
+
+Everything stored in the JSON columns was written by json.dumps, so it is valid JSON and can be
+copied into the response as-is. Keys are sorted like jsonify sorts them."""
+def splice_json_object(fields, raw_keys):
+    parts = []
+    for key in sorted(fields):
+        value = fields[key]
+        text = value if key in raw_keys and value is not None else json.dumps(value)
+        parts.append('{}:{}'.format(json.dumps(key), text))
+    return '{' + ','.join(parts) + '}'
+
+"""Yields rows of a query, closing the connection once they are exhausted."""
+def iter_rows(sql, params=()):
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(200)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+"""Returns a JSON array of pre-serialized objects, streamed as it is produced if ?stream=1."""
+def json_array_response(items):
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        def generate():
+            yield '['
+            for i, item in enumerate(items):
+                yield item if i == 0 else ',' + item
+            yield ']\n'
+        return Response(stream_with_context(generate()), mimetype='application/json')
+    return Response('[' + ','.join(items) + ']\n', mimetype='application/json')
+
+
+
+
+
+
+
+# ==================== FIELD PROJECTION ====================
+
+# What a fields= list may name for each table: plain columns, JSON columns (and their short
+# aliases), and computed score fields. The id is always returned.
+PROJECTION_TABLES = {
+    'matches': {
+        'columns': ('id', 'created_at'),
+        'sections': {
+            'pre_match': 'pre_match_json', 'auto': 'auto_json', 'auto_period': 'auto_json',
+            'teleop': 'teleop_json', 'teleop_period': 'teleop_json',
+            'endgame': 'endgame_json', 'misc': 'misc_json'
+        },
+        'computed': METRIC_COMPUTED_FIELDS
+    },
+    'pits': {
+        'columns': ('id', 'created_at', 'image_path'),
+        'sections': {'pit': 'pit_json'},
+        'computed': ()
+    }
+}
+
+"""A parsed fields= list: a SELECT that builds the requested JSON inside SQLite with json_object
+and ->, plus the computed fields to add from the match cache.
+
+Paths are nested the way the full document nests them, so fields=auto.L4.Made returns
+{"id": ..., "auto_json": {"L4": {"Made": ...}}}. A path missing from a record comes back as null."""
+class FieldProjection:
+    def __init__(self, table, spec):
+        options = PROJECTION_TABLES[table]
+        sections = dict(options['sections'], **{c: c for c in options['sections'].values()})
+        self.table = table
+        self.columns = ['id']
+        self.computed = []
+        trees = {}
+        for item in spec.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            head, _, rest = item.partition('.')
+            if not rest and head in options['columns']:
+                if head not in self.columns:
+                    self.columns.append(head)
+            elif not rest and head in options['computed']:
+                if head not in self.computed:
+                    self.computed.append(head)
+            elif head in sections:
+                column = sections[head]
+                keys = rest.split('.') if rest else []
+                if any(not key or '"' in key for key in keys):
+                    raise ValueError("Invalid field path '{}'".format(item))
+                trees[column] = self.add_path(trees.get(column, {}), keys)
+            else:
+                raise ValueError("Unknown field '{}'".format(item))
+        self.raw_keys = tuple(trees)
+        self.params = []
+        selects = list(self.columns)
+        for column, tree in trees.items():
+            selects.append('{} AS {}'.format(self.tree_sql(column, tree, []), column))
+        if self.computed:
+            selects.append('row_version')
+        self.select = 'SELECT {} FROM {}'.format(', '.join(selects), table)
+
+    @staticmethod
+    def add_path(tree, keys):
+        """Merges a key path into a selection tree, where None means the whole value."""
+        if tree is None or not keys:
+            return None
+        tree[keys[0]] = FieldProjection.add_path(tree.get(keys[0], {}), keys[1:])
+        return tree
+
+    def tree_sql(self, column, tree, path):
+        if tree is None:
+            if not path:
+                return column
+            self.params.append('$' + ''.join('."{}"'.format(key) for key in path))
+            return '{} -> ?'.format(column)
+        parts = []
+        for key in sorted(tree):
+            self.params.append(key)
+            parts.append('?, ' + self.tree_sql(column, tree[key], path + [key]))
+        return 'json_object({})'.format(', '.join(parts))
+
+    def row_json(self, row, records=None):
+        fields = {column: row[column] for column in self.columns + list(self.raw_keys)}
+        if self.computed:
+            record = (records or {}).get(row['id'])
+            if record is None or record['row_version'] != row['row_version']:
+                full = list(iter_rows(MATCH_SELECT + ' WHERE id = ?', (row['id'],)))
+                record = decode_match_row(full[0], read_config()) if full else {}
+            for field in self.computed:
+                fields[field] = record.get(field)
+        return splice_json_object(fields, self.raw_keys)
+
+"""Returns the FieldProjection for the request's fields= parameter, or None to return everything."""
+def requested_projection(table):
+    spec = request.args.get('fields', '').strip()
+    return FieldProjection(table, spec) if spec else None
+
+
+
+
+
+
+
+# ==================== COLD STORAGE ARCHIVE ====================
+
+"""Archive tier for closed events and past seasons.
+
+Archiving moves the selected matches (one event, or a season by created_at year) and pits (a
+season) out of the hot tables into one zlib-compressed block per table in archive_blocks, in the
+same write-queue transaction. archive_teams records which teams each block holds, so a team query
+decompresses only that team's blocks. Reads with include_archived=1 load the needed blocks into
+an in-memory table with the hot table's name and columns, so the same SQL (filters, fields=
+projections) runs over archived rows. Archive and restore run as background jobs."""
+
+# Columns stored per archived row, and the expression the team lookup uses
+ARCHIVE_TABLES = {
+    'matches': {'columns': MATCH_COLUMNS + ('row_version',), 'team': "CAST(json_extract(pre_match_json, '$.team_number') AS TEXT)"},
+    'pits': {'columns': ('id', 'created_at', 'pit_json', 'image_path'), 'team': "CAST(json_extract(pit_json, '$.team_number') AS TEXT)"}
+}
+
+"""Turns an archive request into a scope label and the rows it selects per table.
+
+{"event_code": "CAAV"} selects that event's matches; {"season": "2024"} selects matches and pits
+created in 2024. The current season, and any scope holding matches of the live event, cannot be
+archived."""
+def archive_scope(data):
+    event_code = str(data.get('event_code') or '').strip()
+    season = str(data.get('season') or '').strip()
+    if bool(event_code) == bool(season):
+        raise ValueError('send exactly one of event_code or season')
+    if event_code:
+        scope, filters = 'event:' + event_code, {'matches': (MATCH_EVENT_FILTER, [event_code])}
+    else:
+        if not re.match(r'^\d{4}$', season):
+            raise ValueError('season must be a year, e.g. 2024')
+        if int(season) >= datetime.now().year:
+            raise ValueError('{} is not a past season'.format(season))
+        year_filter = ('substr(created_at, 1, 4) = ?', [season])
+        scope, filters = 'season:' + season, {'matches': year_filter, 'pits': year_filter}
+    conn = get_db_connection()
+    try:
+        live = live_event(conn)
+        where, params = filters['matches']
+        if live is not None and conn.execute('SELECT 1 FROM matches WHERE ({}) AND {} LIMIT 1'.format(
+                where, MATCH_EVENT_FILTER), params + [live]).fetchone():
+            raise ValueError('{} holds matches of the current event {}'.format(scope, live))
+    finally:
+        conn.close()
+    return scope, filters
+
+"""Event being scouted: config.json current_event, else the event of the newest match row."""
+def live_event(conn):
+    current = read_config().get('current_event')
+    if current:
+        return current
+    row = conn.execute(
+        "SELECT COALESCE(json_extract(pre_match_json, '$.event_code'), 'Unknown') FROM matches ORDER BY id DESC LIMIT 1"
+    ).fetchone()
+    return row[0] if row else None
+
+"""Write operation that compresses the selected rows into archive blocks and deletes them from the hot tables."""
+def archive_rows(cursor, scope, filters):
+    result = {'scope': scope, 'blocks': [], 'ids': {}}
+    for table, (where, params) in filters.items():
+        spec = ARCHIVE_TABLES[table]
+        rows = cursor.execute('SELECT {} FROM {} WHERE {} ORDER BY id'.format(
+            ', '.join(spec['columns']), table, where), params).fetchall()
+        if not rows:
+            continue
+        teams = [row[0] for row in cursor.execute('SELECT DISTINCT {} FROM {} WHERE {}'.format(
+            spec['team'], table, where), params).fetchall() if row[0] is not None]
+        payload = json.dumps({'columns': spec['columns'], 'rows': [list(row) for row in rows]}).encode('utf-8')
+        data = zlib.compress(payload, 9)
+        cursor.execute('''
+            INSERT INTO archive_blocks (kind, scope, row_count, raw_bytes, stored_bytes, data)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (table, scope, len(rows), len(payload), len(data), data))
+        block_id = cursor.lastrowid
+        cursor.executemany('INSERT INTO archive_teams (team_number, block_id) VALUES (?, ?)',
+                           [(team, block_id) for team in teams])
+        cursor.execute('DELETE FROM {} WHERE {}'.format(table, where), params)
+        result['blocks'].append({'id': block_id, 'kind': table, 'rows': len(rows),
+                                 'raw_bytes': len(payload), 'stored_bytes': len(data)})
+        result['ids'][table] = [row[0] for row in rows]
+    return result
+
+"""Write operation that moves an archive block's rows back into its table and drops the block.
+
+Rows keep their IDs unless the ID has been reused since (e.g. after a reindex); those get new IDs."""
+def restore_archive_block(cursor, block_id):
+    block = cursor.execute('SELECT kind, scope, data FROM archive_blocks WHERE id = ?', (block_id,)).fetchone()
+    if block is None:
+        raise ValueError('archive block {} not found'.format(block_id))
+    payload = json.loads(zlib.decompress(block['data']))
+    columns = payload['columns']
+    renumbered = 0
+    for row in payload['rows']:
+        if cursor.execute('SELECT 1 FROM {} WHERE id = ?'.format(block['kind']), (row[0],)).fetchone():
+            cursor.execute('INSERT INTO {} ({}) VALUES ({})'.format(
+                block['kind'], ', '.join(columns[1:]), ', '.join('?' * (len(columns) - 1))), row[1:])
+            renumbered += 1
+        else:
+            cursor.execute('INSERT INTO {} ({}) VALUES ({})'.format(
+                block['kind'], ', '.join(columns), ', '.join('?' * len(columns))), row)
+    cursor.execute('DELETE FROM archive_teams WHERE block_id = ?', (block_id,))
+    cursor.execute('DELETE FROM archive_blocks WHERE id = ?', (block_id,))
+    return {'block': block_id, 'kind': block['kind'], 'scope': block['scope'],
+            'rows': len(payload['rows']), 'renumbered': renumbered}
+
+"""Loads a table's archive blocks (only those holding the team, if given) into an in-memory table of the same name."""
+def archive_database(table, team=None):
+    conn = get_db_connection()
+    try:
+        if team is None:
+            blocks = conn.execute('SELECT data FROM archive_blocks WHERE kind = ? ORDER BY id', (table,)).fetchall()
+        else:
+            blocks = conn.execute('''
+                SELECT b.data FROM archive_blocks b JOIN archive_teams t ON t.block_id = b.id
+                WHERE b.kind = ? AND t.team_number = ? ORDER BY b.id
+            ''', (table, str(team))).fetchall()
+    finally:
+        conn.close()
+    columns = ARCHIVE_TABLES[table]['columns']
+    memory = sqlite3.connect(':memory:')
+    memory.row_factory = sqlite3.Row
+    memory.execute('CREATE TABLE {} ({})'.format(table, ', '.join(columns)))
+    for block in blocks:
+        payload = json.loads(zlib.decompress(block['data']))
+        memory.executemany('INSERT INTO {} ({}) VALUES ({})'.format(
+            table, ', '.join(payload['columns']), ', '.join('?' * len(payload['columns']))), payload['rows'])
+    return memory
+
+"""True when the request asks for archived rows too."""
+def include_archived():
+    return request.args.get('include_archived', '').lower() in ('1', 'true')
+
+"""Returns archived matches as decoded, scored records (not cached), filtered like read_match_records."""
+def read_archived_match_records(team=None, event_code='all'):
+    where, params = match_filters(team, event_code)
+    archive = archive_database('matches', team)
+    try:
+        conf = read_config()
+        return [decode_match_row(row, conf) for row in archive.execute(MATCH_SELECT + ' ' + where + ' ORDER BY id', params)]
+    finally:
+        archive.close()
+
+"""Runs archive and restore operations on their own threads and keeps the last 50 results."""
+class BackgroundJobs:
+    def __init__(self, keep=50):
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+    def submit(self, name, function, *args):
+        with self.lock:
+            job = {'id': self.next_id, 'name': name, 'status': 'queued', 'result': None, 'error': None,
+                   'created_at': datetime.now().isoformat(timespec='seconds'), 'finished_at': None}
+            self.next_id += 1
+            self.jobs[job['id']] = job
+            while len(self.jobs) > self.keep:
+                self.jobs.popitem(last=False)
+        threading.Thread(target=self._run, args=(job, function, args), name='job-{}'.format(job['id']), daemon=True).start()
+        return dict(job)
+
+    def _run(self, job, function, args):
+        job['status'] = 'running'
+        try:
+            job['result'] = function(*args)
+            job['status'] = 'done'
+        except Exception as e:
+            print(f"Background job {job['name']} failed: {e}")
+            job['error'] = str(e)
+            job['status'] = 'failed'
+        job['finished_at'] = datetime.now().isoformat(timespec='seconds')
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+background_jobs = BackgroundJobs()
+
+"""Marks caches derived from archived or restored tables as stale."""
+def archive_changed(tables, match_ids=()):
+    match_cache.invalidate(list(match_ids))
+    bump_data_version(*tables)
+    if 'matches' in tables:
+        team_ratings.invalidate()
+
+"""Background job: archives a scope and refreshes caches."""
+def run_archive(scope, filters):
+    result = write_queue.run(archive_rows, scope, filters)
+    ids = result.pop('ids')
+    if ids:
+        archive_changed(list(ids), ids.get('matches', []))
+    return result
+
+"""Background job: restores one archive block and refreshes caches."""
+def run_archive_restore(block_id):
+    result = write_queue.run(restore_archive_block, block_id)
+    archive_changed([result['kind']])
+    return result
+
+"""Lists archive blocks with row counts and compressed sizes (admin only)."""
+@app.route('/api/archive', methods=['GET'])
+@login_required(role="admin")
+def list_archive():
+    try:
+        conn = get_db_connection()
+        rows = conn.execute('''
+            SELECT id, kind, scope, row_count, raw_bytes, stored_bytes, archived_at
+            FROM archive_blocks ORDER BY id
+        ''').fetchall()
+        conn.close()
+        return jsonify([dict(row) for row in rows])
+    except Exception as e:
+        return jsonify({'error': 'db', 'details': str(e)}), 500
+
+"""Starts archiving a closed event or a past season: {"event_code": "CAAV"} or {"season": "2024"} (admin only)."""
+@app.route('/api/archive', methods=['POST'])
+@login_required(role="admin")
+def start_archive():
+    try:
+        scope, filters = archive_scope(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': 'scope', 'details': str(e)}), 400
+    return jsonify(background_jobs.submit('archive ' + scope, run_archive, scope, filters)), 202
+
+"""Starts moving an archive block back into the hot tables (admin only)."""
+@app.route('/api/archive/<int:block_id>/restore', methods=['POST'])
+@login_required(role="admin")
+def start_archive_restore(block_id):
+    return jsonify(background_jobs.submit('restore block {}'.format(block_id), run_archive_restore, block_id)), 202
+
+"""Returns the status and result of an archive or restore job (admin only)."""
+@app.route('/api/archive/jobs/<int:job_id>', methods=['GET'])
+@login_required(role="admin")
+def get_archive_job(job_id):
+    job = background_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'not found'}), 404
+    return jsonify(job)
+
 
 
 
@@ -1510,24 +4129,18 @@ def delete_pit(pit_id):
 
 """Calculates and returns average scores for a specific team across all their matches."""
 @app.route('/api/team/<team>/averages', methods=['GET'])
+@analytics_read
 def get_team_averages(team):
     try:
-        conf = read_config()
         match_type_filter = request.args.get('match_type', 'all')
         event_code_filter = request.args.get('event_code', 'all')
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM matches ORDER BY id')
-        all_matches = cursor.fetchall()
-        conn.close()
-
+        records = read_match_records(team=team, event_code=event_code_filter)
+        if include_archived():
+            records = read_archived_match_records(team, event_code_filter) + records
         team_matches = []
-        for row in all_matches:
-            pre_match_data = json.loads(row['pre_match_json'])
-            if str(pre_match_data.get('team_number')) != str(team):
-                continue
-
+        for record in records:
+            pre_match_data = record['pre_match']
             match_type = pre_match_data.get('match_type', 'Unknown')
             event_code = pre_match_data.get('event_code', 'Unknown')
 
@@ -1536,7 +4149,7 @@ def get_team_averages(team):
             if event_code_filter != 'all' and event_code != event_code_filter:
                 continue
 
-            team_matches.append(row)
+            team_matches.append(record)
 
         if not team_matches:
             return jsonify({
@@ -1546,10 +4159,10 @@ def get_team_averages(team):
             })
 
         auto_total = tele_total = end_total = 0
-        for row in team_matches:
-            auto_total += auto_score(json.loads(row['auto_json']), conf)
-            tele_total += tele_score(json.loads(row['teleop_json']), conf)
-            end_total += endgame_score(json.loads(row['endgame_json']), conf)
+        for record in team_matches:
+            auto_total += record['auto_points']
+            tele_total += record['teleop_points']
+            end_total += record['endgame_points']
 
         n = len(team_matches)
         return jsonify({
@@ -1566,34 +4179,37 @@ def get_team_averages(team):
 
 """Retrieves all match data for a specific team with calculated scoring."""
 @app.route('/api/team/<team>/matches', methods=['GET'])
+@analytics_read
 def get_team_matches(team):
     try:
-        conf = read_config()
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM matches ORDER BY id ASC')
-        all_matches = cursor.fetchall()
-        conn.close()
-        matches = []
-        for row in all_matches:
-            pre_match_data = json.loads(row['pre_match_json'])
-            if str(pre_match_data.get('team_number')) != str(team):
-                continue
-            match_data = dict(row)
-            match_data['pre_match_json'] = pre_match_data
-            match_data['auto_json'] = json.loads(row['auto_json'])
-            match_data['teleop_json'] = json.loads(row['teleop_json'])
-            match_data['endgame_json'] = json.loads(row['endgame_json'])
-            match_data['misc_json'] = json.loads(row['misc_json'])
-            auto_pts = auto_score(match_data['auto_json'], conf)
-            tele_pts = tele_score(match_data['teleop_json'], conf)
-            end_pts = endgame_score(match_data['endgame_json'], conf)
-            match_data['auto_points'] = auto_pts
-            match_data['teleop_points'] = tele_pts
-            match_data['endgame_points'] = end_pts
-            match_data['total_points'] = auto_pts + tele_pts + end_pts
-            matches.append(match_data)
-        return jsonify(matches)
+        projection = requested_projection('matches')
+    except ValueError as e:
+        return jsonify({'error': 'fields', 'details': str(e)}), 400
+    try:
+        event_code = request.args.get('event_code', 'all')
+        where, params = match_filters(team, event_code)
+        select, select_params = (projection.select, projection.params) if projection else (MATCH_SELECT, [])
+        render = projection.row_json if projection else match_json
+        records = None
+        if projection is None or projection.computed:
+            records = {record['id']: record for record in read_match_records(team=team, event_code=event_code)}
+        rows = iter_rows(select + ' ' + where + ' ORDER BY id', select_params + params)
+        items = (render(row, records) for row in rows)
+        if include_archived():
+            # Archived rows come first: they belong to closed events and seasons
+            archive = archive_database('matches', team)
+            try:
+                archived_records = None
+                if records is not None:
+                    conf = read_config()
+                    archived_records = {row['id']: decode_match_row(row, conf) for row in
+                                        archive.execute(MATCH_SELECT + ' ' + where, params)}
+                archived = [render(row, archived_records) for row in
+                            archive.execute(select + ' ' + where + ' ORDER BY id', select_params + params)]
+            finally:
+                archive.close()
+            items = itertools.chain(archived, items)
+        return json_array_response(items)
     except Exception as e:
         return jsonify({'error': 'db', 'details': str(e)}), 500
 
@@ -1639,36 +4255,48 @@ def get_team_info(team):
 
 """Retrieves pit scouting data for a specific team."""
 @app.route('/api/team/<team>/pit', methods=['GET'])
+@analytics_read
 def get_team_pit(team):
+    try:
+        projection = requested_projection('pits')
+    except ValueError as e:
+        return jsonify({'error': 'fields', 'details': str(e)}), 400
     try:
        #print(f"Looking for pit data for team: {team} (type: {type(team)})")
+        select, params = (projection.select, projection.params) if projection else ('SELECT * FROM pits', [])
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT id, pit_json FROM pits')
-        all_pits = cursor.fetchall()
-       #print("All pit entries:")
-        #for pit in all_pits:
-            #pit_json = json.loads(pit['pit_json'])
-            #print(f"  ID {pit['id']}: Team {pit_json.get('team_number')} (type: {type(pit_json.get('team_number'))})")
-        cursor.execute('''
-            SELECT * FROM pits 
+        cursor.execute(select + '''
             WHERE json_extract(pit_json, '$.team_number') = ?
             ORDER BY id DESC LIMIT 1
-        ''', (team,))
+        ''', params + [team])
         row = cursor.fetchone()
         if not row:
             #print("Team not found with string match, trying integer...")
             if team.isdigit():
-                cursor.execute('''
-                    SELECT * FROM pits 
+                cursor.execute(select + '''
                     WHERE json_extract(pit_json, '$.team_number') = ?
                     ORDER BY id DESC LIMIT 1
-                ''', (int(team),))
+                ''', params + [int(team)])
                 row = cursor.fetchone()
         conn.close()
+        if not row and include_archived():
+            archive = archive_database('pits', team)
+            try:
+                for value in ([team, int(team)] if team.isdigit() else [team]):
+                    row = archive.execute(select + '''
+                        WHERE json_extract(pit_json, '$.team_number') = ?
+                        ORDER BY id DESC LIMIT 1
+                    ''', params + [value]).fetchone()
+                    if row:
+                        break
+            finally:
+                archive.close()
         if not row:
             #print(f"No pit data found for team {team}")
             return jsonify({'error': 'not found'}), 404
+        if projection:
+            return Response(projection.row_json(row) + '\n', mimetype='application/json')
         pit_data = dict(row)
         pit_data['pit_json'] = json.loads(row['pit_json'])
         #print(f"Found pit data: {pit_data}")
@@ -1685,8 +4313,52 @@ def get_team_pit(team):
 
 # ==================== RANKINGS ENDPOINT ====================
 
+rankings_snapshot = {'key': None, 'snapshot': None}
+rankings_snapshot_lock = threading.Lock()
+
+"""Computes every rankings option for every team in one pass, sorted best-first.
+
+Cached against the matches data version and the config version, so it is rebuilt lazily by the
+first rankings request after a write and every other request is a dictionary lookup."""
+def get_rankings_snapshot(conf):
+    key = (data_version('matches'), config_version())
+    with rankings_snapshot_lock:
+        if rankings_snapshot['key'] == key:
+            return rankings_snapshot['snapshot']
+        team_matches = {}
+        for match in read_match_records():
+            team_matches.setdefault(match['team_number'], []).append(match)
+        engine = get_ranking_engine(conf)
+        values = engine.evaluate(team_matches, conf=conf)
+        options = {}
+        for option, spec in conf.get('rankings_options', {}).items():
+            entry = {'description': spec.get('description', option)}
+            if option in engine.errors:
+                entry['error'] = engine.errors[option]
+            else:
+                rows = [{
+                    'team_number': team_number,
+                    'matches_count': len(matches),
+                    'metric_value': values[team_number][option]
+                } for team_number, matches in team_matches.items()]
+                rows.sort(key=lambda x: x['metric_value'], reverse=True)
+                entry['rows'] = rows
+            options[option] = entry
+        snapshot = {'version': key[0], 'options': options}
+        rankings_snapshot['key'] = key
+        rankings_snapshot['snapshot'] = snapshot
+        return snapshot
+
+"""Applies the min_matches and team filters to a sorted snapshot row list (top 100)."""
+def filter_ranking_rows(rows, min_matches, team_filter):
+    return [
+        row for row in rows
+        if row['matches_count'] >= min_matches and (not team_filter or row['team_number'] == team_filter)
+    ][:100]
+
 """Generates team rankings based on various statistical metrics and filtering options."""
 @app.route('/api/rankings', methods=['GET'])
+@analytics_read
 def get_rankings():
     try:
         conf = read_config()
@@ -1696,45 +4368,1177 @@ def get_rankings():
         spec = conf.get('rankings_options', {}).get(option)
         if not spec:
             return jsonify({'error': 'unknown option'}), 400
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM matches ORDER BY id')
-        all_matches = cursor.fetchall()
-        conn.close()
-        team_matches = {}
-        for row in all_matches:
-            pre_match = json.loads(row['pre_match_json'])
-            team_number = str(pre_match.get('team_number'))
-            if team_number not in team_matches:
-                team_matches[team_number] = []
-            match_data = {
-                'pre_match': pre_match,
-                'auto': json.loads(row['auto_json']),
-                'teleop': json.loads(row['teleop_json']),
-                'endgame': json.loads(row['endgame_json']),
-                'misc': json.loads(row['misc_json'])
+        entry = get_rankings_snapshot(conf)['options'][option]
+        if 'error' in entry:
+            return jsonify({'error': 'invalid metric', 'details': entry['error']}), 400
+        return jsonify({
+            'option': option,
+            'description': entry['description'],
+            'rows': filter_ranking_rows(entry['rows'], min_matches, team_filter)
+        })
+    except Exception as e:
+        return jsonify({'error': 'db', 'details': str(e)}), 500
+
+"""Returns every rankings option at once from the same snapshot, with the same filters as /api/rankings."""
+@app.route('/api/rankings/all', methods=['GET'])
+@analytics_read
+def get_all_rankings():
+    try:
+        conf = read_config()
+        min_matches = int(request.args.get('min_matches', 0))
+        team_filter = request.args.get('team', '')
+        snapshot = get_rankings_snapshot(conf)
+        options = {}
+        for option, entry in snapshot['options'].items():
+            if 'error' in entry:
+                options[option] = entry
+            else:
+                options[option] = {
+                    'description': entry['description'],
+                    'rows': filter_ranking_rows(entry['rows'], min_matches, team_filter)
+                }
+        return jsonify({'version': snapshot['version'], 'options': options})
+    except Exception as e:
+        return jsonify({'error': 'db', 'details': str(e)}), 500
+
+
+
+
+
+
+
+# ==================== TEAM RATINGS ====================
+
+DEFAULT_RATING_FIELDS = ('total_points', 'auto_points', 'teleop_points', 'endgame_points')
+
+"""Exponentially weighted per-team ratings of scouted points and chosen fields, in match ID order.
+
+A rating moves towards each new match by alpha: rating += alpha * (value - rating), starting from
+the first match's value. A new match is folded into its team's ratings in O(1). Editing or
+deleting a match replays only that team's history (an exponential average cannot be un-applied).
+Ratings are built lazily from history and rebuilt when config.json changes or after bulk writes."""
+class TeamRatings:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key = None
+        self.alpha = 0.3
+        self.fields = {}
+        self.errors = {}
+        self.teams = {}
+        self.match_teams = {}
+        self.stats = {'folds': 0, 'replays': 0, 'rebuilds': 0}
+
+    def configure(self, conf):
+        settings = conf.get('ratings', {})
+        self.alpha = float(settings.get('alpha', 0.3))
+        self.fields = {}
+        self.errors = {}
+        for path in settings.get('fields', DEFAULT_RATING_FIELDS):
+            try:
+                self.fields[path] = compile_metric_path(path)
+            except MetricSyntaxError as e:
+                self.errors[path] = str(e)
+
+    def fold(self, record):
+        team = record['team_number']
+        state = self.teams.setdefault(team, {'matches': 0, 'last_match_id': None, 'ratings': {}})
+        ratings = state['ratings']
+        for path, resolve in self.fields.items():
+            value = frame_number(resolve(record))
+            ratings[path] = value if path not in ratings else ratings[path] + self.alpha * (value - ratings[path])
+        state['matches'] += 1
+        state['last_match_id'] = record['id']
+        self.match_teams[record['id']] = team
+        self.stats['folds'] += 1
+
+    def replay(self, teams):
+        for team in teams:
+            if team is None:
+                continue
+            for match_id in [m for m, t in self.match_teams.items() if t == team]:
+                del self.match_teams[match_id]
+            self.teams.pop(team, None)
+            for record in read_match_records(team=team):
+                self.fold(record)
+            self.stats['replays'] += 1
+
+    def ensure(self, conf):
+        """Rebuilds from history if nothing is built or config.json changed; call with the lock held."""
+        key = config_version()
+        if self.key == key:
+            return
+        self.configure(conf)
+        self.teams = {}
+        self.match_teams = {}
+        for record in read_match_records():
+            self.fold(record)
+        self.key = key
+        self.stats['rebuilds'] += 1
+
+    def add(self, record):
+        """Folds in a newly created match; out-of-order IDs (concurrent inserts) replay the team.
+
+        A rebuild that ran after the insert committed has already folded the match, so it is skipped."""
+        with self.lock:
+            if self.key != config_version() or record['id'] in self.match_teams:
+                return
+            state = self.teams.get(record['team_number'])
+            if state is not None and state['last_match_id'] is not None and record['id'] < state['last_match_id']:
+                self.replay([record['team_number']])
+            else:
+                self.fold(record)
+
+    def changed(self, match_id, team=None):
+        """Replays the teams a match belonged to before and after an update or delete."""
+        with self.lock:
+            if self.key != config_version():
+                return
+            self.replay({self.match_teams.get(match_id), team})
+
+    def invalidate(self):
+        with self.lock:
+            self.key = None
+
+    def team(self, team, conf):
+        with self.lock:
+            self.ensure(conf)
+            state = self.teams.get(str(team))
+            return {
+                'team': team,
+                'alpha': self.alpha,
+                'matches': state['matches'] if state else 0,
+                'ratings': dict(state['ratings']) if state else {},
+                'errors': dict(self.errors)
             }
-            team_matches[team_number].append(match_data)
-        rankings = []
-        for team_number, matches in team_matches.items():
-            if len(matches) < min_matches:
+
+    def table(self, field, conf):
+        with self.lock:
+            self.ensure(conf)
+            if field not in self.fields:
+                return None
+            rows = [{
+                'team_number': team,
+                'matches_count': state['matches'],
+                'metric_value': state['ratings'][field]
+            } for team, state in self.teams.items()]
+        rows.sort(key=lambda x: x['metric_value'], reverse=True)
+        return rows
+
+    def rebuild(self, conf):
+        with self.lock:
+            self.key = None
+            self.ensure(conf)
+            return dict(self.stats, teams=len(self.teams), matches=len(self.match_teams))
+
+team_ratings = TeamRatings()
+
+"""Returns a team's exponentially weighted ratings (see the ratings block of config.json)."""
+@app.route('/api/team/<team>/rating', methods=['GET'])
+def get_team_rating(team):
+    try:
+        return jsonify(team_ratings.team(team, read_config()))
+    except Exception as e:
+        return jsonify({'error': 'db', 'details': str(e)}), 500
+
+"""Ranks teams by one exponentially weighted rating, with the same filters as /api/rankings."""
+@app.route('/api/rankings/ratings', methods=['GET'])
+def get_rating_rankings():
+    try:
+        conf = read_config()
+        field = request.args.get('field', 'total_points')
+        min_matches = int(request.args.get('min_matches', 0))
+        team_filter = request.args.get('team', '')
+        rows = team_ratings.table(field, conf)
+        if rows is None:
+            return jsonify({'error': 'unknown rating field', 'details': field}), 400
+        return jsonify({
+            'field': field,
+            'alpha': team_ratings.alpha,
+            'rows': filter_ranking_rows(rows, min_matches, team_filter)
+        })
+    except Exception as e:
+        return jsonify({'error': 'db', 'details': str(e)}), 500
+
+"""Rebuilds every team rating from match history (admin only)."""
+@app.route('/api/ratings/rebuild', methods=['POST'])
+@login_required(role="admin")
+def rebuild_team_ratings():
+    try:
+        return jsonify(team_ratings.rebuild(read_config()))
+    except Exception as e:
+        return jsonify({'error': 'rebuild', 'details': str(e)}), 500
+
+
+
+
+
+
+
+# ==================== DISTRIBUTION STATISTICS ====================
+
+# match_form field types summarised as numbers (booleans become 0/1) and as option frequencies
+FRAME_NUMERIC_TYPES = ('Boolean', 'Boolean with Value', 'Integer', 'Typed Integer', 'Float', 'Counter')
+FRAME_CHOICE_TYPES = ('Single Choice List', 'Single Choice List with Value', 'Single Choice with Image')
+DISTRIBUTION_PERCENTILES = (0, 10, 25, 50, 75, 90, 100)
+
+"""Column-oriented copy of every match for vectorized statistics.
+
+numeric maps a field path (auto.L4.Made, misc.died, total_points, ...) to a float array with one
+entry per match; a missing value counts as 0, as it does when scoring. choices maps a field path to
+(codes, options), where options are the configured options followed by any other values seen, and
+-1 means nothing was recorded. ids and match_numbers (NaN when missing) identify each entry."""
+class MatchFrame:
+    def __init__(self, records, conf):
+        self.teams = np.array([record['team_number'] for record in records], dtype=object)
+        self.match_types = np.array(
+            [record['pre_match'].get('match_type', 'Unknown') for record in records], dtype=object)
+        self.event_codes = np.array(
+            [record['pre_match'].get('event_code', 'Unknown') for record in records], dtype=object)
+        self.ids = np.array([record['id'] for record in records], dtype=np.int64)
+        self.match_numbers = np.array(
+            [frame_match_number(record['pre_match'].get('match_number')) for record in records])
+        self.numeric = {}
+        self.choices = {}
+        for field in METRIC_COMPUTED_FIELDS:
+            self.numeric[field] = np.array([record[field] for record in records], dtype=float)
+        for section_name, fields in conf.get('match_form', {}).items():
+            section = METRIC_SECTIONS.get(section_name)
+            if section is None or section == 'pre_match' or not isinstance(fields, dict):
                 continue
-            if team_filter and team_number != team_filter:
+            for field, spec in fields.items():
+                if not isinstance(spec, dict):
+                    continue
+                kind = spec.get('type') or spec.get('Type')
+                values = [record[section].get(field) for record in records]
+                path = '{}.{}'.format(section, field)
+                if kind == 'Scoring Object':
+                    for part in ('Made', 'Missed'):
+                        if spec.get(part):
+                            self.numeric[path + '.' + part] = np.array([
+                                frame_number(value.get(part) if isinstance(value, dict) else None)
+                                for value in values
+                            ])
+                elif kind in FRAME_NUMERIC_TYPES:
+                    self.numeric[path] = np.array([frame_number(value) for value in values])
+                elif kind in FRAME_CHOICE_TYPES and spec.get('options'):
+                    options = list(spec['options'])
+                    index = {option: i for i, option in enumerate(options)}
+                    for value in values:
+                        if isinstance(value, str) and value and value not in index:
+                            index[value] = len(options)
+                            options.append(value)
+                    codes = np.array([index.get(value, -1) if isinstance(value, str) else -1
+                                      for value in values], dtype=np.int64)
+                    self.choices[path] = (codes, options)
+
+    def mask(self, match_type='all', event_code='all'):
+        mask = np.ones(len(self.teams), dtype=bool)
+        if match_type != 'all':
+            mask &= self.match_types == match_type
+        if event_code != 'all':
+            mask &= self.event_codes == event_code
+        return mask
+
+"""Coerces a stored field value to a float (true/false become 1/0, anything else non-numeric 0)."""
+def frame_number(value):
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    return 0.0
+
+"""Returns a match number as a float, accepting numeric text; NaN when it is missing or not a number."""
+def frame_match_number(value):
+    if isinstance(value, bool):
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+match_frames = OrderedDict()
+match_frame_lock = threading.Lock()
+
+"""Returns the MatchFrame for the current matches data version and config version.
+
+An event_code other than 'all' builds the frame from that event's matches only, so event-day
+statistics stay the same size however much history is stored. The last 8 frames are kept."""
+def get_match_frame(conf, event_code='all'):
+    key = (data_version('matches'), config_version())
+    with match_frame_lock:
+        cached = match_frames.get(event_code)
+        if cached is None or cached[0] != key:
+            cached = match_frames[event_code] = (key, MatchFrame(read_match_records(event_code=event_code), conf))
+            while len(match_frames) > 8:
+                match_frames.popitem(last=False)
+        match_frames.move_to_end(event_code)
+        return cached[1]
+
+"""Computes distribution statistics for every team in the mask in one vectorized pass.
+
+Each team's matches are laid out in one row of a NaN-padded (field, team, match) array, so the
+percentiles, mean and standard deviation of every field for every team come from whole-array
+NumPy operations. Consistency is 1 / (1 + std / mean): 1 for a team that always scores the same, falling
+towards 0 as the spread grows relative to the mean (1 when the mean is 0)."""
+def team_distributions(frame, mask):
+    rows = np.flatnonzero(mask)
+    if len(rows) == 0:
+        return {}
+    teams, team_index, counts = np.unique(frame.teams[rows].astype(str), return_inverse=True, return_counts=True)
+    team_index = team_index.reshape(-1)
+    order = np.argsort(team_index, kind='stable')
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sorted_team = team_index[order]
+    slot = np.arange(len(order)) - starts[sorted_team]
+
+    names = list(frame.numeric)
+    grid = np.full((len(names), len(teams), counts.max()), np.nan)
+    grid[:, sorted_team, slot] = np.stack([frame.numeric[name][rows][order] for name in names])
+    mean = np.nansum(grid, axis=2) / counts
+    std = np.sqrt(np.nansum((grid - mean[:, :, None]) ** 2, axis=2) / counts)
+    # Linear-interpolated percentiles (numpy's default method); sorting moves the NaN padding last
+    grid.sort(axis=2)
+    position = np.array(DISTRIBUTION_PERCENTILES)[:, None] / 100 * (counts - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    team_axis = np.arange(len(teams))
+    below = grid[:, team_axis, lower]
+    percentiles = (below + (position - lower) * (grid[:, team_axis, upper] - below)).transpose(1, 0, 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        consistency = np.where(mean > 0, 1 / (1 + std / mean), 1.0)
+
+    stats = {
+        'mean': mean.tolist(), 'std': std.tolist(), 'consistency': consistency.tolist(),
+        'min': percentiles[0].tolist(), 'p10': percentiles[1].tolist(), 'p25': percentiles[2].tolist(),
+        'median': percentiles[3].tolist(), 'p75': percentiles[4].tolist(), 'p90': percentiles[5].tolist(),
+        'max': percentiles[6].tolist()
+    }
+    frequencies = {}
+    for name, (codes, options) in frame.choices.items():
+        width = len(options) + 1
+        picked = codes[rows]
+        picked = np.where(picked < 0, len(options), picked)
+        table = np.bincount(team_index * width + picked, minlength=len(teams) * width)
+        frequencies[name] = (table.reshape(len(teams), width)[:, :-1] / counts[:, None]).tolist()
+
+    result = {}
+    for t, team in enumerate(teams.tolist()):
+        result[team] = {
+            'team': team,
+            'matches': int(counts[t]),
+            'fields': {
+                name: {stat: values[f][t] for stat, values in stats.items()}
+                for f, name in enumerate(names)
+            },
+            'frequencies': {
+                name: dict(zip(frame.choices[name][1], table[t]))
+                for name, table in frequencies.items()
+            }
+        }
+    return result
+
+"""Returns median, spread, percentiles and consistency of each match_form field for one team."""
+@app.route('/api/team/<team>/distribution', methods=['GET'])
+@analytics_read
+def get_team_distribution(team):
+    try:
+        conf = read_config()
+        event_code = request.args.get('event_code', 'all')
+        frame = get_match_frame(conf, event_code)
+        mask = frame.mask(request.args.get('match_type', 'all'), event_code)
+        mask &= frame.teams == str(team)
+        distribution = team_distributions(frame, mask).get(str(team))
+        if distribution is None:
+            return jsonify({'team': team, 'matches': 0, 'fields': {}, 'frequencies': {}})
+        return jsonify(distribution)
+    except Exception as e:
+        return jsonify({'error': 'db', 'details': str(e)}), 500
+
+"""Returns the same distribution statistics for every team, computed together."""
+@app.route('/api/teams/distribution', methods=['GET'])
+@analytics_read
+def get_all_team_distributions():
+    try:
+        conf = read_config()
+        event_code = request.args.get('event_code', 'all')
+        frame = get_match_frame(conf, event_code)
+        mask = frame.mask(request.args.get('match_type', 'all'), event_code)
+        return jsonify({'teams': team_distributions(frame, mask)})
+    except Exception as e:
+        return jsonify({'error': 'db', 'details': str(e)}), 500
+
+
+
+
+
+
+
+# ==================== PERFORMANCE TRENDS ====================
+
+TREND_DEFAULT_FIELDS = ('auto_points', 'teleop_points', 'endgame_points', 'total_points')
+
+"""Returns the masked frame rows in trend order: by team, then event (in the order events were first
+scouted), match type (in match_form option order), match_number and finally match ID."""
+def trend_rows(frame, mask, conf):
+    rows = np.flatnonzero(mask)
+    if len(rows) == 0:
+        return rows
+    ids = frame.ids[rows]
+    _, event_index = np.unique(frame.event_codes[rows].astype(str), return_inverse=True)
+    event_index = event_index.reshape(-1)
+    first_seen = np.full(event_index.max() + 1, np.iinfo(np.int64).max)
+    np.minimum.at(first_seen, event_index, ids)
+    type_options = conf.get('match_form', {}).get('pre_match', {}).get('match_type', {}).get('options', [])
+    type_rank = {option: i for i, option in enumerate(type_options)}
+    types = np.array([type_rank.get(t, len(type_options)) for t in frame.match_types[rows].tolist()])
+    teams = frame.teams[rows].astype(str)
+    order = np.lexsort((ids, frame.match_numbers[rows], types, first_seen[event_index], teams))
+    return rows[order]
+
+"""Returns trailing rolling means and least-squares slopes (points per match) over the last window
+entries of each row of a (fields, teams, matches) array; early matches use the entries so far."""
+def rolling_trend(values, window):
+    x = np.arange(values.shape[-1], dtype=float)
+    y = np.nan_to_num(values)
+    def window_sum(a):
+        total = np.cumsum(a, axis=-1)
+        total[..., window:] = total[..., window:] - total[..., :-window].copy()
+        return total
+    n = np.minimum(x + 1, window)
+    sum_x, sum_xx = window_sum(x), window_sum(x * x)
+    sum_y, sum_xy = window_sum(y), window_sum(y * x)
+    denominator = n * sum_xx - sum_x ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(denominator > 0, (n * sum_xy - sum_x * sum_y) / denominator, 0.0)
+    return sum_y / n, slope
+
+"""Builds per-match series with rolling means and slopes for every team in the mask.
+
+Each team's matches fill one row of a NaN-padded (field, team, match) array, so the windows for
+every field and team come from a few cumulative sums instead of a loop per team."""
+def team_trends(frame, mask, fields, window, conf):
+    rows = trend_rows(frame, mask, conf)
+    if len(rows) == 0:
+        return {}
+    teams, team_index, counts = np.unique(frame.teams[rows].astype(str), return_inverse=True, return_counts=True)
+    team_index = team_index.reshape(-1)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    slot = np.arange(len(rows)) - starts[team_index]
+    grid = np.full((len(fields), len(teams), counts.max()), np.nan)
+    grid[:, team_index, slot] = np.stack([frame.numeric[field][rows] for field in fields])
+    mean, slope = rolling_trend(grid, window)
+    grid, mean, slope = np.round(grid, 3), np.round(mean, 3), np.round(slope, 3)
+    match_numbers = frame.match_numbers[rows]
+    result = {}
+    for t, team in enumerate(teams.tolist()):
+        n = int(counts[t])
+        team_rows = rows[starts[t]:starts[t] + n]
+        result[team] = {
+            'team': team,
+            'matches': n,
+            'match_id': frame.ids[team_rows].tolist(),
+            'match_number': [None if np.isnan(m) else int(m) if m.is_integer() else m
+                             for m in match_numbers[starts[t]:starts[t] + n].tolist()],
+            'event_code': frame.event_codes[team_rows].tolist(),
+            'match_type': frame.match_types[team_rows].tolist(),
+            'fields': {
+                field: {
+                    'values': grid[f, t, :n].tolist(),
+                    'rolling_mean': mean[f, t, :n].tolist(),
+                    'rolling_slope': slope[f, t, :n].tolist()
+                } for f, field in enumerate(fields)
+            }
+        }
+    return result
+
+"""Returns per-match point series with rolling-window means and slopes for one or many teams.
+
+Query: teams (comma-separated; every team when omitted), fields (comma-separated frame paths such as
+teleop.L4.Made or misc.died, added to auto/teleop/endgame/total points), window (3, up to 50),
+match_type and event_code. Series are ordered by event, match type and match_number."""
+@app.route('/api/teams/trends', methods=['GET'])
+@analytics_read
+def get_team_trends():
+    try:
+        conf = read_config()
+        event_code = request.args.get('event_code', 'all')
+        frame = get_match_frame(conf, event_code)
+        fields = list(TREND_DEFAULT_FIELDS)
+        for field in request.args.get('fields', '').split(','):
+            head, dot, rest = field.strip().partition('.')
+            field = METRIC_SECTIONS.get(head, head) + dot + rest
+            if not field or field in fields:
                 continue
-            metric_value = calculate_ranking_metric(option, matches, conf)
-            rankings.append({
-                'team_number': team_number,
-                'matches_count': len(matches),
-                'metric_value': metric_value
+            if field not in frame.numeric:
+                return jsonify({'error': 'fields', 'details': "Unknown numeric field '{}'".format(field)}), 400
+            fields.append(field)
+        try:
+            window = min(50, max(1, int(request.args.get('window', 3))))
+        except ValueError:
+            return jsonify({'error': 'window must be a whole number'}), 400
+        mask = frame.mask(request.args.get('match_type', 'all'), event_code)
+        teams = [t.strip() for t in request.args.get('teams', '').split(',') if t.strip()]
+        if teams:
+            mask &= np.isin(frame.teams.astype(str), teams)
+        return jsonify({
+            'window': window,
+            'fields': fields,
+            'teams': team_trends(frame, mask, fields, window, conf)
+        })
+    except Exception as e:
+        return jsonify({'error': 'trends', 'details': str(e)}), 500
+
+
+
+
+
+
+
+# ==================== MATCH SIMULATION ====================
+
+SIMULATION_PERCENTILES = (5, 25, 50, 75, 95)
+
+"""Simulates trials matches between two alliances by resampling each robot's scouted matches.
+
+Every trial draws one of each robot's matches at random, so auto, teleop and endgame points keep
+whatever correlation they have within a match. All robots and trials are drawn in one NumPy
+operation. Robots without scouted matches score 0 and are listed in missing_teams."""
+def simulate_alliances(frame, mask, red, blue, trials, seed):
+    rng = np.random.default_rng(seed)
+    robots = [str(team) for team in red + blue]
+    rows = [np.flatnonzero(mask & (frame.teams == team)) for team in robots]
+    counts = np.array([len(r) for r in rows])
+    padded = np.zeros((len(robots), max(counts.max(), 1)), dtype=np.int64)
+    for i, r in enumerate(rows):
+        padded[i, :len(r)] = r
+    draws = (rng.random((len(robots), trials)) * np.maximum(counts, 1)[:, None]).astype(np.int64)
+    picked = np.take_along_axis(padded, draws, axis=1)
+    present = (counts > 0)[:, None]
+    periods = {
+        period: np.where(present, frame.numeric[period + '_points'][picked], 0.0)
+        for period in ('auto', 'teleop', 'endgame')
+    }
+    red_scores = {period: points[:len(red)].sum(axis=0) for period, points in periods.items()}
+    blue_scores = {period: points[len(red):].sum(axis=0) for period, points in periods.items()}
+    red_total = sum(red_scores.values())
+    blue_total = sum(blue_scores.values())
+    margin = red_total - blue_total
+
+    def alliance(teams, scores, total, wins):
+        return {
+            'teams': [str(team) for team in teams],
+            'win_probability': float(wins.mean()),
+            'mean': float(total.mean()),
+            'std': float(total.std()),
+            'auto_mean': float(scores['auto'].mean()),
+            'teleop_mean': float(scores['teleop'].mean()),
+            'endgame_mean': float(scores['endgame'].mean()),
+            'percentiles': dict(zip(
+                ('p{}'.format(p) for p in SIMULATION_PERCENTILES),
+                np.percentile(total, SIMULATION_PERCENTILES).tolist()
+            ))
+        }
+
+    histogram, edges = np.histogram(margin, bins=20)
+    return {
+        'trials': trials,
+        'seed': seed,
+        'red': alliance(red, red_scores, red_total, margin > 0),
+        'blue': alliance(blue, blue_scores, blue_total, margin < 0),
+        'tie_probability': float((margin == 0).mean()),
+        'margin': {
+            'mean': float(margin.mean()),
+            'std': float(margin.std()),
+            'percentiles': dict(zip(
+                ('p{}'.format(p) for p in SIMULATION_PERCENTILES),
+                np.percentile(margin, SIMULATION_PERCENTILES).tolist()
+            )),
+            'histogram': {'edges': edges.tolist(), 'probabilities': (histogram / trials).tolist()}
+        },
+        'missing_teams': [team for team, count in zip(robots, counts) if count == 0]
+    }
+
+"""Runs a Monte Carlo simulation of a red vs blue match from scouted data.
+
+Body: {"red": [teams], "blue": [teams], "trials": 20000, "seed": 1, "match_type": "all", "event_code": "all"}.
+trials is clamped to 1,000-100,000. Without a seed one is chosen and returned, so any result can
+be reproduced by sending it back."""
+@app.route('/api/simulate', methods=['POST'])
+@analytics_read
+def simulate_match():
+    try:
+        data = request.get_json() or {}
+        red = [team for team in data.get('red', []) if str(team).strip()]
+        blue = [team for team in data.get('blue', []) if str(team).strip()]
+        if not red or not blue:
+            return jsonify({'error': 'Each alliance needs at least one team'}), 400
+        try:
+            trials = min(max(int(data.get('trials', 20000)), 1000), 100000)
+            seed = data.get('seed')
+            seed = int(seed) if seed is not None else secrets.randbits(32)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'trials and seed must be whole numbers'}), 400
+        conf = read_config()
+        event_code = data.get('event_code', 'all')
+        frame = get_match_frame(conf, event_code)
+        mask = frame.mask(data.get('match_type', 'all'), event_code)
+        return jsonify(simulate_alliances(frame, mask, red, blue, trials, seed))
+    except Exception as e:
+        return jsonify({'error': 'simulate', 'details': str(e)}), 500
+
+"""Reads a remaining qualification schedule from a JSON list or an uploaded CSV.
+
+Each match is {"red": [3 teams], "blue": [3 teams]}; CSV files need red1-red3 and blue1-blue3
+columns. Returns a list of (red, blue) team-number string tuples."""
+def parse_schedule(data):
+    if 'csv' in request.files:
+        stream = StringIO(request.files['csv'].stream.read().decode("UTF8"), newline=None)
+        matches = [
+            ([row.get('red{}'.format(i), '') for i in (1, 2, 3)], [row.get('blue{}'.format(i), '') for i in (1, 2, 3)])
+            for row in csv.DictReader(stream)
+        ]
+    else:
+        matches = [(match.get('red', []), match.get('blue', [])) for match in data.get('schedule', [])]
+    schedule = []
+    for number, (red, blue) in enumerate(matches, start=1):
+        red = [str(team).strip() for team in red if str(team).strip()]
+        blue = [str(team).strip() for team in blue if str(team).strip()]
+        if len(red) != 3 or len(blue) != 3:
+            raise ValueError('Schedule match {} needs three red and three blue teams'.format(number))
+        schedule.append((red, blue))
+    return schedule
+
+# Trials simulated together by project_standings; bounds each request to a few tens of MB
+PROJECTION_CHUNK = 1000
+
+"""Simulates the rest of the qualification schedule and returns each team's rank distribution.
+
+Robot scores are drawn from each team's scouted total points (teams without scouting data draw
+from every scouted match). Trials are drawn PROJECTION_CHUNK at a time, every match of a chunk at
+once, so memory stays bounded however many trials are asked for; ranking points are summed per
+team with one bincount per chunk, and teams are ranked by ranking points, then simulated match points."""
+def project_standings(frame, mask, schedule, current_rp, trials, seed, win_rp, tie_rp):
+    rng = np.random.default_rng(seed)
+    teams = sorted(set(current_rp) | {team for red, blue in schedule for team in red + blue},
+                   key=lambda team: (len(team), team))
+    index = {team: i for i, team in enumerate(teams)}
+    pooled = np.flatnonzero(mask)
+    rows = []
+    scouted = []
+    for team in teams:
+        team_rows = np.flatnonzero(mask & (frame.teams == team))
+        scouted.append(len(team_rows) > 0)
+        rows.append(team_rows if len(team_rows) else pooled)
+    counts = np.array([len(r) for r in rows])
+    padded = np.zeros((len(teams), max(counts.max(), 1)), dtype=np.int64)
+    for i, r in enumerate(rows):
+        padded[i, :len(r)] = r
+    points = frame.numeric['total_points'] if len(pooled) else np.zeros(1)
+
+    rp_totals = np.zeros((trials, len(teams)))
+    score_totals = np.zeros((trials, len(teams)))
+    if schedule:
+        slots = np.array([[index[team] for team in red + blue] for red, blue in schedule])
+        for start in range(0, trials, PROJECTION_CHUNK):
+            chunk = min(PROJECTION_CHUNK, trials - start)
+            draws = (rng.random((chunk,) + slots.shape) * np.maximum(counts[slots], 1)).astype(np.int64)
+            robot_points = points[padded[slots, draws]]
+            red = robot_points[:, :, :3].sum(axis=2)
+            blue = robot_points[:, :, 3:].sum(axis=2)
+            red_rp = np.where(red > blue, win_rp, np.where(red == blue, tie_rp, 0.0))
+            blue_rp = np.where(blue > red, win_rp, np.where(red == blue, tie_rp, 0.0))
+            slot_rp = np.concatenate([np.repeat(red_rp[:, :, None], 3, axis=2),
+                                      np.repeat(blue_rp[:, :, None], 3, axis=2)], axis=2)
+            slot_score = np.concatenate([np.repeat(red[:, :, None], 3, axis=2),
+                                         np.repeat(blue[:, :, None], 3, axis=2)], axis=2)
+            flat = (np.arange(chunk)[:, None, None] * len(teams) + slots[None, :, :]).ravel()
+            size = chunk * len(teams)
+            rp_totals[start:start + chunk] += np.bincount(
+                flat, weights=slot_rp.ravel(), minlength=size).reshape(chunk, len(teams))
+            score_totals[start:start + chunk] += np.bincount(
+                flat, weights=slot_score.ravel(), minlength=size).reshape(chunk, len(teams))
+    rp_totals += np.array([float(current_rp.get(team, 0)) for team in teams])
+
+    # Rank by ranking points, breaking ties on simulated match points (largest first)
+    key = rp_totals * (score_totals.max() + 1) + score_totals
+    order = np.argsort(-key, axis=1, kind='stable')
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(len(teams))[None, :], axis=1)
+    distribution = np.bincount(
+        (np.arange(len(teams))[None, :] * len(teams) + ranks).ravel(), minlength=len(teams) ** 2
+    ).reshape(len(teams), len(teams)) / trials
+
+    projections = []
+    for i, team in enumerate(teams):
+        projections.append({
+            'team_number': team,
+            'scouted': scouted[i],
+            'expected_rp': float(rp_totals[:, i].mean()),
+            'mean_rank': float(ranks[:, i].mean() + 1),
+            'median_rank': float(np.median(ranks[:, i]) + 1),
+            'top_8_probability': float((ranks[:, i] < 8).mean()),
+            'rank_probabilities': distribution[i].tolist()
+        })
+    projections.sort(key=lambda row: row['mean_rank'])
+    return {'trials': trials, 'seed': seed, 'matches': len(schedule), 'teams': projections}
+
+"""Projects final qualification standings from the remaining schedule (JSON body or CSV upload).
+
+JSON body: {"schedule": [{"red": [...], "blue": [...]}], "current_rp": {"4123": 12}, "trials": 5000,
+"seed": 1, "win_rp": 3, "tie_rp": 1, "match_type": "all", "event_code": "all"}. A CSV upload sends the
+schedule as the 'csv' file and the other settings as form fields."""
+@app.route('/api/projections/standings', methods=['POST'])
+@analytics_read
+def project_event_standings():
+    try:
+        data = request.get_json(silent=True) or request.form.to_dict()
+        try:
+            current_rp = data.get('current_rp') or {}
+            if isinstance(current_rp, str):
+                current_rp = json.loads(current_rp)
+            current_rp = {str(team): float(rp) for team, rp in current_rp.items()}
+            if not all(math.isfinite(rp) for rp in current_rp.values()):
+                raise ValueError
+        except (AttributeError, TypeError, ValueError):
+            return jsonify({'error': 'current_rp must map team numbers to ranking points'}), 400
+        try:
+            schedule = parse_schedule(data)
+        except ValueError as e:
+            return jsonify({'error': 'schedule', 'details': str(e)}), 400
+        if not schedule and not current_rp:
+            return jsonify({'error': 'No schedule provided'}), 400
+        try:
+            trials = min(max(int(data.get('trials', 5000)), 100), 50000)
+            seed = data.get('seed')
+            seed = int(seed) if seed not in (None, '') else secrets.randbits(32)
+            win_rp, tie_rp = float(data.get('win_rp', 3)), float(data.get('tie_rp', 1))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'trials, seed, win_rp and tie_rp must be numbers'}), 400
+        conf = read_config()
+        event_code = data.get('event_code', 'all')
+        frame = get_match_frame(conf, event_code)
+        mask = frame.mask(data.get('match_type', 'all'), event_code)
+        return jsonify(project_standings(
+            frame, mask, schedule, current_rp, trials, seed, win_rp, tie_rp
+        ))
+    except Exception as e:
+        return jsonify({'error': 'projection', 'details': str(e)}), 500
+
+
+
+
+
+
+
+# ==================== PICK LIST ====================
+
+PICKLIST_PHASES = ('auto', 'teleop', 'endgame')
+# Weight of the best, second and third robot in each phase; robots doing the same job get in each
+# other's way, so a partner strong where we are weak adds more than one who duplicates us
+PICKLIST_OVERLAP = np.array([1.0, 0.85, 0.7])
+
+picklist_cache = OrderedDict()
+picklist_cache_lock = threading.Lock()
+
+"""Per-team phase means, total-points spread and reliability for the pick list, as arrays.
+
+Reliability is 1 - died rate - half the tippy rate; each robot's phase points are scaled by it."""
+def picklist_team_stats(frame, mask, min_matches):
+    rows = np.flatnonzero(mask)
+    teams, index, counts = np.unique(frame.teams[rows].astype(str), return_inverse=True, return_counts=True)
+    index = index.reshape(-1)
+    zeros = np.zeros(len(frame.teams))
+
+    def team_mean(values):
+        return np.bincount(index, weights=values[rows], minlength=len(teams)) / np.maximum(counts, 1)
+
+    phases = np.stack([team_mean(frame.numeric[phase + '_points']) for phase in PICKLIST_PHASES], axis=1)
+    mean_total = team_mean(frame.numeric['total_points'])
+    variance = team_mean(frame.numeric['total_points'] ** 2) - mean_total ** 2
+    died = team_mean(frame.numeric.get('misc.died', zeros))
+    tippy = team_mean(frame.numeric.get('misc.tippy', zeros))
+    keep = counts >= min_matches
+    return {
+        'teams': teams[keep].tolist(),
+        'matches': counts[keep],
+        'phases': phases[keep],
+        'std': np.sqrt(np.maximum(variance, 0))[keep],
+        'died': died[keep],
+        'tippy': tippy[keep],
+        'reliability': np.clip(1 - died - 0.5 * tippy, 0, 1)[keep]
+    }
+
+"""Scores every two-partner alliance with our team, best first.
+
+All C(n, 2) partner pairs are scored in one NumPy pass: each phase totals the robots'
+reliability-weighted points, sorted and weighted by PICKLIST_OVERLAP, and risk times the alliance's
+total-points standard deviation is subtracted. Returns (pairs, phase totals, scores)."""
+def rank_alliances(stats, team, risk):
+    contribution = stats['phases'] * stats['reliability'][:, None]
+    ours = np.zeros(len(PICKLIST_PHASES))
+    our_std = 0.0
+    if team in stats['teams']:
+        i = stats['teams'].index(team)
+        ours, our_std = contribution[i], stats['std'][i]
+    candidates = np.array([i for i, t in enumerate(stats['teams']) if t != team], dtype=np.int64)
+    if len(candidates) < 2:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros((0, len(PICKLIST_PHASES))), np.zeros(0)
+    first, second = np.triu_indices(len(candidates), k=1)
+    pairs = np.stack([candidates[first], candidates[second]], axis=1)
+    robots = np.stack([
+        np.broadcast_to(ours, (len(pairs), len(PICKLIST_PHASES))),
+        contribution[pairs[:, 0]],
+        contribution[pairs[:, 1]]
+    ], axis=1)
+    robots = -np.sort(-robots, axis=1)
+    phase_totals = (robots * PICKLIST_OVERLAP[None, :, None]).sum(axis=1)
+    spread = np.sqrt(our_std ** 2 + stats['std'][pairs[:, 0]] ** 2 + stats['std'][pairs[:, 1]] ** 2)
+    scores = phase_totals.sum(axis=1) - risk * spread
+    order = np.argsort(-scores, kind='stable')
+    return pairs[order], phase_totals[order], scores[order]
+
+"""Returns the team stats and ranked alliances for these settings, cached per data version.
+
+Picking teams only filters the cached ranking, so the list refreshes without rescoring."""
+def get_picklist(conf, team, match_type, event_code, min_matches, risk):
+    key = (data_version('matches'), config_version(), team, match_type, event_code, min_matches, risk)
+    with picklist_cache_lock:
+        if key in picklist_cache:
+            picklist_cache.move_to_end(key)
+            return picklist_cache[key]
+    frame = get_match_frame(conf, event_code)
+    stats = picklist_team_stats(frame, frame.mask(match_type, event_code), min_matches)
+    entry = (stats, rank_alliances(stats, team, risk))
+    with picklist_cache_lock:
+        picklist_cache[key] = entry
+        while len(picklist_cache) > 32:
+            picklist_cache.popitem(last=False)
+    return entry
+
+"""Suggests alliance partners and full alliances for a team from scouted stats.
+
+Query: team (required), picked (comma-separated teams already taken), limit (20), min_matches (1),
+risk (0; higher prefers consistent alliances), match_type and event_code. Partners are ranked by the
+best alliance still available with them."""
+@app.route('/api/picklist', methods=['GET'])
+@analytics_read
+def get_pick_list():
+    try:
+        team = request.args.get('team', '').strip()
+        if not team:
+            return jsonify({'error': 'team is required'}), 400
+        picked = {t.strip() for t in request.args.get('picked', '').split(',') if t.strip()}
+        try:
+            limit = max(1, int(request.args.get('limit', 20)))
+            min_matches = max(1, int(request.args.get('min_matches', 1)))
+            risk = float(request.args.get('risk', 0))
+        except ValueError:
+            return jsonify({'error': 'limit and min_matches must be whole numbers and risk a number'}), 400
+        if not math.isfinite(risk):
+            return jsonify({'error': 'risk must be finite'}), 400
+        conf = read_config()
+        stats, (pairs, phase_totals, scores) = get_picklist(
+            conf, team, request.args.get('match_type', 'all'), request.args.get('event_code', 'all'),
+            min_matches, risk
+        )
+        taken = np.array([t in picked for t in stats['teams']], dtype=bool)
+        available = ~(taken[pairs[:, 0]] | taken[pairs[:, 1]]) if len(pairs) else np.zeros(0, dtype=bool)
+        pairs, phase_totals, scores = pairs[available], phase_totals[available], scores[available]
+
+        best = np.full(len(stats['teams']), -np.inf)
+        np.maximum.at(best, pairs[:, 0], scores)
+        np.maximum.at(best, pairs[:, 1], scores)
+        partners = []
+        for i in np.argsort(-best, kind='stable')[:limit]:
+            if not np.isfinite(best[i]):
+                break
+            partners.append({
+                'team_number': stats['teams'][i],
+                'best_alliance_score': float(best[i]),
+                'matches': int(stats['matches'][i]),
+                'auto': float(stats['phases'][i, 0]),
+                'teleop': float(stats['phases'][i, 1]),
+                'endgame': float(stats['phases'][i, 2]),
+                'std': float(stats['std'][i]),
+                'died_rate': float(stats['died'][i]),
+                'tippy_rate': float(stats['tippy'][i]),
+                'reliability': float(stats['reliability'][i])
             })
-        rankings.sort(key=lambda x: x['metric_value'], reverse=True)
+        alliances = [{
+            'teams': [team, stats['teams'][a], stats['teams'][b]],
+            'score': float(score),
+            'auto': float(phases[0]),
+            'teleop': float(phases[1]),
+            'endgame': float(phases[2])
+        } for (a, b), phases, score in zip(pairs[:limit].tolist(), phase_totals[:limit], scores[:limit])]
         return jsonify({
-            'option': option,
-            'description': spec.get('description', option),
-            'rows': rankings[:100]
+            'team': team,
+            'team_scouted': team in stats['teams'],
+            'picked': sorted(picked),
+            'partners': partners,
+            'alliances': alliances
         })
     except Exception as e:
-        return jsonify({'error': 'db', 'details': str(e)}), 500
+        return jsonify({'error': 'picklist', 'details': str(e)}), 500
+
+
+
+
+
+
+
+# ==================== AD-HOC QUERY API ====================
+
+# Limits from the "query" block of config.json (read once at startup)
+QUERY_SETTINGS = read_config().get('query', {})
+QUERY_AGGREGATIONS = ('count', 'sum', 'avg', 'min', 'max', 'rate')
+QUERY_OPERATORS = {'==': '=', '!=': '!=', '>': '>', '>=': '>=', '<': '<', '<=': '<='}
+QUERY_SHORTCUTS = {
+    'team_number': 'pre_match.team_number', 'event_code': 'pre_match.event_code',
+    'match_type': 'pre_match.match_type'
+}
+# The expressions idx_matches_team and idx_matches_event are built on, so filters and groups on
+# these fields can be answered from the index
+QUERY_INDEXED_FIELDS = {
+    ('pre_match_json', 'team_number'): "CAST(json_extract(pre_match_json, '$.team_number') AS TEXT)",
+    ('pre_match_json', 'event_code'): "COALESCE(json_extract(pre_match_json, '$.event_code'), 'Unknown')"
+}
+# The team index compares text, so <, <=, > and >= on team_number use this numeric form instead
+QUERY_TEAM_NUMBER = "CAST(json_extract(pre_match_json, '$.team_number') AS INTEGER)"
+
+query_fields_cache = {'version': None, 'fields': None}
+query_fields_lock = threading.Lock()
+query_cache = OrderedDict()
+query_cache_lock = threading.Lock()
+
+"""Raised when a /api/query request names an unknown field or cannot be parsed."""
+class QuerySyntaxError(ValueError):
+    pass
+
+"""Raised when a query runs longer than the configured time limit."""
+class QueryTimeout(Exception):
+    pass
+
+"""Returns {path: SQL expression} for every match_form field a query may use, rebuilt when config.json changes.
+
+Scoring Objects are only available through their Made and Missed counts."""
+def query_fields():
+    version = config_version()
+    with query_fields_lock:
+        if query_fields_cache['version'] != version:
+            match_form = read_config().get('match_form', {})
+            forms = {key: section for section, key in MATCH_FORM_SECTIONS}
+            fields = {}
+            for alias, column in PROJECTION_TABLES['matches']['sections'].items():
+                for name, spec in match_form.get(forms[column], {}).items():
+                    if not isinstance(spec, dict) or '"' in name:
+                        continue
+                    kind = str(spec.get('type') or spec.get('Type') or '').strip().lower()
+                    if kind == 'scoring object' or (not kind and 'Made' in spec):
+                        keys = [[name, k] for k in ('Made', 'Missed') if spec.get(k, True)]
+                    else:
+                        keys = [[name]]
+                    for key in keys:
+                        path = '$' + ''.join('."{}"'.format(k) for k in key)
+                        fields['.'.join([alias] + key)] = QUERY_INDEXED_FIELDS.get(
+                            (column, name),
+                            "json_extract({}, '{}')".format(column, path.replace("'", "''")))
+            query_fields_cache['fields'] = fields
+            query_fields_cache['version'] = version
+        return query_fields_cache['fields']
+
+"""A /api/query request compiled to one parameterized SELECT over matches.
+
+Group-by fields become the leading result columns, aggregations follow, and filters are ANDed in
+the WHERE clause. Only match_form fields are accepted; every value is bound as a parameter."""
+class QueryPlan:
+    def __init__(self, spec, max_rows):
+        if not isinstance(spec, dict):
+            raise QuerySyntaxError('Expected a JSON object')
+        self.fields = query_fields()
+        self.params = []
+        group_by = self.as_list(spec.get('group_by'), 'group_by')
+        select = self.as_list(spec.get('select', ['count']), 'select')
+        if not select:
+            raise QuerySyntaxError('select needs at least one aggregation')
+        self.columns = list(group_by) + list(select)
+        if len(set(self.columns)) != len(self.columns):
+            raise QuerySyntaxError('Duplicate group_by or select entry')
+        expressions = ['{} AS g{}'.format(self.field(path), i) for i, path in enumerate(group_by)]
+        expressions += ['{} AS a{}'.format(self.aggregate(item), i) for i, item in enumerate(select)]
+        where = [self.condition(*clause) for text in self.as_list(spec.get('where'), 'where')
+                 for clause in self.where_clauses(text)]
+        self.sql = 'SELECT {} FROM matches'.format(', '.join(expressions))
+        if where:
+            self.sql += ' WHERE ' + ' AND '.join(where)
+        if group_by:
+            self.sql += ' GROUP BY ' + ', '.join(str(i + 1) for i in range(len(group_by)))
+        self.sql += ' ORDER BY ' + self.order(spec.get('order_by'), len(group_by))
+        try:
+            self.limit = min(int(spec.get('limit', QUERY_SETTINGS.get('default_rows', 1000))), max_rows)
+        except (TypeError, ValueError):
+            raise QuerySyntaxError('limit must be a whole number')
+        if self.limit < 1:
+            raise QuerySyntaxError('limit must be at least 1')
+        self.sql += ' LIMIT ?'
+        self.params.append(self.limit + 1)
+
+    @staticmethod
+    def as_list(value, name):
+        if value is None:
+            return []
+        if isinstance(value, str):
+            return [value]
+        if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+            raise QuerySyntaxError('{} must be a string or a list of strings'.format(name))
+        return [v.strip() for v in value]
+
+    def field(self, path):
+        path = QUERY_SHORTCUTS.get(path, path)
+        if path not in self.fields:
+            raise QuerySyntaxError("Unknown field '{}'".format(path))
+        return self.fields[path]
+
+    def condition(self, path, op, literal):
+        """Returns the SQL for 'path op literal', binding the literal."""
+        expression = self.field(path)
+        if expression.startswith('CAST(') and not isinstance(literal, bool):
+            if isinstance(literal, float):
+                if not literal.is_integer():
+                    raise QuerySyntaxError("'{} {}' needs a whole number".format(path, op))
+                literal = int(literal)
+            if op in ('==', '!='):
+                literal = str(literal)
+            elif isinstance(literal, (int, float)):
+                expression = QUERY_TEAM_NUMBER
+            else:
+                raise QuerySyntaxError("'{} {}' needs a number".format(path, op))
+        self.params.append(int(literal) if isinstance(literal, bool) else literal)
+        return '{} {} ?'.format(expression, QUERY_OPERATORS[op])
+
+    def where_clauses(self, text):
+        """Parses 'path op value [and path op value ...]' into (path, op, literal) tuples."""
+        try:
+            tokens = tokenize_metric(text) if text else []
+        except MetricSyntaxError as e:
+            raise QuerySyntaxError(str(e))
+        clauses = []
+        for index in range(0, len(tokens), 4):
+            part = tokens[index:index + 4]
+            if (len(part) < 3 or part[0][0] != 'name' or part[1][0] != 'op'
+                    or part[2][0] not in ('number', 'string', 'name')
+                    or (len(part) == 4 and part[3] != ('name', 'and'))):
+                raise QuerySyntaxError("Expected 'field op value [and ...]' in '{}'".format(text))
+            clauses.append((part[0][1], part[1][1], parse_metric_literal(*part[2])))
+        if tokens and tokens[-1] == ('name', 'and'):
+            raise QuerySyntaxError("Dangling 'and' in '{}'".format(text))
+        return clauses
+
+    def aggregate(self, item):
+        """Compiles 'count', 'count(path)', 'agg(path)' or 'rate(path [op value])' to SQL."""
+        try:
+            tokens = tokenize_metric(item)
+        except MetricSyntaxError as e:
+            raise QuerySyntaxError(str(e))
+        if not tokens or tokens[0][0] != 'name' or tokens[0][1] not in QUERY_AGGREGATIONS:
+            raise QuerySyntaxError("Unknown aggregation '{}'; use one of {}".format(
+                item, ', '.join(QUERY_AGGREGATIONS)))
+        name = tokens[0][1]
+        args = tokens[1:]
+        if not args or args == [('punct', '('), ('punct', ')')]:
+            if name != 'count':
+                raise QuerySyntaxError('{}() needs a field path'.format(name))
+            return 'COUNT(*)'
+        if args[0] != ('punct', '(') or args[-1] != ('punct', ')') or len(args) not in (3, 5):
+            raise QuerySyntaxError("Expected '{}(field)' in '{}'".format(name, item))
+        if args[1][0] != 'name':
+            raise QuerySyntaxError("Expected a field path in '{}'".format(item))
+        if len(args) == 5:
+            if name != 'rate' or args[2][0] != 'op' or args[3][0] not in ('number', 'string', 'name'):
+                raise QuerySyntaxError("Only rate() takes a condition, as 'rate(field op value)'")
+            condition = self.condition(args[1][1], args[2][1], parse_metric_literal(*args[3]))
+        else:
+            expression = self.field(args[1][1])
+            condition = "{0} IS NOT NULL AND {0} NOT IN (0, '')".format(expression)
+            if name != 'rate':
+                return '{}({})'.format(name.upper(), expression)
+        return 'AVG(CASE WHEN {} THEN 1.0 ELSE 0.0 END) * 100'.format(condition)
+
+    def order(self, order_by, groups):
+        """Returns the ORDER BY list: the requested column first, then the group-by columns."""
+        keys = [str(i + 1) for i in range(groups)]
+        if order_by:
+            if not isinstance(order_by, str):
+                raise QuerySyntaxError('order_by must be a string')
+            descending = order_by.startswith('-')
+            name = order_by.lstrip('-').strip()
+            name = next((c for c in self.columns if c == name or QUERY_SHORTCUTS.get(c) == name), None)
+            if name is None:
+                raise QuerySyntaxError("order_by must name a group_by or select entry")
+            position = str(self.columns.index(name) + 1)
+            keys = [position + (' DESC' if descending else '')] + [k for k in keys if k != position]
+        return ', '.join(keys) or '1'
+
+    def key(self):
+        return (self.sql, tuple(self.params))
+
+"""Runs a compiled query with the configured time limit; returns (rows, truncated)."""
+def execute_query(plan):
+    timeout = float(QUERY_SETTINGS.get('timeout_ms', 2000)) / 1000
+    deadline = time.monotonic() + timeout
+    conn = get_db_connection()
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+    try:
+        rows = conn.execute(plan.sql, plan.params).fetchall()
+    except sqlite3.OperationalError as e:
+        if 'interrupted' in str(e):
+            raise QueryTimeout('Query took longer than {:.0f} ms; add filters or fewer groups'.format(timeout * 1000))
+        raise
+    finally:
+        conn.close()
+    return [dict(zip(plan.columns, row)) for row in rows[:plan.limit]], len(rows) > plan.limit
+
+"""Returns the result for a plan, cached per matches data version and config version."""
+def get_query_result(plan):
+    key = (data_version('matches'), config_version()) + plan.key()
+    with query_cache_lock:
+        if key in query_cache:
+            query_cache.move_to_end(key)
+            return query_cache[key], True
+    result = execute_query(plan)
+    with query_cache_lock:
+        query_cache[key] = result
+        while len(query_cache) > int(QUERY_SETTINGS.get('cache_entries', 64)):
+            query_cache.popitem(last=False)
+    return result, False
+
+"""Answers an aggregate question over match scouting data with a single SQLite query.
+
+Body: {"group_by": ["team_number"], "select": ["count", "avg(teleop.L4.Made)", "rate(misc.died)"],
+"where": ["event_code == 'CAAV' and match_type == 'Qualification'"], "order_by": "-avg(teleop.L4.Made)",
+"limit": 100}. Fields are match_form paths (section.field, plus .Made/.Missed for Scoring Objects);
+team_number, event_code and match_type are shortcuts for their pre_match fields."""
+@app.route('/api/query', methods=['POST'])
+@analytics_read
+def run_query():
+    try:
+        plan = QueryPlan(request.get_json(silent=True), int(QUERY_SETTINGS.get('max_rows', 5000)))
+        started = time.perf_counter()
+        (rows, truncated), cached = get_query_result(plan)
+        return jsonify({
+            'columns': plan.columns,
+            'rows': rows,
+            'truncated': truncated,
+            'cached': cached,
+            'data_version': data_version('matches'),
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)
+        })
+    except QuerySyntaxError as e:
+        return jsonify({'error': 'query', 'details': str(e)}), 400
+    except QueryTimeout as e:
+        return jsonify({'error': 'timeout', 'details': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': 'query', 'details': str(e)}), 500
 
 
 
@@ -1746,13 +5550,19 @@ def get_rankings():
 
 """Exports all match data as a CSV file download."""
 @app.route('/api/export/matches.csv', methods=['GET'])
+@analytics_read
 def export_matches_csv():
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM matches ORDER BY id ASC')
+        cursor.execute('SELECT {} FROM matches ORDER BY id ASC'.format(', '.join(MATCH_COLUMNS)))
         rows = [dict(row) for row in cursor.fetchall()]
         conn.close()
+        if include_archived():
+            archive = archive_database('matches')
+            archived = archive.execute('SELECT {} FROM matches ORDER BY id ASC'.format(', '.join(MATCH_COLUMNS)))
+            rows = [dict(row) for row in archived.fetchall()] + rows
+            archive.close()
         csv_data = to_csv(rows)
         return csv_data, 200, {
             'Content-Type': 'text/csv',
@@ -1763,6 +5573,7 @@ def export_matches_csv():
 
 """Exports all pit scouting data as a CSV file download."""
 @app.route('/api/export/pits.csv', methods=['GET'])
+@analytics_read
 def export_pits_csv():
     try:
         conn = get_db_connection()
@@ -1770,6 +5581,10 @@ def export_pits_csv():
         cursor.execute('SELECT * FROM pits ORDER BY id ASC')
         rows = [dict(row) for row in cursor.fetchall()]
         conn.close()
+        if include_archived():
+            archive = archive_database('pits')
+            rows = [dict(row) for row in archive.execute('SELECT * FROM pits ORDER BY id ASC').fetchall()] + rows
+            archive.close()
         csv_data = to_csv(rows)
         return csv_data, 200, {
             'Content-Type': 'text/csv',
@@ -1786,10 +5601,26 @@ def export_pits_csv():
 
 # ==================== CSV UPLOAD ENDPOINT ====================
 
-"""Handles CSV file uploads for importing match or pit data into the database."""
+"""Parses a CSV row's JSON columns and validates them; raises SubmissionError listing every bad column or field."""
+def csv_row_sections(row, validator):
+    sections = {}
+    errors = []
+    for key in validator.sections:
+        try:
+            sections[key] = json.loads(row[key]) if row.get(key) else {}
+        except ValueError as e:
+            errors.append({'field': key, 'error': 'invalid JSON ({})'.format(e)})
+    if errors:
+        raise SubmissionError(errors)
+    return validator.validate(sections)
+
+"""Handles CSV file uploads for importing match or pit data into the database.
+Every row is validated against the form config before it is written; rows that fail are skipped and
+reported in row_errors. With mode=validate the file is only checked and nothing is written."""
 @app.route('/api/upload/csv', methods=['POST'])
 def upload_csv():
     try:
+        validate_only = (request.form.get('mode') or request.args.get('mode', 'import')) == 'validate'
         if 'csv' not in request.files:
             return jsonify({'error': 'No CSV file provided'}), 400
         file = request.files['csv']
@@ -1808,14 +5639,23 @@ def upload_csv():
         cursor = conn.cursor()
         records_processed = 0
         errors = []
+        row_errors = []
+        def reject(i, row, e):
+            row_errors.append({'row': i + 1, 'id': row.get('id'), 'errors': e.errors})
+            errors.extend("Row {}: {}: {}".format(i + 1, err['field'], err['error']) for err in e.errors)
         if 'pre_match_json' in first_row:
+            validator = get_form_validator('match')
             for i, row in enumerate(csv_data):
                 try:
-                    pre_match_json = json.loads(row['pre_match_json']) if row['pre_match_json'] else {}
-                    auto_json = json.loads(row['auto_json']) if row['auto_json'] else {}
-                    teleop_json = json.loads(row['teleop_json']) if row['teleop_json'] else {}
-                    endgame_json = json.loads(row['endgame_json']) if row['endgame_json'] else {}
-                    misc_json = json.loads(row['misc_json']) if row['misc_json'] else {}
+                    sections = csv_row_sections(row, validator)
+                    if validate_only:
+                        records_processed += 1
+                        continue
+                    pre_match_json = sections['pre_match_json']
+                    auto_json = sections['auto_json']
+                    teleop_json = sections['teleop_json']
+                    endgame_json = sections['endgame_json']
+                    misc_json = sections['misc_json']
                     cursor.execute('SELECT id FROM matches WHERE id = ?', (row['id'],))
                     existing = cursor.fetchone()
                     if existing:
@@ -1831,12 +5671,18 @@ def upload_csv():
                         ''', (row['id'], row['created_at'], json.dumps(pre_match_json), json.dumps(auto_json),
                               json.dumps(teleop_json), json.dumps(endgame_json), json.dumps(misc_json)))
                     records_processed += 1
+                except SubmissionError as e:
+                    reject(i, row, e)
                 except Exception as e:
                     errors.append(f"Row {i+1}: {str(e)}")
         elif 'pit_json' in first_row:
+            validator = get_form_validator('pit')
             for i, row in enumerate(csv_data):
                 try:
-                    pit_json = json.loads(row['pit_json']) if row['pit_json'] else {}
+                    pit_json = csv_row_sections(row, validator)['pit_json']
+                    if validate_only:
+                        records_processed += 1
+                        continue
                     image_path = row.get('image_path', '')
                     cursor.execute('SELECT id FROM pits WHERE id = ?', (row['id'],))
                     existing = cursor.fetchone()
@@ -1851,6 +5697,8 @@ def upload_csv():
                             VALUES (?, ?, ?, ?)
                         ''', (row['id'], row['created_at'], json.dumps(pit_json), image_path))
                     records_processed += 1
+                except SubmissionError as e:
+                    reject(i, row, e)
                 except Exception as e:
                     errors.append(f"Row {i+1}: {str(e)}")
         else:
@@ -1858,9 +5706,20 @@ def upload_csv():
             return jsonify({'error': 'Unknown CSV format'}), 400
         conn.commit()
         conn.close()
+        if validate_only:
+            return jsonify({
+                'message': f'{records_processed} records are valid, {len(row_errors)} would be rejected',
+                'errors': errors if errors else None,
+                'row_errors': row_errors
+            })
+        if 'pre_match_json' in first_row:
+            match_cache.invalidate()
+            team_ratings.invalidate()
+        bump_data_version('matches' if 'pre_match_json' in first_row else 'pits')
         return jsonify({
             'message': f'Successfully processed {records_processed} records',
-            'errors': errors if errors else None
+            'errors': errors if errors else None,
+            'row_errors': row_errors
         })
     except Exception as e:
         return jsonify({'error': 'upload', 'details': str(e)}), 500
@@ -1868,4 +5727,25 @@ def upload_csv():
 # ==================== MAIN APPLICATION ENTRY POINT ====================
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        applied = run_migrations()
+        print("Schema is at version {} ({} migration(s) applied)".format(SCHEMA_VERSION, len(applied)))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'backup':
+        result = backups.take()
+        print("Wrote {} ({} bytes, sha256 {})".format(result['file'], result['bytes'], result['sha256']))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'restore':
+        if len(sys.argv) < 3:
+            print("Usage: python server.py restore <backup file>  (stop the server first)")
+            sys.exit(1)
+        backup_path = sys.argv[2] if os.path.exists(sys.argv[2]) else os.path.join(BACKUP_DIR, sys.argv[2])
+        try:
+            previous = restore_backup(backup_path)
+        except (OSError, ValueError, sqlite3.DatabaseError) as e:
+            print("Restore failed: {}".format(e))
+            sys.exit(1)
+        print("Restored {}{}".format(backup_path, "; previous database saved as " + previous if previous else ""))
+        sys.exit(0)
+    ensure_schema()
     app.run(host='0.0.0.0', port=3000, debug=True)
\ No newline at end of file